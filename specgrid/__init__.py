@@ -10,20 +10,62 @@ This is an Astropy affiliated package.
 from ._astropy_init import *
 # ----------------------------------------------------------------------------
 
-# For egg_info test builds to pass, put package imports here.
-if not _ASTROPY_SETUP_:
-    from specgrid.fix_spectrum1d import Spectrum1D
-    from specgrid.base import SpectralGrid
-    from specgrid import plugins
-    from specgrid.model_star import (ModelStar, ModelInstrument, Observation,
-                                     assemble_observation)
+import importlib
+import logging
+import sys
+import types
 
+# The public classes are imported on first access (e.g.
+# ``specgrid.SpectralGrid``) so that ``import specgrid`` does not pull in
+# scipy, pandas, h5py or specutils - each path only imports what it needs.
+_lazy_imports = {
+    'Spectrum1D': 'specgrid.fix_spectrum1d',
+    'SpectralGrid': 'specgrid.base',
+    'GridCollection': 'specgrid.grid_collection',
+    'ModelStar': 'specgrid.model_star',
+    'ModelInstrument': 'specgrid.model_star',
+    'Observation': 'specgrid.model_star',
+    'assemble_observation': 'specgrid.model_star'}
+
+_lazy_submodules = ['plugins']
+
+
+class _LazyModule(types.ModuleType):
+    """
+    specgrid package module that imports the names in ``_lazy_imports``
+    and ``_lazy_submodules`` when they are first accessed
+    """
+
+    def __getattr__(self, name):
+        if name in _lazy_submodules:
+            value = importlib.import_module('{0}.{1}'.format(self.__name__,
+                                                             name))
+        elif name in _lazy_imports:
+            value = getattr(importlib.import_module(_lazy_imports[name]),
+                            name)
+        else:
+            raise AttributeError("'module' object has no attribute "
+                                 "'{0}'".format(name))
+        setattr(self, name, value)
+        return value
+
+    def __dir__(self):
+        return sorted(set(self.__dict__) | set(_lazy_imports) |
+                      set(_lazy_submodules))
 
-import logging
 
 logger = logging.getLogger('specgrid')
 logger.setLevel(logging.INFO)
 console_handler = logging.StreamHandler()
 console_formatter = logging.Formatter('%(name)s - %(levelname)s - %(message)s')
 console_handler.setFormatter(console_formatter)
-logger.addHandler(console_handler)
\ No newline at end of file
+logger.addHandler(console_handler)
+
+# For egg_info test builds to pass, put package imports here.
+if not _ASTROPY_SETUP_:
+    _module = _LazyModule(__name__, __doc__)
+    _module.__dict__.update(globals())
+    # keep the original module alive as Python 2 clears the globals of
+    # garbage collected modules, which __getattr__ still uses
+    _module._original_module = sys.modules[__name__]
+    sys.modules[__name__] = _module
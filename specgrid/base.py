@@ -1,14 +1,7 @@
 #specgrid class
-from scipy import interpolate
 import numpy as np
-try:
-    from pyspec import oned
-    pyspec_available = True
-except ImportError:
-    pyspec_available = False
-
-import pandas as pd
 import os
+from collections import OrderedDict
 try:
     import h5py
 except ImportError:
@@ -17,96 +10,243 @@ else:
     h5py_available = True
 from astropy import units as u
 
-from astropy import modeling
+# scipy and astropy.constants are imported where they are needed so that
+# opening a grid does not pay for them
 
-from fix_spectrum1d import Spectrum1D
+from spectrum_record import SpectrumRecord
+from interpolators import (MultilinearInterpolator, SimplexInterpolator,
+                           PCAInterpolator, Triangulation,
+                           interpolate_with_jacobian)
+from cache import (LazyFluxes, LRUCache, PCAFluxes, memmap_hdf5_dataset,
+                   memmap_sidecar)
 
 
-class SpectralGrid(object):
+# version of the grid file layout written by `GridIndex.write` - version 1
+# files store the index as a pandas (PyTables) table
+GRID_FORMAT_VERSION = 2
+
+
+class GridIndex(object):
     """
-    A SpectralGrid interpolation class. Can serve as a model maybe
+    Parameter index of a spectral grid. Checks whether parameters are inside
+    the grid from the index alone, without loading any fluxes.
 
     Parameters
     ----------
 
-    grid_hdf5_fname: filename for HDF5 File
+    points: ~numpy.ndarray
+        parameters of each spectrum in the grid with shape
+        (n_points, n_params)
+
+    param_names: list of str
+        names of the parameters (the columns of points)
     """
 
-    param_names = None
+    def __init__(self, points, param_names):
+        self.points = np.asarray(points, dtype=float)
+        self.param_names = list(param_names)
+        self.bounds = np.vstack((self.points.min(0),
+                                 self.points.max(0))).T
+
+        # on complete rectilinear grids the bounds are the convex hull
+        self.regular_grid = MultilinearInterpolator.is_regular_grid(
+            self.points)
+        self._hull_equations = None
+        self._index = None
+
+    @classmethod
+    def from_dataframe(cls, index):
+        grid_index = cls(index.values, index.columns.tolist())
+        grid_index._index = index
+        return grid_index
+
+    @classmethod
+    def from_hdf5(cls, grid_hdf5_fname):
+        with h5py.File(grid_hdf5_fname, 'r') as h5file:
+            return cls.read(h5file)
 
-    def __init__(self, grid_hdf5_fname,
-                 interpolator=interpolate.LinearNDInterpolator):
+    @classmethod
+    def read(cls, h5file):
+        """
+        Read the index from an open HDF5 grid file: a structured ``index``
+        dataset with a field for each parameter or - in version 1 files - a
+        pandas table (read with `~pandas.read_hdf`)
+        """
+        format_version = h5file.attrs.get('grid_format_version', 1)
+        if format_version > GRID_FORMAT_VERSION:
+            raise ValueError('{0} has grid format version {1} - this version '
+                             'of specgrid reads up to version {2}'.format(
+                h5file.filename, format_version, GRID_FORMAT_VERSION))
+
+        if isinstance(h5file['index'], h5py.Dataset):
+            index = h5file['index'][()]
+            param_names = list(index.dtype.names)
+            return cls(np.column_stack([index[name] for name in param_names]),
+                       param_names)
+
+        import pandas as pd
+        return cls.from_dataframe(pd.read_hdf(h5file.filename, 'index'))
+
+    def write(self, h5file):
+        """
+        Write the index to an open HDF5 file as a structured ``index``
+        dataset and mark the file with the grid format version
+        """
+        index = np.empty(len(self.points), dtype=[
+            (str(name), float) for name in self.param_names])
+        for i, name in enumerate(self.param_names):
+            index[name] = self.points[:, i]
+        h5file['index'] = index
+        h5file.attrs['grid_format_version'] = GRID_FORMAT_VERSION
+
+    @property
+    def index(self):
+        """
+        The index as `~pandas.DataFrame`
+        """
+        if self._index is None:
+            import pandas as pd
+            self._index = pd.DataFrame(self.points, columns=self.param_names)
+        return self._index
 
-        super(SpectralGrid, self).__init__()
+    def contains_many(self, parameter_matrix):
+        """
+        Check which parameter sets (with shape (N, n_params)) are within the
+        bounds of each parameter and - for irregular grids - inside the convex
+        hull of the grid points
+
+        Returns
+        -------
+            : ~numpy.ndarray
+            boolean array with shape (N,)
+        """
+        inside = np.all((parameter_matrix >= self.bounds[:, 0]) &
+                        (parameter_matrix <= self.bounds[:, 1]), axis=1)
 
-        if not os.path.exists(grid_hdf5_fname):
-            raise IOError('{0} does not exists'.format(grid_hdf5_fname))
+        if not self.regular_grid and inside.any():
+            normals, offsets, varying = self._convex_hull()
+            if normals is not None:
+                scaled = self._scale_to_bounds(parameter_matrix[inside])
+                inside[inside] = np.all(
+                    np.dot(scaled[:, varying], normals.T) + offsets <= 1e-10,
+                    axis=1)
 
-        self._load_index(grid_hdf5_fname)
-        self._load_fluxes(grid_hdf5_fname)
+        return inside
 
+    def _scale_to_bounds(self, parameter_matrix):
+        width = self.bounds[:, 1] - self.bounds[:, 0]
+        return (parameter_matrix - self.bounds[:, 0]) / np.where(width > 0,
+                                                                 width, 1.)
 
-        self.interpolate_grid = interpolator(self.index.values, self.fluxes)
-        self.interpolator = interpolator
+    def _convex_hull(self):
+        """
+        Facet equations of the convex hull of the grid points in coordinates
+        scaled to the bounds, restricted to the parameters that vary
+
+        Returns
+        -------
+        normals: ~numpy.ndarray or None
+            outward facet normals, None if the bounds already are the hull
+        offsets: ~numpy.ndarray
+        varying: ~numpy.ndarray
+            boolean array selecting the parameters that vary
+        """
+        if self._hull_equations is None:
+            varying = self.bounds[:, 1] > self.bounds[:, 0]
+            if varying.sum() > 1:
+                from scipy import spatial
+                points = self._scale_to_bounds(self.points)[:, varying]
+                equations = spatial.ConvexHull(points).equations
+                self._hull_equations = (equations[:, :-1], equations[:, -1],
+                                        varying)
+            else:
+                self._hull_equations = (None, None, varying)
+        return self._hull_equations
+
+
+class BaseSpectralGrid(object):
+    """
+    Parameter handling shared by `SpectralGrid` and
+    `~specgrid.GridCollection`: setting and checking the parameters,
+    ``contains`` and ``evaluate``. Subclasses provide ``param_names``,
+    ``wavelength``, ``flux_unit``, ``dtype``, ``contains_many`` and
+    ``_interpolate_flux``.
+    """
+
+    param_names = None
 
     def __call__(self):
-        return Spectrum1D.from_array(self.wavelength, self._interpolate_flux())
+        return self._evaluate_record().to_spectrum1d()
 
-    def _interpolate_flux(self):
-        parameter_values = [getattr(self, item) for item in self.param_names]
-        return self.interpolate_grid(parameter_values)[0] * self.flux_unit
+    def _evaluate_record(self, *args, **kwargs):
+        """
+        Set the given parameters (like `evaluate`) and interpolate the
+        spectrum as `~specgrid.spectrum_record.SpectrumRecord` for the plugin
+        pipeline
+        """
+        self._set_parameters(*args, **kwargs)
+        return SpectrumRecord(self.wavelength.value, self._interpolate_flux(),
+                              self.wavelength.unit, self.flux_unit)
 
-    def _load_index(self, grid_hdf5_fname):
+    def evaluate(self, *args, **kwargs):
         """
-        Loading the index from the hdf5 file
+        Interpolating on the grid to the necessary param_names
 
-        Parameters
-        ----------
+        Examples
+        --------
 
-        grid_hdf5_fname: ~str
-            path to HDF5 file
+        This can either be called with arguments ``specgrid.evaluate(5780, 4.4, -1)`` or
+        using keyword way of calling (then not all param_names have to be given)
+        ``specgrid.evaluate(logg=4.4)``
         """
 
-        self.index = pd.read_hdf(grid_hdf5_fname, 'index')
-
-        self.param_names = self.index.columns.tolist()
+        self._set_parameters(*args, **kwargs)
 
-        for parameter_name in self.param_names:
-            setattr(self, parameter_name, self.index[parameter_name].iloc[0])
+        return self.__call__()
 
-    def _load_fluxes(self, grid_hdf5_fname):
+    def contains(self, *args, **kwargs):
         """
-        Loading the fluxes from the HDF5 file
+        Check if parameters are inside the grid without interpolating. Takes
+        the same arguments as `evaluate` (parameters not given keep their
+        current value) but does not set the parameters.
 
-        Parameters
-        ----------
+        Returns
+        -------
+            : ~bool
 
-        grid_hdf5_fname: ~str
-            path to HDF5 file
+        Examples
+        --------
 
+        ``specgrid.contains(5780, 4.4, -1)`` or ``specgrid.contains(logg=6.)``
         """
 
-        with h5py.File(grid_hdf5_fname, 'r') as h5file:
-            wavelength_unit = u.Unit(h5file['fluxes'].attrs['wavelength.unit'])
+        parameters = self._parse_parameters(*args, **kwargs)
+        parameter_values = [parameters.get(item, getattr(self, item))
+                            for item in self.param_names]
+        return bool(self.contains_many([parameter_values])[0])
 
-            if h5file['fluxes'].attrs['wavelength'] == 'wavelength':
-                self.wavelength = h5file['wavelength'] * wavelength_unit
-            else:
-                self.wavelength = h5file['fluxes'].attrs['wavelength'] * \
-                                  wavelength_unit
-            self.flux_unit = u.Unit(h5file['fluxes'].attrs['flux.unit'])
-            self.fluxes = np.array(h5file['fluxes'])
+    def _off_grid_flux(self, n_spectra):
+        return np.full((n_spectra, len(self.wavelength)), np.nan,
+                       dtype=self.dtype)
 
-    def evaluate(self, *args, **kwargs):
+    def _set_parameters(self, *args, **kwargs):
+        """
+        Set the grid parameters either from arguments (one for each parameter)
+        or from keyword arguments
         """
-        Interpolating on the grid to the necessary param_names
 
-        Examples
-        --------
+        for key, value in self._parse_parameters(*args, **kwargs).items():
+            setattr(self, key, value)
 
-        This can either be called with arguments ``specgrid.evaluate(5780, 4.4, -1)`` or
-        using keyword way of calling (then not all param_names have to be given)
-        ``specgrid.evaluate(logg=4.4)``
+    def _parse_parameters(self, *args, **kwargs):
+        """
+        Check parameters given either as arguments (one for each parameter)
+        or as keyword arguments
+
+        Returns
+        -------
+            : ~collections.OrderedDict
+            parameter values by name
         """
 
         if len(args) > 0:
@@ -120,15 +260,515 @@ class SpectralGrid(object):
                         len(self.param_names),
                         ', '.join(self.param_names),
                         len(args)))
-            for param_name, value in zip(self.param_names, args):
-                setattr(self, param_name, value)
+            return OrderedDict(zip(self.param_names, args))
 
         for key in kwargs:
             if key not in self.param_names:
                 raise ValueError('{0} not a parameter of the current '
                                  'spectral grid (param_names are {1})'.format(
                     key, ','.join(self.param_names)))
-            setattr(self, key, kwargs[key])
+        return OrderedDict(kwargs)
+
+    def _check_parameter_matrix(self, parameter_matrix, method_name):
+        parameter_matrix = np.atleast_2d(np.asarray(parameter_matrix,
+                                                    dtype=float))
+        if parameter_matrix.ndim != 2 or \
+                parameter_matrix.shape[1] != len(self.param_names):
+            raise ValueError(
+                '{0}() takes an array with shape (N, {1}) with a '
+                'column for each parameter ({2}) - {3} given'.format(
+                    method_name, len(self.param_names),
+                    ', '.join(self.param_names), parameter_matrix.shape))
+        return parameter_matrix
+
+
+class SpectralGrid(BaseSpectralGrid):
+    """
+    A SpectralGrid interpolation class. Can serve as a model maybe
 
-        return self.__call__()
+    Parameters
+    ----------
+
+    grid_hdf5_fname: filename for HDF5 File. This can also be a PCA
+        compressed grid written by `~specgrid.io.pca.make_pca_hdf5`, which is
+        interpolated in coefficient space
+
+    interpolator: class or None
+        interpolator class called with ``(points, fluxes)``. If None, a
+        `~specgrid.interpolators.MultilinearInterpolator` is used for complete
+        rectilinear grids and `~scipy.interpolate.LinearNDInterpolator`
+        otherwise (`~specgrid.interpolators.SimplexInterpolator` for lazy,
+        memory-mapped or single precision grids) [default None]
+
+    lazy: bool
+        keep the HDF5 file open and only read the spectra needed by each
+        interpolation instead of loading all fluxes into memory
+        [default False]
+
+    flux_cache_bytes: int
+        byte budget of the row cache used for lazy grids [default 256 MB]
+
+    triangulation_cache: bool or str
+        store the Delaunay triangulation of irregular grids in a sidecar HDF5
+        file (``<grid_hdf5_fname>.triangulation.h5`` if True, or the given
+        path) and memory-map it on later loads instead of triangulating again.
+        Implies `~specgrid.interpolators.SimplexInterpolator` [default False]
+
+    wavelength_range: tuple of float or ~astropy.units.Quantity or None
+        (wmin, wmax) - only load the part of the grid covering this range.
+        Floats are in the wavelength unit of the grid. None loads the full
+        wavelength range [default None]
+
+    margin: ~astropy.units.Quantity
+        extra coverage on both sides of ``wavelength_range`` to allow for
+        Doppler shifts and convolution kernels, either as a wavelength or as a
+        velocity [default 0 Angstrom]
+
+    dtype: ~numpy.dtype or None
+        dtype the fluxes are stored and interpolated in, e.g. ``np.float32``
+        to halve memory use and bandwidth. None keeps the dtype of the file
+        [default None]
+
+    spectrum_cache_bytes: int or None
+        byte budget of an LRU cache of interpolated spectra keyed on the grid
+        parameters, None disables the cache [default None]
+
+    spectrum_cache_tolerance: float or list of float
+        parameters are quantized to multiples of this tolerance (one value or
+        one per parameter) before looking them up in the spectrum cache, so
+        parameters closer than the tolerance may share a cached spectrum. 0
+        only reuses spectra for identical parameters [default 0]
+
+    memmap: bool
+        memory-map the fluxes (and the triangulation of irregular grids)
+        read-only so that all processes on a node share one copy. The flux
+        dataset is mapped directly from the HDF5 file if it is stored
+        contiguously and uncompressed in the requested dtype, otherwise from
+        an ``.npy`` copy written next to it (or to the user cache directory
+        if the grid directory is read-only). Pickled memory-mapped grids (e.g.
+        sent to parallel workers) carry no fluxes and map them again when
+        unpickled [default False]
+    """
+
+    param_names = None
+
+    def __init__(self, grid_hdf5_fname, interpolator=None, lazy=False,
+                 flux_cache_bytes=2**28, triangulation_cache=False,
+                 wavelength_range=None, margin=0 * u.angstrom, dtype=None,
+                 spectrum_cache_bytes=None, spectrum_cache_tolerance=0.,
+                 memmap=False):
+
+        super(SpectralGrid, self).__init__()
+
+        if not os.path.exists(grid_hdf5_fname):
+            raise IOError('{0} does not exists'.format(grid_hdf5_fname))
+
+        if lazy and memmap:
+            raise ValueError('A grid can either be lazy or memory-mapped '
+                             'not both')
+
+        self.grid_hdf5_fname = grid_hdf5_fname
+        self.lazy = lazy
+        self.memmap = memmap
+        with h5py.File(grid_hdf5_fname, 'r') as h5file:
+            self._load_index(h5file)
+            self._load_fluxes(h5file, flux_cache_bytes=flux_cache_bytes,
+                              wavelength_range=wavelength_range,
+                              margin=margin, dtype=dtype)
+
+        if interpolator is None:
+            if self.regular_grid:
+                interpolator = MultilinearInterpolator
+            elif (lazy or memmap or triangulation_cache or
+                  self.dtype != np.float64):
+                # LinearNDInterpolator keeps its own float64 copy of the
+                # fluxes
+                interpolator = SimplexInterpolator
+            else:
+                from scipy import interpolate
+                interpolator = interpolate.LinearNDInterpolator
+
+        if memmap and not triangulation_cache:
+            triangulation_cache = True
+        if triangulation_cache is True:
+            triangulation_cache = '{0}.triangulation.h5'.format(
+                grid_hdf5_fname)
+        self.triangulation_cache = triangulation_cache or None
+
+        self.interpolator = interpolator
+        self._build_interpolator()
+
+        if spectrum_cache_bytes is None:
+            self.spectrum_cache = None
+        else:
+            self.spectrum_cache = LRUCache(spectrum_cache_bytes)
+        self.spectrum_cache_tolerance = np.broadcast_to(
+            np.asarray(spectrum_cache_tolerance, dtype=float),
+            (len(self.param_names),))
+
+    def _build_interpolator(self):
+        interpolator = self.interpolator
+        if interpolator is SimplexInterpolator and \
+                self.triangulation_cache is not None:
+            triangulation = Triangulation.cached(self.triangulation_cache,
+                                                 self.grid_index.points)
+            interpolator = lambda points, values: SimplexInterpolator(
+                points, values, triangulation=triangulation)
+
+        if isinstance(self.fluxes, PCAFluxes):
+            self.interpolate_grid = PCAInterpolator(
+                self.grid_index.points, self.fluxes, interpolator=interpolator)
+        else:
+            self.interpolate_grid = interpolator(self.grid_index.points,
+                                                 self.fluxes)
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        if self.memmap:
+            # fluxes and interpolator are mapped again in __setstate__
+            for key in ('fluxes', 'interpolate_grid'):
+                state.pop(key, None)
+            state['_flux_dtype'] = self.fluxes.dtype
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        if self.memmap:
+            self.fluxes = self._memmap_fluxes(self.grid_hdf5_fname,
+                                              self.__dict__.pop('_flux_dtype'))
+            self._build_interpolator()
+
+    @property
+    def dtype(self):
+        return self.fluxes.dtype
+
+    @property
+    def regular_grid(self):
+        return self.grid_index.regular_grid
+
+    def _interpolate_flux(self):
+        parameter_values = [getattr(self, item) for item in self.param_names]
+        if not self.contains_many([parameter_values])[0]:
+            return self._off_grid_flux(1)[0]
+
+        if self.spectrum_cache is None:
+            return self.interpolate_grid(parameter_values)[0].astype(
+                self.dtype, copy=False)
+
+        cache_key = self._spectrum_cache_key(parameter_values)
+        flux = self.spectrum_cache.get(cache_key)
+        if flux is None:
+            flux = self.interpolate_grid(parameter_values)[0].astype(
+                self.dtype, copy=False)
+            self.spectrum_cache.put(cache_key, flux)
+
+        # callers may modify the flux in place
+        return flux.copy()
+
+    def _spectrum_cache_key(self, parameter_values):
+        """
+        Key for the spectrum cache: the parameter values, quantized to
+        multiples of ``spectrum_cache_tolerance`` where it is non-zero
+        """
+        parameter_values = np.asarray(parameter_values, dtype=float)
+        tolerance = self.spectrum_cache_tolerance
+        quantized = tolerance > 0
+        parameter_values[quantized] = np.round(
+            parameter_values[quantized] / tolerance[quantized])
+        return tuple(parameter_values.tolist())
+
+    def _load_index(self, h5file):
+        """
+        Loading the index from the hdf5 file
+
+        Parameters
+        ----------
+
+        h5file: ~h5py.File
+            open HDF5 grid file
+        """
+
+        self.grid_index = GridIndex.read(h5file)
+        self.param_names = self.grid_index.param_names
+        self.bounds = self.grid_index.bounds
+
+        for parameter_name, value in zip(self.param_names,
+                                         self.grid_index.points[0]):
+            setattr(self, parameter_name, value)
+
+    @property
+    def index(self):
+        """
+        Parameters of the grid spectra as `~pandas.DataFrame`
+        """
+        return self.grid_index.index
+
+    def _load_fluxes(self, h5file, flux_cache_bytes=2**28,
+                     wavelength_range=None, margin=0 * u.angstrom,
+                     dtype=None):
+        """
+        Loading the fluxes from the HDF5 file. For lazy grids the fluxes are
+        a `~specgrid.cache.LazyFluxes` view that reads rows on demand, for PCA
+        compressed grids a `~specgrid.cache.PCAFluxes` view that reconstructs
+        them from their coefficients. ``log_wavelength_step`` is the step in
+        ln(wavelength) of grids stored on a uniform log(wavelength) axis and
+        None for other grids.
+
+        Parameters
+        ----------
+
+        h5file: ~h5py.File
+            open HDF5 grid file
+
+        flux_cache_bytes: ~int
+            byte budget of the row cache for lazy grids
+
+        wavelength_range: tuple or None
+            (wmin, wmax) to restrict the loaded wavelengths to
+
+        margin: ~astropy.units.Quantity
+            wavelength or velocity margin around ``wavelength_range``
+
+        dtype: ~numpy.dtype or None
+            dtype to convert the fluxes to, None keeps the dtype of the file
+
+        """
+
+        pca_compressed = 'fluxes' not in h5file and 'pca' in h5file
+        if pca_compressed and (self.lazy or self.memmap):
+            raise ValueError('PCA compressed grids are always loaded into '
+                             'memory - lazy and memmap are not supported')
+
+        flux_attrs = h5file['pca' if pca_compressed else 'fluxes'].attrs
+        wavelength_unit = u.Unit(flux_attrs['wavelength.unit'])
+
+        # the attribute either holds the wavelengths or the name of the
+        # wavelength dataset
+        wavelength = flux_attrs['wavelength']
+        if np.ndim(wavelength) == 0:
+            wavelength = np.array(h5file['wavelength'])
+
+        self.wavelength_slice = self._wavelength_range_slice(
+            wavelength * wavelength_unit, wavelength_range, margin)
+        self.wavelength = (wavelength[self.wavelength_slice] *
+                           wavelength_unit)
+        self.flux_unit = u.Unit(flux_attrs['flux.unit'])
+
+        # grids resampled by `~specgrid.io.base.make_hdf5` or
+        # `~specgrid.io.base.convert_to_log_wavelength` are uniform in
+        # ln(wavelength), which the plugins use without resampling
+        log_wavelength_step = flux_attrs.get('log_wavelength_step')
+        self.log_wavelength_step = (None if log_wavelength_step is None
+                                    else float(log_wavelength_step))
+
+        if pca_compressed:
+            pca_group = h5file['pca']
+            if dtype is None:
+                dtype = pca_group['components'].dtype
+            self.fluxes = PCAFluxes(
+                pca_group['mean'][self.wavelength_slice].astype(dtype),
+                pca_group['components'][:, self.wavelength_slice].astype(
+                    dtype),
+                pca_group['coefficients'][()].astype(dtype))
+        elif not (self.lazy or self.memmap):
+            flux_dataset = h5file['fluxes']
+            if dtype is None:
+                dtype = flux_dataset.dtype
+            self.fluxes = np.empty(
+                (flux_dataset.shape[0], len(self.wavelength)),
+                dtype=dtype)
+            # converts while reading without a full size temporary copy
+            flux_dataset.read_direct(
+                self.fluxes, source_sel=np.s_[:, self.wavelength_slice])
+
+        if self.lazy:
+            self.fluxes = LazyFluxes(self.grid_hdf5_fname, 'fluxes',
+                                     cache_bytes=flux_cache_bytes,
+                                     columns=self.wavelength_slice,
+                                     dtype=dtype)
+        elif self.memmap:
+            self.fluxes = self._memmap_fluxes(self.grid_hdf5_fname, dtype)
+
+    def _memmap_fluxes(self, grid_hdf5_fname, dtype=None):
+        """
+        Memory-map the fluxes from the HDF5 file or - if the dataset can not
+        be mapped in the requested dtype - from an ``.npy`` copy next to it
+
+        Parameters
+        ----------
+
+        grid_hdf5_fname: ~str
+            path to HDF5 file
+
+        dtype: ~numpy.dtype or None
+            dtype of the fluxes, None keeps the dtype of the file
+        """
+        with h5py.File(grid_hdf5_fname, 'r') as h5file:
+            flux_dataset = h5file['fluxes']
+            fluxes = None
+            if dtype is None or np.dtype(dtype) == flux_dataset.dtype:
+                fluxes = memmap_hdf5_dataset(flux_dataset, grid_hdf5_fname)
+
+        if fluxes is None:
+            fluxes = memmap_sidecar(grid_hdf5_fname, 'fluxes', dtype)
+
+        return fluxes[:, self.wavelength_slice]
+
+    @staticmethod
+    def _wavelength_range_slice(wavelength, wavelength_range,
+                                margin=0 * u.angstrom):
+        """
+        Slice of the (sorted) grid wavelengths that covers wavelength_range
+        widened by margin, including one pixel beyond each end
+
+        Parameters
+        ----------
+
+        wavelength: ~astropy.units.Quantity
+            grid wavelengths
+
+        wavelength_range: tuple or None
+            (wmin, wmax), None selects all wavelengths
+
+        margin: ~astropy.units.Quantity
+            wavelength or velocity margin
+
+        Returns
+        -------
+            : slice
+        """
+        if wavelength_range is None:
+            return slice(None)
+
+        wmin, wmax = u.Quantity(wavelength_range, wavelength.unit).value
+        margin = u.Quantity(margin)
+        if margin.unit.physical_type == 'speed':
+            from astropy import constants as const
+            doppler_factor = (np.abs(margin) / const.c).to(1).value
+            wmin, wmax = (wmin * (1 - doppler_factor),
+                          wmax * (1 + doppler_factor))
+        else:
+            margin = np.abs(margin.to(wavelength.unit).value)
+            wmin, wmax = wmin - margin, wmax + margin
+
+        start = max(np.searchsorted(wavelength.value, wmin, side='right') - 1,
+                    0)
+        stop = min(np.searchsorted(wavelength.value, wmax, side='left') + 1,
+                   len(wavelength))
+        if stop - start < 2:
+            raise ValueError('wavelength_range {0} is not covered by the grid '
+                             '({1} - {2})'.format(wavelength_range,
+                                                  wavelength.min(),
+                                                  wavelength.max()))
+
+        return slice(start, stop)
+
+    def close(self):
+        """
+        Close the HDF5 file held open by lazy grids
+        """
+        if self.lazy:
+            self.fluxes.close()
+
+    def evaluate_with_jacobian(self, *args, **kwargs):
+        """
+        Interpolating on the grid like `evaluate` and returning the derivative
+        of the flux with respect to each parameter as well. Linear
+        interpolation is piecewise linear, so the derivatives follow exactly
+        from the weights of the enclosing simplex or cell and are constant
+        within it.
+
+        Returns
+        -------
+        spectrum: ~Spectrum1D
+            interpolated spectrum
+        jacobian: ~astropy.units.Quantity
+            d(flux)/d(parameter) with shape (n_params, n_wavelength), the rows
+            ordered as in ``param_names``. All NaN outside the grid.
+
+        Examples
+        --------
+
+        ``spectrum, jacobian = specgrid.evaluate_with_jacobian(5780, 4.4, -1)``
+        """
+
+        # specutils (and astropy.modeling) are only imported when a spectrum
+        # is built, not when a grid is opened
+        from fix_spectrum1d import Spectrum1D
+
+        self._set_parameters(*args, **kwargs)
+
+        parameter_values = [getattr(self, item) for item in self.param_names]
+        if self.contains_many([parameter_values])[0]:
+            flux, jacobian = interpolate_with_jacobian(self.interpolate_grid,
+                                                       parameter_values)
+        else:
+            flux = self._off_grid_flux(1)
+            jacobian = np.full((1, len(self.param_names)) + flux.shape[1:],
+                               np.nan, dtype=self.dtype)
+
+        flux = flux[0].astype(self.dtype, copy=False) * self.flux_unit
+        jacobian = jacobian[0].astype(self.dtype, copy=False) * self.flux_unit
+        return Spectrum1D.from_array(self.wavelength, flux), jacobian
+
+    def contains_many(self, parameter_matrix):
+        """
+        Check which parameter sets are inside the grid: within the bounds of
+        each parameter and - for irregular grids - inside the convex hull of
+        the grid points. Only the grid index is used, no fluxes are touched.
+
+        Parameters
+        ----------
+
+        parameter_matrix: ~numpy.ndarray
+            parameter sets with shape (N, n_params), the columns ordered as
+            in ``param_names``
+
+        Returns
+        -------
+            : ~numpy.ndarray
+            boolean array with shape (N,)
+        """
+
+        parameter_matrix = self._check_parameter_matrix(parameter_matrix,
+                                                        'contains_many')
+        return self.grid_index.contains_many(parameter_matrix)
+
+    def evaluate_many(self, parameter_matrix):
+        """
+        Interpolating on the grid for many parameter sets at once
+
+        In contrast to `evaluate` this does not set the parameters of the grid
+        and returns a plain array instead of `Spectrum1D` objects.
+
+        Parameters
+        ----------
+
+        parameter_matrix: ~numpy.ndarray
+            parameter sets with shape (N, n_params), the columns ordered as
+            in ``param_names``
+
+        Returns
+        -------
+            : ~numpy.ndarray
+            interpolated fluxes in ``flux_unit`` with shape (N, n_wavelength).
+            Rows for parameter sets outside the grid are NaN.
+
+        Examples
+        --------
+
+        ``specgrid.evaluate_many([[5780, 4.4, 0.0], [6000, 4.0, 0.2]])``
+        """
+
+        parameter_matrix = self._check_parameter_matrix(parameter_matrix,
+                                                        'evaluate_many')
+
+        inside = self.contains_many(parameter_matrix)
+        if inside.all():
+            return self.interpolate_grid(parameter_matrix).astype(
+                self.dtype, copy=False)
 
+        fluxes = self._off_grid_flux(len(parameter_matrix))
+        if inside.any():
+            fluxes[inside] = self.interpolate_grid(parameter_matrix[inside])
+        return fluxes
@@ -0,0 +1,421 @@
+import hashlib
+import os
+from collections import OrderedDict
+from logging import getLogger
+
+import numpy as np
+
+try:
+    import h5py
+except ImportError:
+    h5py_available = False
+else:
+    h5py_available = True
+
+logger = getLogger(__name__)
+
+
+def memmap_hdf5_dataset(dataset, h5_fname):
+    """
+    Memory-map a contiguous, uncompressed HDF5 dataset read-only. All
+    processes mapping the same file share its pages.
+
+    Parameters
+    ----------
+
+    dataset: ~h5py.Dataset
+
+    h5_fname: ~str
+        path of the HDF5 file containing dataset
+
+    Returns
+    -------
+        : ~numpy.memmap or None
+        None if the dataset is chunked, compressed or not yet allocated
+    """
+    offset = dataset.id.get_offset()
+    if dataset.chunks is None and dataset.compression is None and \
+            offset is not None:
+        return np.memmap(h5_fname, mode='r', dtype=dataset.dtype,
+                         shape=dataset.shape, offset=offset)
+    else:
+        return None
+
+
+def user_cache_dir():
+    """
+    Directory for copies of grid data that can not be stored next to the
+    grid (``specgrid`` in the astropy cache directory)
+    """
+    from astropy.config.paths import get_cache_dir
+    return os.path.join(get_cache_dir(), 'specgrid')
+
+
+def memmap_sidecar(h5_fname, dataset_name='fluxes', dtype=None,
+                   block_rows=256):
+    """
+    Memory-map a copy of an HDF5 dataset stored as ``.npy`` file next to the
+    HDF5 file (``<h5_fname>.<dataset_name>.<dtype>.npy``). The copy is
+    written block by block if it does not exist or is older than the HDF5
+    file. If it can not be written there (e.g. in a read-only grid store),
+    it is written to `user_cache_dir` instead, and if that fails as well the
+    dataset is loaded into memory with a warning.
+
+    Parameters
+    ----------
+
+    h5_fname: ~str
+        path to HDF5 file
+
+    dataset_name: ~str
+        name of the dataset [default 'fluxes']
+
+    dtype: ~numpy.dtype or None
+        dtype of the copy, None keeps the dtype of the dataset
+        [default None]
+
+    block_rows: ~int
+        number of rows copied at once [default 256]
+
+    Returns
+    -------
+        : ~numpy.memmap or ~numpy.ndarray
+    """
+    with h5py.File(h5_fname, 'r') as h5file:
+        dataset = h5file[dataset_name]
+        dtype = dataset.dtype if dtype is None else np.dtype(dtype)
+        sidecar_fname = '{0}.{1}.{2}.npy'.format(h5_fname, dataset_name,
+                                                 dtype.name)
+        try:
+            _write_sidecar(dataset, sidecar_fname, dtype, block_rows,
+                           os.path.getmtime(h5_fname))
+        except (IOError, OSError) as e:
+            logger.warning('Could not store a copy of {0} next to {1}: '
+                           '{2}'.format(dataset_name, h5_fname, e))
+        else:
+            return np.load(sidecar_fname, mmap_mode='r')
+
+        # named after the full path, so equally named grids do not collide
+        path_hash = hashlib.sha1(
+            os.path.abspath(h5_fname).encode('utf-8')).hexdigest()[:16]
+        try:
+            cache_dir = user_cache_dir()
+            if not os.path.isdir(cache_dir):
+                os.makedirs(cache_dir)
+            sidecar_fname = os.path.join(cache_dir, '{0}.{1}'.format(
+                path_hash, os.path.basename(sidecar_fname)))
+            _write_sidecar(dataset, sidecar_fname, dtype, block_rows,
+                           os.path.getmtime(h5_fname))
+        except (IOError, OSError) as e:
+            logger.warning('Could not store a copy of {0} in the user cache '
+                           'either ({1}) - loading it into memory'.format(
+                dataset_name, e))
+            return dataset[()].astype(dtype, copy=False)
+        else:
+            logger.info('Stored a copy of {0} in {1}'.format(
+                dataset_name, sidecar_fname))
+            return np.load(sidecar_fname, mmap_mode='r')
+
+
+def _write_sidecar(dataset, sidecar_fname, dtype, block_rows, h5_mtime):
+    """
+    Write the ``.npy`` copy of dataset unless an up-to-date one exists
+    """
+    if os.path.exists(sidecar_fname) and \
+            os.path.getmtime(sidecar_fname) >= h5_mtime:
+        return
+
+    # write to a temporary file first so concurrent workers never map a
+    # partially written copy
+    tmp_fname = '{0}.{1}.tmp'.format(sidecar_fname, os.getpid())
+    try:
+        sidecar = np.lib.format.open_memmap(tmp_fname, mode='w+',
+                                            dtype=dtype, shape=dataset.shape)
+        for start in range(0, dataset.shape[0], block_rows):
+            sidecar[start:start + block_rows] = \
+                dataset[start:start + block_rows]
+        sidecar.flush()
+        del sidecar
+        os.rename(tmp_fname, sidecar_fname)
+    except (IOError, OSError):
+        if os.path.exists(tmp_fname):
+            os.remove(tmp_fname)
+        raise
+
+
+class LRUCache(object):
+    """
+    Least-recently-used cache for numpy arrays with a byte budget
+
+    Parameters
+    ----------
+
+    max_bytes: ~int
+        maximum number of bytes held by the cache. Items larger than the
+        budget are never stored.
+    """
+
+    def __init__(self, max_bytes):
+        self.max_bytes = int(max_bytes)
+        self._data = OrderedDict()
+        self.current_bytes = 0
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self):
+        return len(self._data)
+
+    def __contains__(self, key):
+        return key in self._data
+
+    def get(self, key, default=None):
+        """
+        Return the cached value for key (marking it as most recently used) or
+        default if the key is not cached
+        """
+        if key in self._data:
+            value = self._data.pop(key)
+            self._data[key] = value
+            self.hits += 1
+            return value
+        else:
+            self.misses += 1
+            return default
+
+    def put(self, key, value):
+        nbytes = getattr(value, 'nbytes', 0)
+        if key in self._data:
+            self.current_bytes -= getattr(self._data.pop(key), 'nbytes', 0)
+
+        if nbytes > self.max_bytes:
+            return
+
+        while self._data and self.current_bytes + nbytes > self.max_bytes:
+            _, evicted = self._data.popitem(last=False)
+            self.current_bytes -= getattr(evicted, 'nbytes', 0)
+
+        self._data[key] = value
+        self.current_bytes += nbytes
+
+    def clear(self):
+        self._data.clear()
+        self.current_bytes = 0
+        self.hits = 0
+        self.misses = 0
+
+    @property
+    def stats(self):
+        return OrderedDict([('hits', self.hits), ('misses', self.misses),
+                            ('items', len(self._data)),
+                            ('bytes', self.current_bytes),
+                            ('max_bytes', self.max_bytes)])
+
+    def __repr__(self):
+        return 'LRUCache ({0})'.format(
+            ', '.join('{0}={1}'.format(key, value)
+                      for key, value in self.stats.items()))
+
+
+class LazyFluxes(object):
+    """
+    Read-only, array-like view of a flux dataset in an HDF5 file that reads
+    rows on demand through an `LRUCache`.
+
+    Rows are read in blocks of ``chunk_rows`` consecutive rows (by default
+    the chunking of the dataset on disk), so indexing only touches the blocks
+    that contain the requested spectra.
+
+    Parameters
+    ----------
+
+    h5_fname: ~str
+        path to HDF5 file
+
+    dataset_name: ~str
+        name of the flux dataset [default 'fluxes']
+
+    cache_bytes: ~int
+        byte budget of the row cache [default 256 MB]
+
+    chunk_rows: ~int or None
+        number of rows read at once, None uses the chunk shape of the
+        dataset or single rows for contiguous datasets [default None]
+
+    columns: slice
+        only read these columns (e.g. a wavelength range) of each row
+        [default slice(None)]
+
+    dtype: ~numpy.dtype or None
+        dtype the rows are converted to when read, None keeps the dtype of
+        the dataset [default None]
+    """
+
+    def __init__(self, h5_fname, dataset_name='fluxes', cache_bytes=2**28,
+                 chunk_rows=None, columns=slice(None), dtype=None):
+        self.h5_fname = h5_fname
+        self.dataset_name = dataset_name
+        self.columns = columns
+        self.cache = LRUCache(cache_bytes)
+        self._open()
+        self.dtype = self.dataset.dtype if dtype is None else np.dtype(dtype)
+
+        if chunk_rows is None:
+            chunks = self.dataset.chunks
+            chunk_rows = 1 if chunks is None else chunks[0]
+        self.chunk_rows = int(chunk_rows)
+
+    def _open(self):
+        self.h5file = h5py.File(self.h5_fname, 'r')
+        self.dataset = self.h5file[self.dataset_name]
+        n_columns = len(range(*self.columns.indices(self.dataset.shape[1])))
+        self.shape = (self.dataset.shape[0], n_columns)
+
+    @property
+    def ndim(self):
+        return len(self.shape)
+
+    @property
+    def nbytes(self):
+        return int(np.prod(self.shape)) * self.dtype.itemsize
+
+    def __len__(self):
+        return self.shape[0]
+
+    def _read_block(self, block_id):
+        block = self.cache.get(block_id)
+        if block is None:
+            start = block_id * self.chunk_rows
+            block = self.dataset[start:min(start + self.chunk_rows,
+                                           self.shape[0]), self.columns]
+            block = block.astype(self.dtype, copy=False)
+            self.cache.put(block_id, block)
+        return block
+
+    def __getitem__(self, item):
+        if isinstance(item, tuple):
+            rows_selected = self[item[0]]
+            if rows_selected.ndim < self.ndim:
+                return rows_selected[item[1:]]
+            return rows_selected[(slice(None),) + item[1:]]
+
+        if isinstance(item, slice):
+            rows = np.arange(*item.indices(self.shape[0]))
+        else:
+            rows = np.asarray(item)
+            if rows.dtype == bool:
+                rows = np.flatnonzero(rows)
+
+        scalar_row = rows.ndim == 0
+        rows = np.atleast_1d(rows).astype(np.int64)
+        rows[rows < 0] += self.shape[0]
+
+        result = np.empty((len(rows),) + self.shape[1:], dtype=self.dtype)
+        block_ids = rows // self.chunk_rows
+        for block_id in np.unique(block_ids):
+            in_block = block_ids == block_id
+            block = self._read_block(int(block_id))
+            result[in_block] = block[rows[in_block] -
+                                     block_id * self.chunk_rows]
+
+        return result[0] if scalar_row else result
+
+    def __array__(self, dtype=None, copy=None):
+        fluxes = self.dataset[:, self.columns].astype(self.dtype, copy=False)
+        return fluxes if dtype is None else fluxes.astype(dtype)
+
+    def close(self):
+        self.h5file.close()
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        for key in ('h5file', 'dataset'):
+            state.pop(key, None)
+        state['cache'] = LRUCache(self.cache.max_bytes)
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._open()
+
+    def __repr__(self):
+        return '<LazyFluxes {0}:{1} shape={2} {3}>'.format(
+            self.h5_fname, self.dataset_name, self.shape, self.cache)
+
+
+class PCAFluxes(object):
+    """
+    Read-only, array-like view of the fluxes of a PCA compressed grid (see
+    `~specgrid.io.pca.make_pca_hdf5`). Spectra are reconstructed from their
+    coefficients when indexed.
+
+    Parameters
+    ----------
+
+    mean: ~numpy.ndarray
+        mean spectrum with shape (n_wavelength,)
+
+    components: ~numpy.ndarray
+        principal components with shape (n_components, n_wavelength)
+
+    coefficients: ~numpy.ndarray
+        coefficients of each grid point with shape (n_points, n_components)
+    """
+
+    def __init__(self, mean, components, coefficients):
+        self.mean = mean
+        self.components = components
+        self.coefficients = coefficients
+        self.dtype = np.result_type(mean, components)
+        self.shape = (coefficients.shape[0], mean.shape[0])
+
+    @property
+    def ndim(self):
+        return len(self.shape)
+
+    @property
+    def n_components(self):
+        return self.components.shape[0]
+
+    @property
+    def nbytes(self):
+        return self.mean.nbytes + self.components.nbytes + \
+            self.coefficients.nbytes
+
+    def __len__(self):
+        return self.shape[0]
+
+    def reconstruct(self, coefficients):
+        """
+        Spectra for the given coefficients
+
+        Parameters
+        ----------
+
+        coefficients: ~numpy.ndarray
+            coefficients with shape (..., n_components)
+
+        Returns
+        -------
+            : ~numpy.ndarray
+            spectra with shape (..., n_wavelength)
+        """
+        spectra = np.dot(coefficients, self.components)
+        spectra += self.mean
+        return spectra.astype(self.dtype, copy=False)
+
+    def __getitem__(self, item):
+        if isinstance(item, tuple):
+            rows_selected = self[item[0]]
+            if rows_selected.ndim < self.ndim:
+                return rows_selected[item[1:]]
+            return rows_selected[(slice(None),) + item[1:]]
+
+        return self.reconstruct(self.coefficients[item])
+
+    def __array__(self, dtype=None, copy=None):
+        fluxes = self.reconstruct(self.coefficients)
+        return fluxes if dtype is None else fluxes.astype(dtype)
+
+    def __repr__(self):
+        return '<PCAFluxes shape={0} n_components={1}>'.format(
+            self.shape, self.n_components)
@@ -10,6 +10,8 @@ import pytest
 
 import h5py
 import numpy as np
+import pandas as pd
+from scipy import interpolate
 from astropy import units as u
 
 import specgrid
@@ -22,8 +24,39 @@ def data_path(filename):
 
 @pytest.fixture()
 def test_specgrid():
+    # reference data in test_data.h5 was generated with the Delaunay
+    # interpolator
+    return SpectralGrid(data_path('munari_small.h5'),
+                        interpolator=interpolate.LinearNDInterpolator)
+
+@pytest.fixture()
+def test_regular_specgrid():
     return SpectralGrid(data_path('munari_small.h5'))
 
+@pytest.fixture(scope='session')
+def irregular_grid_fname(tmpdir_factory):
+    """
+    munari_small.h5 without its last (corner) grid point, an irregular grid
+    whose convex hull is smaller than its bounds
+    """
+    fname = str(tmpdir_factory.mktemp('irregular_grid').join(
+        'munari_irregular.h5'))
+    index = pd.read_hdf(data_path('munari_small.h5'), 'index')
+    with h5py.File(data_path('munari_small.h5'), 'r') as fh:
+        fluxes = fh['fluxes'][:-1]
+        flux_attrs = dict(fh['fluxes'].attrs)
+
+    index[:-1].to_hdf(fname, 'index', mode='w')
+    with h5py.File(fname, 'a') as fh:
+        fh['fluxes'] = fluxes
+        for key, value in flux_attrs.items():
+            fh['fluxes'].attrs[key] = value
+    return fname
+
+@pytest.fixture()
+def test_irregular_specgrid(irregular_grid_fname):
+    return SpectralGrid(irregular_grid_fname)
+
 @pytest.fixture(scope='session')
 def h5_test_data():
     return h5py.File(data_path('test_data.h5'), mode='r')
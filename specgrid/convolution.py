@@ -0,0 +1,224 @@
+from collections import namedtuple
+
+import numpy as np
+import scipy.ndimage as nd
+from scipy import sparse
+
+from cache import LRUCache
+
+# rough cost of one FFT operation relative to one multiply-add of the direct
+# convolution (numpy's FFT versus scipy.ndimage.convolve1d)
+FFT_COST_FACTOR = 2.5
+
+# number of block layouts (one for each spectrum and kernel length) kept
+MAX_LAYOUTS = 32
+
+FFTLayout = namedtuple('FFTLayout', ['fft_length', 'block_length',
+                                     'n_blocks', 'buffer'])
+
+
+def next_fast_length(n):
+    """
+    Smallest product of powers of 2, 3 and 5 that is at least n - lengths
+    the FFT handles fastest
+    """
+    best = 2 ** int(np.ceil(np.log2(max(n, 1))))
+    power5 = 1
+    while power5 < best:
+        power35 = power5
+        while power35 < best:
+            length = power35
+            while length < n:
+                length *= 2
+            best = min(best, length)
+            power35 *= 3
+        power5 *= 5
+    return best
+
+
+def gaussian_kernel(sigma, truncate=4.0):
+    """
+    Normalized gaussian kernel with standard deviation sigma (in pixels),
+    truncated at ``truncate`` sigma like `scipy.ndimage.gaussian_filter1d`
+    """
+    radius = int(truncate * float(sigma) + 0.5)
+    x = np.arange(-radius, radius + 1)
+    kernel = np.exp(-0.5 * (x / float(sigma)) ** 2)
+    return kernel / kernel.sum()
+
+
+def variable_gaussian_matrix(sigma, truncate=4.0):
+    """
+    Banded sparse matrix that convolves a spectrum with a normalized
+    gaussian whose width changes from pixel to pixel, reflecting the
+    spectrum at the edges like `Convolver`. Row i holds the gaussian with
+    standard deviation sigma[i] centred on pixel i, truncated at
+    ``truncate`` sigma like `gaussian_kernel`, so applying the matrix costs
+    O(N K) for N pixels and kernels of up to K pixels.
+
+    Parameters
+    ----------
+
+    sigma: ~numpy.ndarray
+        standard deviation of the gaussian (in pixels) for each pixel
+
+    truncate: float
+        truncate the gaussians at this many standard deviations
+        [default 4.0]
+
+    Returns
+    -------
+        : ~scipy.sparse.csr_matrix
+        matrix with shape (len(sigma), len(sigma))
+    """
+    sigma = np.asarray(sigma, dtype=np.float64)
+    n = len(sigma)
+    radius = (truncate * sigma + 0.5).astype(int)
+    offsets = np.arange(-radius.max(), radius.max() + 1)
+
+    in_kernel = np.abs(offsets) <= radius[:, np.newaxis]
+    kernels = np.exp(-0.5 * (offsets / sigma[:, np.newaxis]) ** 2) * in_kernel
+    kernels /= kernels.sum(1)[:, np.newaxis]
+
+    columns = np.arange(n)[:, np.newaxis] + offsets
+    columns = np.where(columns < 0, -columns - 1, columns)
+    columns = np.where(columns >= n, 2 * n - columns - 1, columns)
+    columns = np.clip(columns, 0, n - 1)
+
+    rows = np.repeat(np.arange(n), in_kernel.sum(1))
+    return sparse.csr_matrix((kernels[in_kernel], (rows, columns[in_kernel])),
+                             shape=(n, n))
+
+
+class Convolver(object):
+    """
+    Convolution of a spectrum with a kernel of odd length centred on the
+    middle pixel, reflecting the spectrum at the edges (like
+    `scipy.ndimage.convolve1d`)
+
+    The ``'direct'`` method calls `scipy.ndimage.convolve1d`, costing
+    O(N K) for a spectrum of N pixels and a kernel of K pixels. The ``'fft'``
+    method uses overlap-add with batched real FFTs of blocks a few times the
+    kernel length, costing O(N log K). ``'auto'`` picks whichever is estimated
+    to be cheaper for the given lengths. The block layout, the work buffer and
+    the transformed kernels are cached, so repeated convolutions of spectra
+    of the same length (e.g. on a fixed log-wavelength grid) only transform
+    the spectrum.
+
+    Parameters
+    ----------
+
+    method: str
+        ``'auto'``, ``'direct'`` or ``'fft'`` [default 'auto']
+
+    kernel_cache_bytes: int
+        byte budget of the cache of transformed kernels [default 4 MB]
+    """
+
+    methods = ('auto', 'direct', 'fft')
+
+    def __init__(self, method='auto', kernel_cache_bytes=2**22):
+        if method not in self.methods:
+            raise ValueError('method needs to be one of {0} - {1} '
+                             'given'.format(', '.join(self.methods), method))
+        self.method = method
+        self.kernel_cache = LRUCache(kernel_cache_bytes)
+        self._layouts = {}
+
+    def __call__(self, flux, kernel):
+        """
+        Convolve flux with kernel
+
+        Parameters
+        ----------
+
+        flux: ~numpy.ndarray
+            1D spectrum
+
+        kernel: ~numpy.ndarray
+            1D kernel of odd length
+
+        Returns
+        -------
+            : ~numpy.ndarray
+            convolved spectrum in the dtype of flux
+        """
+        if self.select_method(len(flux), len(kernel)) == 'direct':
+            return nd.convolve1d(flux, kernel)
+        return self._fft_convolve(flux, kernel).astype(flux.dtype, copy=False)
+
+    def select_method(self, n, k):
+        """
+        Method used for a spectrum of n pixels and a kernel of k pixels
+        """
+        # even kernels and kernels wider than the spectrum are shifted or
+        # reflected differently by scipy.ndimage
+        if k % 2 == 0 or k // 2 >= n or k == 1:
+            return 'direct'
+        if self.method != 'auto':
+            return self.method
+        return 'fft' if self._fft_cost(n, k) < n * k else 'direct'
+
+    def cost(self, n, k):
+        """
+        Estimated cost (in multiply-adds of the direct convolution) of
+        convolving a spectrum of n pixels with a kernel of k pixels
+        """
+        if self.select_method(n, k) == 'direct':
+            return n * k
+        return self._fft_cost(n, k)
+
+    def _fft_cost(self, n, k):
+        layout = self._layout(n, k)
+        return (FFT_COST_FACTOR * layout.n_blocks * layout.fft_length *
+                np.log2(layout.fft_length))
+
+    def _layout(self, n, k):
+        """
+        Block layout and work buffer of the overlap-add for a spectrum of n
+        pixels and a kernel of k pixels
+        """
+        layout = self._layouts.get((n, k))
+        if layout is None:
+            padded_length = n + k - 1
+            fft_length = min(next_fast_length(max(8 * (k - 1), 256)),
+                             next_fast_length(padded_length + k - 1))
+            block_length = fft_length - (k - 1)
+            n_blocks = -(-padded_length // block_length)
+            layout = FFTLayout(fft_length, block_length, n_blocks,
+                               np.zeros(n_blocks * block_length))
+            if len(self._layouts) >= MAX_LAYOUTS:
+                self._layouts.clear()
+            self._layouts[(n, k)] = layout
+        return layout
+
+    def _kernel_fft(self, kernel, fft_length):
+        key = (fft_length, kernel.tobytes())
+        kernel_fft = self.kernel_cache.get(key)
+        if kernel_fft is None:
+            kernel_fft = np.fft.rfft(kernel, fft_length)
+            self.kernel_cache.put(key, kernel_fft)
+        return kernel_fft
+
+    def _fft_convolve(self, flux, kernel):
+        n, k = len(flux), len(kernel)
+        half = k // 2
+        layout = self._layout(n, k)
+
+        # the spectrum reflected at the edges, zero padded to whole blocks
+        padded = layout.buffer
+        padded[:half] = flux[half - 1::-1]
+        padded[half:half + n] = flux
+        padded[half + n:n + 2 * half] = flux[:n - half - 1:-1]
+
+        blocks = padded.reshape(layout.n_blocks, layout.block_length)
+        convolved_blocks = np.fft.irfft(
+            np.fft.rfft(blocks, layout.fft_length, axis=1) *
+            self._kernel_fft(kernel, layout.fft_length),
+            layout.fft_length, axis=1)
+
+        # overlap-add: the last k - 1 pixels of each block spill into the next
+        convolved = np.zeros((layout.n_blocks + 1, layout.block_length))
+        convolved[:-1] += convolved_blocks[:, :layout.block_length]
+        convolved[1:, :k - 1] += convolved_blocks[:, layout.block_length:]
+        return convolved.ravel()[2 * half:2 * half + n]
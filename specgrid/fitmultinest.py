@@ -1,6 +1,5 @@
 from scipy.stats import norm, poisson
 from collections import OrderedDict
-from pylab import plt
 import pymultinest
 import json
 import os
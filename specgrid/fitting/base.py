@@ -3,6 +3,7 @@ import numpy as np
 from collections import OrderedDict\
 
 from specgrid import Spectrum1D
+from specgrid.spectrum_record import SpectrumRecord
 
 class BaseFitResult():
     pass
@@ -58,7 +59,8 @@ class SimpleFitResult(BaseFitResult):
                 uncertainty = np.ones(self.residuals.flux.shape)
             else:
                 uncertainty = self.spectrum.uncertainty
-            chi2 = np.sum((self.residuals.flux.value / uncertainty) **2)
+            chi2 = np.sum((self.residuals.flux.value / uncertainty) **2,
+                          dtype=np.float64)
             self._chi2 = chi2
         return chi2
 
@@ -142,7 +144,9 @@ class SimpleSpectrumFitnessFunction(object):
         self.spectrum = spectrum
         self.model_observation = model_observation
         self.fill_value = fill_value
-        
+        self._fill_flux = None
+        self._observed_values = None
+        self._flux_scale = {}
 
     def _get_spectrum_uncertainty(self):
         if getattr(self.spectrum, 'uncertainty', None) is not None:
@@ -150,18 +154,51 @@ class SimpleSpectrumFitnessFunction(object):
         else:
             return np.ones_like(self.spectrum.flux)
 
+    def _get_observed_values(self):
+        """
+        Flux, uncertainty (in the flux unit) and flux unit of the observed
+        spectrum as plain arrays
+        """
+        if self._observed_values is None:
+            flux_unit = self.spectrum.flux.unit
+            uncertainty = self._get_spectrum_uncertainty()
+            if hasattr(uncertainty, 'unit'):
+                uncertainty = uncertainty.to(flux_unit).value
+            self._observed_values = (self.spectrum.flux.value,
+                                     np.asarray(uncertainty), flux_unit)
+        return self._observed_values
+
     def _get_model_flux(self, param_values, param_names):
         parameter_dict = OrderedDict(zip(param_names, param_values))
 
-        model_spectrum = self.model_observation.evaluate(**parameter_dict)
+        # off-grid parameters are rejected without evaluating the model once
+        # the shape and unit of the fill flux are known
+        if self._fill_flux is not None and \
+                not self.model_observation.contains(**parameter_dict):
+            return self._fill_flux
+
+        model_spectrum = self.model_observation._evaluate_record(
+            **parameter_dict)
 
         return self._replace_nan_flux(model_spectrum)
 
     def _replace_nan_flux(self, model_spectrum):
-        if np.isnan(model_spectrum.flux[0]):
-            model_flux = np.ones_like(model_spectrum.flux) * self.fill_value
-        else:
-            model_flux = model_spectrum.flux
+        model_flux = model_spectrum.flux
+        if isinstance(model_spectrum, SpectrumRecord):
+            # plain values in the unit of the observed spectrum
+            observed_unit = self._get_observed_values()[2]
+            if model_spectrum.flux_unit != observed_unit:
+                if model_spectrum.flux_unit not in self._flux_scale:
+                    self._flux_scale[model_spectrum.flux_unit] = \
+                        model_spectrum.flux_unit.to(observed_unit)
+                model_flux = model_flux * self._flux_scale[
+                    model_spectrum.flux_unit]
+
+        if self._fill_flux is None:
+            self._fill_flux = np.ones_like(model_flux) * self.fill_value
+
+        if np.isnan(model_flux[0]):
+            model_flux = self._fill_flux
 
         return model_flux
 
@@ -169,14 +206,45 @@ class SimpleSpectrumFitnessFunction(object):
 
         model_flux = self._get_model_flux(param_values, param_names)
 
-        uncertainty = self._get_spectrum_uncertainty()
+        observed_flux, uncertainty, _ = self._get_observed_values()
 
+        quality = (observed_flux - model_flux) / uncertainty
 
 
-        quality = ((self.spectrum.flux - model_flux) / uncertainty)
+        return (quality**2).sum(dtype=np.float64) if return_square_sum \
+            else quality
 
+    def jacobian(self, param_values, param_names, return_square_sum):
+        """
+        Analytic derivative of the (non-squared) fitness function with
+        respect to each parameter for models with ``evaluate_with_jacobian``
+        (e.g. `~specgrid.SpectralGrid`, or a `~specgrid.ModelStar` or
+        `~specgrid.Observation` with ``provides_jacobian``). Returns an array
+        with shape (n_params, n_wavelength) to be used with
+        ``col_deriv=True``.
+        """
+        parameter_dict = OrderedDict(zip(param_names, param_values))
+        if not self.model_observation.contains(**parameter_dict):
+            return np.zeros((len(param_names), len(self.spectrum.flux)))
+
+        if hasattr(self.model_observation, '_evaluate_record_with_jacobian'):
+            # only the fitted parameters, sparing the forward differences of
+            # fixed plugin parameters
+            _, model_jacobian = \
+                self.model_observation._evaluate_record_with_jacobian(
+                    list(param_names), **parameter_dict)
+        else:
+            _, model_jacobian = self.model_observation.evaluate_with_jacobian(
+                **parameter_dict)
+            parameter_rows = [self.model_observation.param_names.index(name)
+                              for name in param_names]
+            model_jacobian = model_jacobian[parameter_rows]
 
-        return (quality**2).sum() if return_square_sum else quality
+        _, uncertainty, flux_unit = self._get_observed_values()
+        jacobian = -(model_jacobian.to(flux_unit).value / uncertainty)
+
+        # the fitness function is constant (fill_value) outside the grid
+        return np.where(np.isnan(jacobian), 0., jacobian)
 
 
 
@@ -191,7 +259,15 @@ def fit_spectrum(spectrum, model_observation, method='leastsq',
     spectrum: ~specutils.Spectrum1D
         spectrum to be fit
     model_observation: ~specgrid.ModelObservation
-        model of observation, that returns a spectrum
+        model of observation, that returns a spectrum. If it provides
+        derivatives (a `~specgrid.SpectralGrid` or
+        `~specgrid.GridCollection` fit directly, or a `~specgrid.ModelStar`
+        or `~specgrid.Observation` whose ``provides_jacobian`` is True)
+        leastsq uses them instead of finite differences of the whole model.
+        Models with plugins that are not linear in the flux (e.g.
+        `~specgrid.plugins.Normalize` or `~specgrid.plugins.NormalizeParts`)
+        are still differentiated numerically by leastsq, which costs
+        n_params + 1 evaluations per step
     method: str
         method name one of the scipy minimize options or leastsq
     fill_value: ~float
@@ -215,7 +291,7 @@ def fit_spectrum(spectrum, model_observation, method='leastsq',
                                   for key in model_observation.param_names
                                   if key in guesses)
 
-    if np.isnan(model_observation.evaluate(**parameter_guesses).flux.value[0]):
+    if not model_observation.contains(**parameter_guesses):
         raise ValueError('Initial guess ({0}) is outside the confines '
                          'of the grid -- aborting'.format(parameter_guesses))
 
@@ -224,11 +300,20 @@ def fit_spectrum(spectrum, model_observation, method='leastsq',
 
     return_square_sum = not (method == 'leastsq')
     if method == 'leastsq':
+        # models that know their derivatives spare leastsq the
+        # finite differences
+        if getattr(model_observation, 'provides_jacobian',
+                   hasattr(model_observation, 'evaluate_with_jacobian')):
+            jacobian_func = SimpleSpectrumFitnessFunction(
+                spectrum, model_observation, fill_value=fill_value).jacobian
+        else:
+            jacobian_func = None
 
         fit = optimize.leastsq(fitness_func,
                                np.array(parameter_guesses.values()),
                                args=(parameter_guesses.keys(),
                                      return_square_sum),
+                               Dfun=jacobian_func, col_deriv=True,
                                full_output=True)
 
         bestfit_spectrum = model_observation()
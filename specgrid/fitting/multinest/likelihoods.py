@@ -1,5 +1,7 @@
 from collections import OrderedDict
 from logging import getLogger
+
+import numpy as np
 #likelihood = SimpleLikelihood(self.spectrum, observation, self.parameter_names)
 
 from specgrid.fitting.spectrophotometry import SpectroPhotometryFitnessFunction
@@ -66,11 +68,15 @@ class SimpleSpectrumLikelihood(object):
         param_dict = OrderedDict([(key, value) for key, value in
                                   zip(self.parameter_names, model_param)])
 
-        m = self.observation.evaluate(**param_dict)
+        # off-grid samples are NaN without evaluating the model
+        if not self.observation.contains(**param_dict):
+            return np.nan
+
+        model_flux = self.observation._evaluate_record(**param_dict).flux
 
         # log-likelhood for chi-square
-        return (-0.5 * ((self.spectrum.flux.value - m.flux.value) /
-        self.spectrum.uncertainty.value)**2).sum()
+        return (-0.5 * ((self.spectrum.flux.value - model_flux) /
+        self.spectrum.uncertainty.value)**2).sum(dtype=np.float64)
 
 
     def __repr__(self):
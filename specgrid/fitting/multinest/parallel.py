@@ -95,7 +95,10 @@ class ParallelMultiNestFitter(object):
             remote clients from ipython
 
         model_star: tardis.atomic.AtomData or None
-            remote atomic data, if None each queue needs to bring their own one
+            remote atomic data, if None each queue needs to bring their own one.
+            Open its grid with ``SpectralGrid(..., memmap=True)`` to send only
+            a reference to the fluxes, so engines on one node share a single
+            memory-mapped copy
         """
 
         logger.info('Sending model star to remote '
@@ -15,6 +15,7 @@ class SpectroPhotometryFitnessFunction(SimpleSpectrumFitnessFunction):
         self.model_observation = model_observation
         self.magnitude_set = magnitude_set
         self.fill_value = fill_value
+        self._fill_flux = None
         self.spectrum_uncertainty = self._get_spectrum_uncertainty()
 
 
@@ -105,7 +106,7 @@ def fit_spectro_photometry(spectrum, magnitude_set, model_observation,
                                   for key in model_observation.param_names
                                   if key in guesses)
 
-    if np.isnan(model_observation.evaluate(**parameter_guesses).flux.value[0]):
+    if not model_observation.contains(**parameter_guesses):
         raise ValueError('Initial guess ({0}) is outside the confines '
                          'of the grid -- aborting'.format(parameter_guesses))
 
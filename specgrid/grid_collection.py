@@ -0,0 +1,268 @@
+from collections import OrderedDict
+import os
+
+import numpy as np
+
+from base import BaseSpectralGrid, SpectralGrid, GridIndex
+
+
+class GridCollection(BaseSpectralGrid):
+    """
+    Several spectral grids (e.g. blocks of teff or metallicity) used as one
+    grid. Each evaluation is routed to the subgrid that contains the
+    parameters, so every piece keeps its own small triangulation and flux
+    array instead of one huge grid made by `~specgrid.io.base.make_hdf5`.
+
+    Only the parameter indices are read when the collection is created; a
+    subgrid is opened as a `~specgrid.SpectralGrid` the first time a
+    parameter set falls inside it. Parameters on a boundary shared by several
+    subgrids are evaluated in the first of them (in the order given).
+    Parameters in a gap between subgrids are outside the collection - there
+    is no interpolation across subgrids.
+
+    A collection has the parameter and evaluation interface of a
+    `~specgrid.SpectralGrid` (``evaluate``, ``evaluate_many``,
+    ``evaluate_with_jacobian``, ``contains``, ``contains_many``), so it can be
+    used as the grid of a `~specgrid.ModelStar`. Members that describe a
+    single grid file (e.g. ``fluxes``, ``interpolate_grid`` or
+    ``regular_grid``) are only available on the subgrids (see `get_grid`).
+
+    Parameters
+    ----------
+
+    grid_hdf5_fnames: list of str
+        HDF5 grids with the same parameters and the same wavelengths
+
+    max_open_grids: int or None
+        number of subgrids kept open at once - the least recently used
+        subgrid is closed when another one has to be opened. None keeps all
+        opened subgrids [default None]
+
+    grid_kwargs:
+        passed on to `~specgrid.SpectralGrid` for every subgrid (e.g.
+        ``dtype``, ``wavelength_range`` or ``memmap``)
+    """
+
+    def __init__(self, grid_hdf5_fnames, max_open_grids=None, **grid_kwargs):
+        # the subgrids are the SpectralGrids - only the index is read here
+        if len(grid_hdf5_fnames) == 0:
+            raise ValueError('A grid collection needs at least one grid')
+        if max_open_grids is not None and max_open_grids < 1:
+            raise ValueError('max_open_grids needs to be at least 1')
+
+        for grid_hdf5_fname in grid_hdf5_fnames:
+            if not os.path.exists(grid_hdf5_fname):
+                raise IOError('{0} does not exists'.format(grid_hdf5_fname))
+
+        self.grid_hdf5_fnames = list(grid_hdf5_fnames)
+        self.max_open_grids = max_open_grids
+        self.grid_kwargs = grid_kwargs
+
+        self.grid_indices = [GridIndex.from_hdf5(grid_hdf5_fname)
+                             for grid_hdf5_fname in self.grid_hdf5_fnames]
+        self.param_names = self.grid_indices[0].param_names
+        for grid_hdf5_fname, grid_index in zip(self.grid_hdf5_fnames,
+                                               self.grid_indices):
+            if grid_index.param_names != self.param_names:
+                raise ValueError(
+                    'Parameters of {0} ({1}) differ from the parameters of '
+                    'the collection ({2})'.format(
+                        grid_hdf5_fname, ', '.join(grid_index.param_names),
+                        ', '.join(self.param_names)))
+
+        bounds = np.array([grid_index.bounds
+                           for grid_index in self.grid_indices])
+        self.bounds = np.vstack((bounds[:, :, 0].min(0),
+                                 bounds[:, :, 1].max(0))).T
+
+        self._open_grids = OrderedDict()
+        self._wavelength = None
+
+        for parameter_name, value in zip(self.param_names,
+                                         self.grid_indices[0].points[0]):
+            setattr(self, parameter_name, value)
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        # subgrids are opened again when needed after unpickling
+        state['_open_grids'] = OrderedDict()
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+
+    @property
+    def index(self):
+        """
+        Parameters of the spectra of all subgrids as `~pandas.DataFrame`
+        (points on a boundary shared by several subgrids appear once for each
+        of them)
+        """
+        import pandas as pd
+        return pd.concat([grid_index.index for grid_index in self.grid_indices],
+                         ignore_index=True)
+
+    def __len__(self):
+        return len(self.grid_hdf5_fnames)
+
+    def get_grid(self, grid_id):
+        """
+        The subgrid with the given number as `~specgrid.SpectralGrid`,
+        opening it if needed
+        """
+        if grid_id in self._open_grids:
+            grid = self._open_grids.pop(grid_id)
+        else:
+            grid = SpectralGrid(self.grid_hdf5_fnames[grid_id],
+                                **self.grid_kwargs)
+            self._check_wavelength(grid)
+            if self.max_open_grids is not None and \
+                    len(self._open_grids) >= self.max_open_grids:
+                _, least_recent_grid = self._open_grids.popitem(last=False)
+                least_recent_grid.close()
+
+        self._open_grids[grid_id] = grid
+        return grid
+
+    def _check_wavelength(self, grid):
+        if self._wavelength is None:
+            self._wavelength = grid.wavelength
+            self._flux_unit = grid.flux_unit
+            self._dtype = grid.dtype
+            self._log_wavelength_step = grid.log_wavelength_step
+        elif (len(grid.wavelength) != len(self._wavelength) or
+              not np.allclose(grid.wavelength.to(self._wavelength.unit).value,
+                              self._wavelength.value)):
+            raise ValueError('Wavelengths of {0} differ from the wavelengths '
+                             'of the collection'.format(grid.grid_hdf5_fname))
+        elif grid.flux_unit != self._flux_unit:
+            raise ValueError('Flux unit of {0} ({1}) differs from the flux '
+                             'unit of the collection ({2})'.format(
+                grid.grid_hdf5_fname, grid.flux_unit, self._flux_unit))
+
+    def _reference_grid(self):
+        if self._wavelength is None:
+            self.get_grid(0)
+
+    @property
+    def wavelength(self):
+        self._reference_grid()
+        return self._wavelength
+
+    @property
+    def flux_unit(self):
+        self._reference_grid()
+        return self._flux_unit
+
+    @property
+    def dtype(self):
+        self._reference_grid()
+        return self._dtype
+
+    @property
+    def log_wavelength_step(self):
+        self._reference_grid()
+        return self._log_wavelength_step
+
+    def close(self):
+        """
+        Close all open subgrids
+        """
+        for grid in self._open_grids.values():
+            grid.close()
+        self._open_grids.clear()
+
+    def find_grids(self, parameter_matrix):
+        """
+        Number of the subgrid each parameter set is evaluated in
+
+        Parameters
+        ----------
+
+        parameter_matrix: ~numpy.ndarray
+            parameter sets with shape (N, n_params), the columns ordered as
+            in ``param_names``
+
+        Returns
+        -------
+            : ~numpy.ndarray
+            integer array with shape (N,), -1 for parameter sets outside all
+            subgrids
+        """
+        parameter_matrix = self._check_parameter_matrix(parameter_matrix,
+                                                        'find_grids')
+        grid_ids = np.full(len(parameter_matrix), -1, dtype=int)
+        for grid_id, grid_index in enumerate(self.grid_indices):
+            unassigned = grid_ids == -1
+            if not unassigned.any():
+                break
+            inside = grid_index.contains_many(parameter_matrix[unassigned])
+            grid_ids[np.flatnonzero(unassigned)[inside]] = grid_id
+        return grid_ids
+
+    def contains_many(self, parameter_matrix):
+        """
+        Check which parameter sets are inside any of the subgrids (see
+        `~specgrid.SpectralGrid.contains_many`)
+        """
+        return self.find_grids(parameter_matrix) >= 0
+
+    def _current_grid(self):
+        """
+        Subgrid containing the current parameters with the parameters set, or
+        None if they are outside the collection
+        """
+        parameter_values = [getattr(self, item) for item in self.param_names]
+        grid_id = self.find_grids([parameter_values])[0]
+        if grid_id < 0:
+            return None
+        grid = self.get_grid(grid_id)
+        grid._set_parameters(*parameter_values)
+        return grid
+
+    def _interpolate_flux(self):
+        grid = self._current_grid()
+        if grid is None:
+            return self._off_grid_flux(1)[0]
+        return grid._interpolate_flux()
+
+    def evaluate_with_jacobian(self, *args, **kwargs):
+        """
+        Interpolating like `evaluate` and returning the derivative of the flux
+        with respect to each parameter from the subgrid the parameters are in
+        (see `~specgrid.SpectralGrid.evaluate_with_jacobian`)
+        """
+        self._set_parameters(*args, **kwargs)
+
+        grid = self._current_grid()
+        if grid is not None:
+            return grid.evaluate_with_jacobian()
+
+        # outside every subgrid - no subgrid needs to be opened for NaNs
+        from fix_spectrum1d import Spectrum1D
+        flux = self._off_grid_flux(1)[0]
+        jacobian = np.full((len(self.param_names), len(flux)), np.nan,
+                           dtype=self.dtype)
+        return (Spectrum1D.from_array(self.wavelength,
+                                      flux * self.flux_unit),
+                jacobian * self.flux_unit)
+
+    def evaluate_many(self, parameter_matrix):
+        """
+        Interpolating many parameter sets at once, each in the subgrid that
+        contains it (see `~specgrid.SpectralGrid.evaluate_many`)
+        """
+        parameter_matrix = self._check_parameter_matrix(parameter_matrix,
+                                                        'evaluate_many')
+        grid_ids = self.find_grids(parameter_matrix)
+
+        fluxes = self._off_grid_flux(len(parameter_matrix))
+        for grid_id in np.unique(grid_ids[grid_ids >= 0]):
+            in_grid = grid_ids == grid_id
+            fluxes[in_grid] = self.get_grid(grid_id).evaluate_many(
+                parameter_matrix[in_grid])
+        return fluxes
+
+    def __repr__(self):
+        return '<GridCollection of {0} grids ({1} open) - {2}>'.format(
+            len(self), len(self._open_grids), ', '.join(self.param_names))
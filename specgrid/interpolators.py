@@ -0,0 +1,761 @@
+import hashlib
+import itertools
+from logging import getLogger
+
+import numpy as np
+
+try:
+    import h5py
+except ImportError:
+    h5py_available = False
+else:
+    h5py_available = True
+
+from cache import memmap_hdf5_dataset
+
+logger = getLogger(__name__)
+
+
+def hash_index(points):
+    """
+    Hash of a grid index used to check that a stored triangulation belongs to
+    a given grid
+
+    Parameters
+    ----------
+
+    points: ~numpy.ndarray
+        grid points with shape (n_points, n_dim)
+
+    Returns
+    -------
+        : ~str
+    """
+    points = np.ascontiguousarray(points, dtype=np.float64)
+    index_hash = hashlib.sha1(str(points.shape).encode('ascii'))
+    index_hash.update(points.tobytes())
+    return index_hash.hexdigest()
+
+
+def weighted_row_sum(values, rows, weights, out):
+    """
+    Sum of ``values`` rows weighted by ``weights`` for each point
+
+    In-memory arrays are indexed directly. Every distinct row of other values
+    (lazily loaded or memory-mapped) is read only once, which keeps the
+    number of reads minimal. Several sets of weights (e.g. the weights and
+    their gradient) can be combined in one pass by giving ``weights`` an
+    extra last axis.
+
+    Parameters
+    ----------
+
+    values: array-like
+        values with shape (n_rows, ...)
+    rows: ~numpy.ndarray
+        rows to combine for each point with shape (n, n_vertices)
+    weights: ~numpy.ndarray
+        weights for each row with shape (n, n_vertices) or
+        (n, n_vertices, n_sets)
+    out: ~numpy.ndarray
+        output array with shape (n, ...) or (n, n_sets, ...)
+    """
+    if isinstance(values, np.ndarray) and not isinstance(values, np.memmap):
+        vertex_values = values
+    else:
+        unique_rows, inverse = np.unique(rows.ravel(), return_inverse=True)
+        rows = inverse.reshape(rows.shape)
+        vertex_values = values[unique_rows]
+    weight_sets = weights.ndim > rows.ndim
+    weights = weights.astype(out.dtype, copy=False).reshape(
+        weights.shape + (1,) * (vertex_values.ndim - 1))
+
+    # the rows and weighted rows of each vertex reuse the same buffers
+    row_values = np.empty((len(rows),) + vertex_values.shape[1:],
+                          dtype=vertex_values.dtype)
+    weighted_values = np.empty_like(out)
+    out[...] = 0.
+    for i in range(rows.shape[1]):
+        # rows are valid, 'clip' spares the buffered copy of 'raise'
+        np.take(vertex_values, rows[:, i], axis=0, out=row_values,
+                mode='clip')
+        if weight_sets:
+            np.multiply(weights[:, i], row_values[:, np.newaxis],
+                        out=weighted_values)
+        else:
+            np.multiply(weights[:, i], row_values, out=weighted_values)
+        out += weighted_values
+
+    return out
+
+
+def _check_points(xi, ndim):
+    xi = np.atleast_2d(np.asarray(xi, dtype=float))
+    if xi.shape[-1] != ndim:
+        raise ValueError('Interpolation points need {0} dimensions - '
+                         '{1} given'.format(ndim, xi.shape[-1]))
+    return xi
+
+
+def _values_with_jacobian(values, rows, weights, weight_gradient, inside,
+                          fill_value):
+    """
+    Interpolated values and jacobian for the points inside the grid from the
+    vertex weights and their gradient, filling points outside with
+    fill_value
+    """
+    n_dim = weight_gradient.shape[-1]
+    result = np.empty((len(inside), n_dim + 1) + values.shape[1:],
+                      dtype=values.dtype)
+    result[~inside] = fill_value
+    if inside.any():
+        all_weights = np.concatenate((weights[..., np.newaxis],
+                                      weight_gradient), axis=-1)
+        result[inside] = weighted_row_sum(values, rows, all_weights,
+                                          np.empty_like(result[inside]))
+
+    return result[:, 0], result[:, 1:]
+
+
+def interpolate_with_jacobian(interpolator, xi):
+    """
+    Interpolated values and their derivatives with respect to each coordinate
+    from an interpolator of this module or a
+    `scipy.interpolate.LinearNDInterpolator` (using its triangulation)
+
+    Parameters
+    ----------
+
+    interpolator: object
+        interpolator instance
+
+    xi: ~numpy.ndarray
+        points with shape (n, n_dim)
+
+    Returns
+    -------
+    values: ~numpy.ndarray
+        interpolated values with shape (n, ...)
+    jacobian: ~numpy.ndarray
+        derivatives with shape (n, n_dim, ...)
+    """
+    if hasattr(interpolator, 'with_jacobian'):
+        return interpolator.with_jacobian(xi)
+
+    triangulation = getattr(interpolator, 'tri', None)
+    if triangulation is None:
+        raise NotImplementedError('{0} does not provide derivatives'.format(
+            type(interpolator).__name__))
+
+    simplex_interpolator = SimplexInterpolator(
+        triangulation.points, interpolator.values,
+        fill_value=interpolator.fill_value, triangulation=triangulation)
+    return simplex_interpolator.with_jacobian(xi)
+
+
+class MultilinearInterpolator(object):
+    """
+    Multilinear interpolation on a complete rectilinear (tensor-product) grid.
+
+    Has the same calling convention as `scipy.interpolate.LinearNDInterpolator`
+    but instead of triangulating the grid it locates the bracketing hypercube
+    on each axis and only touches its :math:`2^d` corner spectra. Points
+    outside the grid return ``fill_value``.
+
+    Parameters
+    ----------
+
+    points: ~numpy.ndarray
+        grid points with shape (n_points, n_dim), e.g. ``index.values``
+
+    values: array-like
+        values at the grid points with shape (n_points, ...), e.g. fluxes
+
+    fill_value: ~float
+        value for points outside of the grid [default nan]
+    """
+
+    def __init__(self, points, values, fill_value=np.nan):
+        points = np.asarray(points, dtype=float)
+        if not self.is_regular_grid(points):
+            raise ValueError('points do not form a complete rectilinear grid '
+                             '- use LinearNDInterpolator instead')
+
+        self.values = values
+        self.fill_value = fill_value
+        self.ndim = points.shape[1]
+        self.axes = [np.unique(points[:, i]) for i in range(self.ndim)]
+        self.shape = tuple(len(axis) for axis in self.axes)
+
+        # map each node of the tensor product onto its row in ``values``
+        node_index = tuple(np.searchsorted(axis, points[:, i])
+                           for i, axis in enumerate(self.axes))
+        self.node_row = np.empty(self.shape, dtype=np.int64)
+        self.node_row[node_index] = np.arange(len(points))
+
+        self.corner_offsets = np.array(
+            list(itertools.product((0, 1), repeat=self.ndim)))
+
+    @staticmethod
+    def is_regular_grid(points):
+        """
+        Check if the points form a complete tensor-product grid, i.e. every
+        combination of the unique values on each axis is present exactly once.
+
+        Parameters
+        ----------
+
+        points: ~numpy.ndarray
+            grid points with shape (n_points, n_dim)
+
+        Returns
+        -------
+            : ~bool
+        """
+        points = np.asarray(points, dtype=float)
+        if points.ndim != 2 or len(points) == 0:
+            return False
+
+        axes = [np.unique(points[:, i]) for i in range(points.shape[1])]
+        if any(len(axis) < 2 for axis in axes):
+            return False
+
+        if np.prod([len(axis) for axis in axes]) != len(points):
+            return False
+
+        unique_points = np.unique(np.ascontiguousarray(points).view(
+            np.dtype((np.void, points.dtype.itemsize * points.shape[1]))))
+
+        return len(unique_points) == len(points)
+
+    def find_cells(self, xi):
+        """
+        Locate the hypercube containing each point
+
+        Parameters
+        ----------
+
+        xi: ~numpy.ndarray
+            points with shape (n, n_dim)
+
+        Returns
+        -------
+        cell_index: ~numpy.ndarray
+            lower corner index on each axis with shape (n, n_dim)
+        cell_fraction: ~numpy.ndarray
+            fractional position within the cell on each axis (n, n_dim)
+        inside: ~numpy.ndarray
+            boolean array that is False for points outside the grid
+        """
+        cell_index = np.empty(xi.shape, dtype=np.int64)
+        cell_fraction = np.empty(xi.shape, dtype=float)
+        inside = np.ones(len(xi), dtype=bool)
+
+        for i, axis in enumerate(self.axes):
+            x = xi[:, i]
+            inside &= (x >= axis[0]) & (x <= axis[-1])
+            idx = np.clip(np.searchsorted(axis, x, side='right') - 1,
+                          0, len(axis) - 2)
+            cell_index[:, i] = idx
+            cell_fraction[:, i] = (x - axis[idx]) / (axis[idx + 1] - axis[idx])
+
+        return cell_index, cell_fraction, inside
+
+    def corner_weights(self, cell_index, cell_fraction):
+        """
+        Rows and multilinear weights of the :math:`2^d` corners of each cell
+
+        Returns
+        -------
+        rows: ~numpy.ndarray
+            row in ``values`` for each corner with shape (n, 2**n_dim)
+        weights: ~numpy.ndarray
+            weight for each corner with shape (n, 2**n_dim)
+        """
+        corners = cell_index[:, np.newaxis, :] + self.corner_offsets
+        rows = self.node_row[tuple(corners[..., i]
+                                   for i in range(self.ndim))]
+        weights = np.where(self.corner_offsets,
+                           cell_fraction[:, np.newaxis, :],
+                           1. - cell_fraction[:, np.newaxis, :]).prod(-1)
+        return rows, weights
+
+    def corner_weight_gradient(self, cell_index, cell_fraction):
+        """
+        Derivative of the corner weights with respect to each coordinate
+
+        Returns
+        -------
+            : ~numpy.ndarray
+            gradient of the weight of each corner with shape
+            (n, 2**n_dim, n_dim)
+        """
+        cell_width = np.empty(cell_index.shape)
+        for i, axis in enumerate(self.axes):
+            cell_width[:, i] = np.diff(axis)[cell_index[:, i]]
+
+        factors = np.where(self.corner_offsets,
+                           cell_fraction[:, np.newaxis, :],
+                           1. - cell_fraction[:, np.newaxis, :])
+        factor_gradient = (np.where(self.corner_offsets, 1., -1.) /
+                           cell_width[:, np.newaxis, :])
+
+        gradient = np.empty(factors.shape)
+        for i in range(self.ndim):
+            gradient[..., i] = factor_gradient[..., i] * np.delete(
+                factors, i, axis=-1).prod(-1)
+        return gradient
+
+    def __call__(self, xi):
+        xi = _check_points(xi, self.ndim)
+        cell_index, cell_fraction, inside = self.find_cells(xi)
+
+        result = np.empty((len(xi),) + self.values.shape[1:],
+                          dtype=self.values.dtype)
+        result[~inside] = self.fill_value
+        if not inside.any():
+            return result
+
+        rows, weights = self.corner_weights(cell_index[inside],
+                                            cell_fraction[inside])
+        result[inside] = weighted_row_sum(self.values, rows, weights,
+                                          np.empty_like(result[inside]))
+
+        return result
+
+    def with_jacobian(self, xi):
+        """
+        Interpolated values and their derivatives with respect to each
+        coordinate, which are constant within a cell. On a cell face the
+        derivative of the cell above is returned (below on the upper grid
+        edge).
+
+        Parameters
+        ----------
+
+        xi: ~numpy.ndarray
+            points with shape (n, n_dim)
+
+        Returns
+        -------
+        values: ~numpy.ndarray
+            interpolated values with shape (n, ...)
+        jacobian: ~numpy.ndarray
+            derivatives with shape (n, n_dim, ...)
+        """
+        xi = _check_points(xi, self.ndim)
+        cell_index, cell_fraction, inside = self.find_cells(xi)
+
+        rows, weights = self.corner_weights(cell_index[inside],
+                                            cell_fraction[inside])
+        weight_gradient = self.corner_weight_gradient(cell_index[inside],
+                                                      cell_fraction[inside])
+
+        return _values_with_jacobian(self.values, rows, weights,
+                                     weight_gradient, inside,
+                                     self.fill_value)
+
+
+class SimplexInterpolator(object):
+    """
+    Piecewise linear interpolation on a Delaunay triangulation of the grid.
+
+    Gives the same results as `scipy.interpolate.LinearNDInterpolator` but
+    only reads the :math:`d+1` vertex spectra of the enclosing simplex from
+    ``values`` instead of requiring the whole array in memory. Points outside
+    the convex hull of the grid return ``fill_value``.
+
+    Parameters
+    ----------
+
+    points: ~numpy.ndarray
+        grid points with shape (n_points, n_dim), e.g. ``index.values``
+
+    values: array-like
+        values at the grid points with shape (n_points, ...), e.g. fluxes
+
+    fill_value: ~float
+        value for points outside of the grid [default nan]
+
+    triangulation: ~scipy.spatial.Delaunay or ~Triangulation or None
+        precomputed triangulation of the points, None triangulates the points
+        with Qhull [default None]
+    """
+
+    def __init__(self, points, values, fill_value=np.nan, triangulation=None):
+        self.points = np.asarray(points, dtype=float)
+        self.values = values
+        self.fill_value = fill_value
+        self.ndim = self.points.shape[1]
+        if triangulation is None:
+            from scipy import spatial
+            triangulation = spatial.Delaunay(self.points)
+        self.triangulation = triangulation
+
+    def find_simplices(self, xi, gradient=False):
+        """
+        Locate the simplex containing each point
+
+        Parameters
+        ----------
+
+        xi: ~numpy.ndarray
+            points with shape (n, n_dim)
+
+        gradient: bool
+            also return the gradient of the weights [default False]
+
+        Returns
+        -------
+        rows: ~numpy.ndarray
+            rows in ``values`` of the simplex vertices for the points inside
+            the grid with shape (n_inside, n_dim + 1)
+        weights: ~numpy.ndarray
+            barycentric weights of the vertices (n_inside, n_dim + 1)
+        inside: ~numpy.ndarray
+            boolean array that is False for points outside the grid
+        weight_gradient: ~numpy.ndarray
+            derivative of the weights with respect to each coordinate with
+            shape (n_inside, n_dim + 1, n_dim), only if gradient is True
+        """
+        simplex = self.triangulation.find_simplex(xi)
+        inside = simplex >= 0
+        simplex = simplex[inside]
+
+        transform = self.triangulation.transform[simplex]
+        barycentric = np.einsum('nij,nj->ni', transform[:, :self.ndim],
+                                xi[inside] - transform[:, self.ndim])
+        weights = np.hstack((barycentric,
+                             1. - barycentric.sum(1)[:, np.newaxis]))
+
+        if not gradient:
+            return self.triangulation.simplices[simplex], weights, inside
+
+        weight_gradient = np.concatenate(
+            (transform[:, :self.ndim],
+             -transform[:, :self.ndim].sum(1)[:, np.newaxis]), axis=1)
+        return (self.triangulation.simplices[simplex], weights, inside,
+                weight_gradient)
+
+    def __call__(self, xi):
+        xi = _check_points(xi, self.ndim)
+        rows, weights, inside = self.find_simplices(xi)
+
+        result = np.empty((len(xi),) + self.values.shape[1:],
+                          dtype=self.values.dtype)
+        result[~inside] = self.fill_value
+        if inside.any():
+            result[inside] = weighted_row_sum(self.values, rows, weights,
+                                              np.empty_like(result[inside]))
+
+        return result
+
+    def with_jacobian(self, xi):
+        """
+        Interpolated values and their derivatives with respect to each
+        coordinate, which are constant within a simplex
+
+        Parameters
+        ----------
+
+        xi: ~numpy.ndarray
+            points with shape (n, n_dim)
+
+        Returns
+        -------
+        values: ~numpy.ndarray
+            interpolated values with shape (n, ...)
+        jacobian: ~numpy.ndarray
+            derivatives with shape (n, n_dim, ...)
+        """
+        xi = _check_points(xi, self.ndim)
+        rows, weights, inside, weight_gradient = self.find_simplices(
+            xi, gradient=True)
+
+        return _values_with_jacobian(self.values, rows, weights,
+                                     weight_gradient, inside,
+                                     self.fill_value)
+
+
+class PCAInterpolator(object):
+    """
+    Interpolation of a PCA compressed grid in coefficient space.
+
+    Only the coefficients of the grid points are interpolated and the spectra
+    are reconstructed with a single matrix product afterwards. As the
+    reconstruction is linear this gives the same result as interpolating the
+    reconstructed spectra.
+
+    Parameters
+    ----------
+
+    points: ~numpy.ndarray
+        grid points with shape (n_points, n_dim), e.g. ``index.values``
+
+    fluxes: ~specgrid.cache.PCAFluxes
+        compressed fluxes of the grid
+
+    interpolator: class
+        interpolator for the coefficients called with ``(points,
+        coefficients)`` [default MultilinearInterpolator]
+    """
+
+    def __init__(self, points, fluxes, interpolator=MultilinearInterpolator):
+        self.fluxes = fluxes
+        self.coefficient_interpolator = interpolator(points,
+                                                     fluxes.coefficients)
+
+    def __call__(self, xi):
+        return self.fluxes.reconstruct(self.coefficient_interpolator(xi))
+
+    def with_jacobian(self, xi):
+        """
+        Interpolated spectra and their derivatives with respect to each
+        coordinate, reconstructed from the interpolated coefficients and
+        their derivatives
+
+        Returns
+        -------
+        values: ~numpy.ndarray
+            interpolated spectra with shape (n, n_wavelength)
+        jacobian: ~numpy.ndarray
+            derivatives with shape (n, n_dim, n_wavelength)
+        """
+        coefficients, coefficient_jacobian = interpolate_with_jacobian(
+            self.coefficient_interpolator, xi)
+        jacobian = np.dot(coefficient_jacobian, self.fluxes.components)
+        return (self.fluxes.reconstruct(coefficients),
+                jacobian.astype(self.fluxes.dtype, copy=False))
+
+
+class Triangulation(object):
+    """
+    Delaunay triangulation of a grid that can be stored in and memory-mapped
+    from an HDF5 file.
+
+    Only the arrays needed for interpolation are kept (``simplices``,
+    ``neighbors`` and the barycentric ``transform`` as computed by
+    `~scipy.spatial.Delaunay`). Points are located by walking from the simplex
+    at the nearest grid node towards the point through the simplex neighbors;
+    points whose walk runs into a degenerate (flat) simplex are located by a
+    brute force search.
+
+    Parameters
+    ----------
+
+    points: ~numpy.ndarray
+        grid points with shape (n_points, n_dim)
+
+    simplices: ~numpy.ndarray
+        vertex indices of each simplex with shape (n_simplex, n_dim + 1)
+
+    neighbors: ~numpy.ndarray
+        neighbor simplices opposite to each vertex, -1 at the boundary
+        (n_simplex, n_dim + 1)
+
+    transform: ~numpy.ndarray
+        affine transforms to barycentric coordinates
+        (n_simplex, n_dim + 1, n_dim)
+    """
+
+    def __init__(self, points, simplices, neighbors, transform):
+        self.points = np.asarray(points, dtype=float)
+        self.simplices = simplices
+        self.neighbors = neighbors
+        self.transform = transform
+        self.ndim = self.points.shape[1]
+        self.eps = 100 * np.finfo(float).eps
+
+        vertices = np.asarray(simplices).ravel()
+        self.vertex_to_simplex = np.empty(len(self.points), dtype=np.int64)
+        self.vertex_to_simplex[vertices] = np.repeat(
+            np.arange(len(simplices)), self.ndim + 1)
+
+        # Qhull leaves duplicate and coplanar points out of all simplices,
+        # walks from them start at the simplex of the nearest used vertex
+        orphans = np.ones(len(self.points), dtype=bool)
+        orphans[vertices] = False
+        if orphans.any():
+            from scipy import spatial
+            used = np.flatnonzero(~orphans)
+            nearest = spatial.cKDTree(self.points[used]).query(
+                self.points[orphans])[1]
+            self.vertex_to_simplex[orphans] = self.vertex_to_simplex[
+                used[nearest]]
+        self._kdtree = None
+
+    @classmethod
+    def from_points(cls, points):
+        """
+        Triangulating the points with Qhull
+
+        Parameters
+        ----------
+
+        points: ~numpy.ndarray
+            grid points with shape (n_points, n_dim)
+        """
+        from scipy import spatial
+        delaunay = spatial.Delaunay(points)
+        return cls(points, delaunay.simplices, delaunay.neighbors,
+                   delaunay.transform)
+
+    @classmethod
+    def from_hdf5(cls, h5_fname, points):
+        """
+        Loading a stored triangulation for the given points. The arrays are
+        memory-mapped from the file.
+
+        Parameters
+        ----------
+
+        h5_fname: ~str
+            path to HDF5 file written by `to_hdf5`
+
+        points: ~numpy.ndarray
+            grid points with shape (n_points, n_dim)
+
+        Returns
+        -------
+            : ~Triangulation or None
+            None if the file holds no triangulation for these points
+        """
+        try:
+            h5file = h5py.File(h5_fname, 'r')
+        except (IOError, OSError):
+            return None
+
+        with h5file:
+            if 'triangulation' not in h5file:
+                return None
+            group = h5file['triangulation']
+            if group.attrs['index_hash'] != hash_index(points):
+                return None
+            arrays = []
+            for name in ('simplices', 'neighbors', 'transform'):
+                array = memmap_hdf5_dataset(group[name], h5_fname)
+                arrays.append(group[name][()] if array is None else array)
+
+        return cls(points, *arrays)
+
+    def to_hdf5(self, h5_fname):
+        """
+        Storing the triangulation (uncompressed so it can be memory-mapped)
+
+        Parameters
+        ----------
+
+        h5_fname: ~str
+            path to HDF5 file, an existing triangulation is replaced
+        """
+        with h5py.File(h5_fname, 'a') as h5file:
+            if 'triangulation' in h5file:
+                del h5file['triangulation']
+            group = h5file.create_group('triangulation')
+            group.attrs['index_hash'] = hash_index(self.points)
+            for name in ('simplices', 'neighbors', 'transform'):
+                group.create_dataset(name, data=np.asarray(getattr(self, name)))
+
+    @classmethod
+    def cached(cls, h5_fname, points):
+        """
+        Loading the triangulation from h5_fname or - if it is missing or was
+        made for a different index - triangulating the points and storing the
+        result there
+        """
+        triangulation = cls.from_hdf5(h5_fname, points)
+        if triangulation is None:
+            triangulation = cls.from_points(points)
+            try:
+                triangulation.to_hdf5(h5_fname)
+            except (IOError, OSError) as e:
+                logger.warning('Could not store triangulation in '
+                               '{0}: {1}'.format(h5_fname, e))
+            else:
+                logger.info('Stored triangulation in {0}'.format(h5_fname))
+                # use the memory-mapped copy from the start
+                triangulation = cls.from_hdf5(h5_fname, points)
+        return triangulation
+
+    def barycentric(self, simplex, xi):
+        """
+        Barycentric coordinates of the points xi in the given simplices
+        """
+        transform = self.transform[simplex]
+        barycentric = np.einsum('nij,nj->ni', transform[:, :self.ndim],
+                                xi - transform[:, self.ndim])
+        return np.hstack((barycentric,
+                          1. - barycentric.sum(1)[:, np.newaxis]))
+
+    def find_simplex(self, xi):
+        """
+        Find the simplex containing each point
+
+        Parameters
+        ----------
+
+        xi: ~numpy.ndarray
+            points with shape (n, n_dim)
+
+        Returns
+        -------
+            : ~numpy.ndarray
+            simplex index for each point, -1 for points outside the grid
+        """
+        xi = np.atleast_2d(np.asarray(xi, dtype=float))
+        if self._kdtree is None:
+            from scipy import spatial
+            self._kdtree = spatial.cKDTree(self.points)
+
+        simplex = self.vertex_to_simplex[self._kdtree.query(xi)[1]]
+        found_simplex = -np.ones(len(xi), dtype=np.int64)
+        active = np.arange(len(xi))
+        degenerate = []
+
+        for _ in range(len(self.simplices)):
+            if len(active) == 0:
+                break
+            coordinates = self.barycentric(simplex, xi[active])
+
+            # degenerate (flat) simplices have no valid transform and are
+            # resolved by the brute force search
+            is_degenerate = np.isnan(coordinates).any(1)
+            degenerate.append(active[is_degenerate])
+            active, simplex = (active[~is_degenerate],
+                               simplex[~is_degenerate])
+            coordinates = coordinates[~is_degenerate]
+
+            min_vertex = coordinates.argmin(1)
+            is_inside = (coordinates[np.arange(len(active)), min_vertex] >=
+                         -self.eps)
+            found_simplex[active[is_inside]] = simplex[is_inside]
+
+            # step across the face opposite to the most negative coordinate
+            simplex = self.neighbors[simplex[~is_inside],
+                                     min_vertex[~is_inside]]
+            active = active[~is_inside]
+            in_hull = simplex >= 0
+            simplex, active = simplex[in_hull], active[in_hull]
+        else:
+            degenerate.append(active)
+
+        degenerate = np.concatenate(degenerate)
+        if len(degenerate) > 0:
+            found_simplex[degenerate] = self._find_simplex_bruteforce(
+                xi[degenerate])
+
+        return found_simplex
+
+    def _find_simplex_bruteforce(self, xi):
+        valid_simplex = np.flatnonzero(
+            np.isfinite(self.transform).all(axis=(1, 2)))
+        found_simplex = -np.ones(len(xi), dtype=np.int64)
+        for i, point in enumerate(xi):
+            coordinates = self.barycentric(
+                valid_simplex, np.broadcast_to(point, (len(valid_simplex),
+                                                       self.ndim)))
+            is_inside = ((coordinates >= -self.eps) &
+                         (coordinates <= 1. + self.eps)).all(1)
+            if is_inside.any():
+                found_simplex[i] = valid_simplex[is_inside.argmax()]
+        return found_simplex
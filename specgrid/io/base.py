@@ -12,6 +12,8 @@ except ImportError:
 else:
     h5py_available = True
 
+from specgrid.base import GRID_FORMAT_VERSION, GridIndex
+from specgrid.plugins import interpolation_weights
 
 
 
@@ -72,7 +74,66 @@ def read_spectra(gridname, indexdf, process_plugins=[]):
 
 
 
-def make_hdf5(gridname, sql_stmt, h5_fname, ignore_columns=[]):
+def log_wavelength_grid(wavelength, log_wavelength_step=None):
+    """
+    Wavelengths equally spaced in ln(wavelength) from the first of the
+    (sorted) wavelengths to at most the last
+
+    Parameters
+    ----------
+
+    wavelength: ~numpy.ndarray
+        sorted wavelengths
+
+    log_wavelength_step: float or None
+        step in ln(wavelength), None uses the smallest step between the given
+        wavelengths so that no part of the spectrum is undersampled
+        [default None]
+
+    Returns
+    -------
+    log_wavelength: ~numpy.ndarray
+        wavelengths of the grid
+
+    log_wavelength_step: float
+    """
+    log_wavelength = np.log(wavelength)
+    if log_wavelength_step is None:
+        log_wavelength_step = np.diff(log_wavelength).min()
+    n_wavelength = int(np.floor((log_wavelength[-1] - log_wavelength[0]) /
+                                log_wavelength_step + 1e-9)) + 1
+    return (np.exp(log_wavelength[0] +
+                   log_wavelength_step * np.arange(n_wavelength)),
+            float(log_wavelength_step))
+
+
+def _write_log_wavelength_fluxes(fh, fluxes, wavelength, log_wavelength_step,
+                                 block_size=1024):
+    """
+    Write fluxes (rows of any array-like, e.g. an HDF5 dataset) resampled
+    linearly to a grid equally spaced in ln(wavelength) as ``fluxes`` into
+    the open HDF5 file fh, with the wavelengths as ``wavelength`` dataset
+    """
+    log_wavelength, log_wavelength_step = log_wavelength_grid(
+        wavelength, log_wavelength_step)
+    index, weight = interpolation_weights(wavelength, log_wavelength)
+
+    flux_dataset = fh.create_dataset(
+        'fluxes', (fluxes.shape[0], len(log_wavelength)), dtype=fluxes.dtype)
+    for start in range(0, fluxes.shape[0], block_size):
+        block = fluxes[start:start + block_size]
+        flux_dataset[start:start + block_size] = (
+            block[:, index] * (1. - weight) + block[:, index + 1] * weight)
+
+    # the wavelengths may be too large for an attribute
+    fh['wavelength'] = log_wavelength
+    flux_dataset.attrs['wavelength'] = 'wavelength'
+    flux_dataset.attrs['log_wavelength_step'] = log_wavelength_step
+    return flux_dataset
+
+
+def make_hdf5(gridname, sql_stmt, h5_fname, ignore_columns=[],
+              log_wavelength=False, log_wavelength_step=None):
     """
     Making an HDF5 File from a databased grid
 
@@ -85,6 +146,12 @@ def make_hdf5(gridname, sql_stmt, h5_fname, ignore_columns=[]):
         sql statement to query the index with
     h5_fname: ~str
         path to save HDF5 grid to
+    log_wavelength: bool
+        resample the spectra to wavelengths equally spaced in ln(wavelength),
+        which the plugins use without resampling [default False]
+    log_wavelength_step: float or None
+        step in ln(wavelength) for ``log_wavelength``, None uses the smallest
+        step of the original wavelengths [default None]
     """
 
     index_df = read_indexdb_to_dataframe(gridname, sql_stmt)
@@ -97,10 +164,84 @@ def make_hdf5(gridname, sql_stmt, h5_fname, ignore_columns=[]):
         if len(index_df[column].unique()) > 1:
             data_columns.append(column)
 
-    index_df[data_columns].to_hdf(h5_fname, 'index', mode='w')
+    grid_index = GridIndex.from_dataframe(index_df[data_columns])
 
-    with h5py.File(h5_fname, 'a') as fh:
-        fh['fluxes'] = fluxes
-        fh['fluxes'].attrs['wavelength'] = wavelength.value
+    with h5py.File(h5_fname, 'w') as fh:
+        grid_index.write(fh)
+        if log_wavelength:
+            _write_log_wavelength_fluxes(fh, fluxes, wavelength.value,
+                                         log_wavelength_step)
+        else:
+            fh['fluxes'] = fluxes
+            fh['fluxes'].attrs['wavelength'] = wavelength.value
         fh['fluxes'].attrs['wavelength.unit'] = str(wavelength.unit)
         fh['fluxes'].attrs['flux.unit'] = 'erg / (cm^2 s Angstrom)'
+
+
+def upgrade_hdf5(h5_fname):
+    """
+    Rewrite the pandas (PyTables) index of an HDF5 grid written by older
+    versions of `make_hdf5` as a native index, so that opening the grid does
+    not need pandas. Grids already in the current format are left alone.
+
+    Parameters
+    ----------
+
+    h5_fname: ~str
+        path to HDF5 grid
+    """
+
+    with h5py.File(h5_fname, 'r') as fh:
+        if fh.attrs.get('grid_format_version', 1) >= GRID_FORMAT_VERSION:
+            return
+        grid_index = GridIndex.read(fh)
+
+    with h5py.File(h5_fname, 'a') as fh:
+        del fh['index']
+        grid_index.write(fh)
+
+
+def convert_to_log_wavelength(h5_fname, log_h5_fname, log_wavelength_step=None,
+                              block_size=1024):
+    """
+    Resample an HDF5 grid to wavelengths equally spaced in ln(wavelength).
+    On such grids `~specgrid.plugins.LogGridPipeline` runs the rotation,
+    Doppler shift and resolution plugins without resampling the spectrum, as
+    long as the step is at least as fine as the plugins ask for (e.g.
+    ``1 / (sampling * R)`` for `~specgrid.plugins.InstrumentConvolve`).
+
+    Parameters
+    ----------
+
+    h5_fname: ~str
+        path to HDF5 grid made by `make_hdf5`
+
+    log_h5_fname: ~str
+        path to save the resampled HDF5 grid to
+
+    log_wavelength_step: float or None
+        step in ln(wavelength), None uses the smallest step of the original
+        wavelengths [default None]
+
+    block_size: ~int
+        number of spectra resampled at once [default 1024]
+    """
+
+    with h5py.File(h5_fname, 'r') as fh:
+        if 'fluxes' not in fh:
+            raise ValueError('{0} has no fluxes - PCA compressed grids can '
+                             'not be converted, convert the grid before '
+                             'compressing it'.format(h5_fname))
+        grid_index = GridIndex.read(fh)
+        flux_dataset = fh['fluxes']
+        wavelength = flux_dataset.attrs['wavelength']
+        if np.ndim(wavelength) == 0:
+            wavelength = fh['wavelength'][()]
+
+        with h5py.File(log_h5_fname, 'w') as log_fh:
+            grid_index.write(log_fh)
+            log_flux_dataset = _write_log_wavelength_fluxes(
+                log_fh, flux_dataset, wavelength, log_wavelength_step,
+                block_size=block_size)
+            for key in ['wavelength.unit', 'flux.unit']:
+                log_flux_dataset.attrs[key] = flux_dataset.attrs[key]
@@ -0,0 +1,225 @@
+from collections import OrderedDict
+from logging import getLogger
+
+import numpy as np
+
+try:
+    import h5py
+except ImportError:
+    h5py_available = False
+else:
+    h5py_available = True
+
+from specgrid.base import GridIndex
+
+logger = getLogger(__name__)
+
+
+def _principal_components(flux_dataset, mean, n_components, block_size,
+                          oversampling=10, n_power_iterations=2):
+    """
+    Leading principal components of the centered fluxes from a randomized
+    SVD (Halko, Martinsson & Tropp 2011). The fluxes are read block by block
+    and only arrays with n_components + oversampling rows or columns are kept
+    in memory.
+
+    Returns
+    -------
+    coefficients: ~numpy.ndarray
+        coefficients of the components for each grid point (n_points, n),
+        n <= n_components
+    components: ~numpy.ndarray
+        orthonormal components (n, n_wavelength), sorted by variance
+    """
+    n_points, n_wavelength = flux_dataset.shape
+    n_samples = min(n_components + oversampling, n_points, n_wavelength)
+
+    random_state = np.random.RandomState(0)
+    sample = _centered_product(
+        flux_dataset, mean, random_state.standard_normal(
+            (n_wavelength, n_samples)), block_size)
+    for _ in range(n_power_iterations):
+        sample = np.linalg.qr(sample)[0]
+        sample = _centered_product(flux_dataset, mean, np.linalg.qr(
+            _centered_transposed_product(flux_dataset, mean, sample,
+                                         block_size))[0], block_size)
+    sample_basis = np.linalg.qr(sample)[0]
+
+    projected = _centered_transposed_product(flux_dataset, mean,
+                                             sample_basis, block_size).T
+    singular_values, components = np.linalg.svd(projected,
+                                                full_matrices=False)[1:]
+    valid = singular_values > singular_values[0] * 1e-12
+    components = components[valid][:n_components]
+
+    # exact projections, so the reconstruction errors are exact as well
+    coefficients = _centered_product(flux_dataset, mean, components.T,
+                                     block_size)
+    return coefficients, components
+
+
+def _smallest_n_components(coefficients, residual, max_squared_error):
+    """
+    Smallest number of leading components for which the squared residual of
+    every spectrum is below max_squared_error, None if it is never reached.
+    The errors are updated one component at a time.
+    """
+    residual = residual.copy()
+    for i in range(coefficients.shape[1]):
+        residual -= coefficients[:, i] ** 2
+        if np.all(residual <= max_squared_error):
+            return i + 1
+    return None
+
+
+def make_pca_hdf5(grid_hdf5_fname, pca_hdf5_fname, n_components=None,
+                  max_relative_error=1e-3, block_size=1024):
+    """
+    Making a PCA compressed HDF5 grid from a grid made by
+    `~specgrid.io.base.make_hdf5`
+
+    The fluxes are stored as the mean spectrum, a truncated set of principal
+    components and the coefficients of each grid point.
+    `~specgrid.SpectralGrid` interpolates the coefficients and reconstructs
+    the spectrum from them, which - as interpolation is linear - is identical
+    to interpolating the reconstructed spectra.
+
+    The leading components are computed with a randomized SVD that reads the
+    fluxes block by block, doubling the number of computed components until
+    ``max_relative_error`` is met. Only arrays of the size of the computed
+    components are held in memory, so grids do not need to fit in memory.
+
+    Parameters
+    ----------
+
+    grid_hdf5_fname: ~str
+        path to the HDF5 grid to compress
+
+    pca_hdf5_fname: ~str
+        path to save the compressed HDF5 grid to
+
+    n_components: ~int or None
+        number of components to keep. If None, the smallest number for which
+        no spectrum exceeds ``max_relative_error`` is used [default None]
+
+    max_relative_error: ~float
+        largest allowed relative RMS reconstruction error of any spectrum if
+        ``n_components`` is None. The error of an all-zero spectrum is
+        relative to the mean spectrum [default 1e-3]
+
+    block_size: ~int
+        number of spectra read and processed at once [default 1024]
+
+    Returns
+    -------
+        : ~collections.OrderedDict
+        n_components, max_relative_error and mean_relative_error of the
+        reconstruction. The relative RMS error of every spectrum is also
+        stored as ``pca/relative_error`` in the compressed grid.
+    """
+
+    with h5py.File(grid_hdf5_fname, 'r') as h5file:
+        grid_index = GridIndex.read(h5file)
+        flux_dataset = h5file['fluxes']
+        flux_attrs = dict(flux_dataset.attrs)
+        wavelength = h5file['wavelength'][()] if 'wavelength' in h5file \
+            else None
+        n_points, n_wavelength = flux_dataset.shape
+
+        mean = np.zeros(n_wavelength)
+        squared_norm = np.zeros(n_points)
+        for start in range(0, n_points, block_size):
+            block = flux_dataset[start:start + block_size]
+            mean += block.sum(0)
+            squared_norm[start:start + block_size] = (block ** 2).sum(1)
+        mean /= n_points
+
+        centered_squared_norm = np.empty(n_points)
+        for start in range(0, n_points, block_size):
+            centered_squared_norm[start:start + block_size] = (
+                (flux_dataset[start:start + block_size] - mean) ** 2).sum(1)
+
+        # all-zero spectra are measured relative to the mean spectrum
+        reference_norm = np.where(squared_norm > 0, squared_norm,
+                                  (mean ** 2).sum())
+        reference_norm[reference_norm == 0] = 1.
+
+        max_rank = min(n_points, n_wavelength)
+        if n_components is not None:
+            coefficients, components = _principal_components(
+                flux_dataset, mean, n_components, block_size)
+        else:
+            # grow the number of computed components until the error is met
+            n_candidates = min(16, max_rank)
+            while True:
+                coefficients, components = _principal_components(
+                    flux_dataset, mean, n_candidates, block_size)
+                n_components = _smallest_n_components(
+                    coefficients, centered_squared_norm,
+                    max_relative_error ** 2 * reference_norm)
+                if n_components is not None:
+                    break
+                if n_candidates >= max_rank or \
+                        coefficients.shape[1] < n_candidates:
+                    n_components = coefficients.shape[1]
+                    logger.warning('Could not reach a relative error of {0} '
+                                   '- keeping all {1} components'.format(
+                        max_relative_error, n_components))
+                    break
+                n_candidates = min(2 * n_candidates, max_rank)
+        n_components = min(n_components, coefficients.shape[1])
+
+    coefficients = coefficients[:, :n_components]
+    components = components[:n_components]
+    residual = np.maximum(centered_squared_norm -
+                          np.einsum('ij,ij->i', coefficients, coefficients),
+                          0.)
+    relative_error = np.sqrt(residual / reference_norm)
+
+    with h5py.File(pca_hdf5_fname, 'w') as fh:
+        grid_index.write(fh)
+        pca_group = fh.create_group('pca')
+        pca_group['mean'] = mean
+        pca_group['components'] = components
+        pca_group['coefficients'] = coefficients
+        pca_group['relative_error'] = relative_error
+        for key, value in flux_attrs.items():
+            pca_group.attrs[key] = value
+        if wavelength is not None:
+            fh['wavelength'] = wavelength
+
+    reconstruction = OrderedDict([
+        ('n_components', n_components),
+        ('max_relative_error', relative_error.max()),
+        ('mean_relative_error', relative_error.mean())])
+
+    logger.info('Compressed {0} spectra to {1} components - relative '
+                'reconstruction error max {2:.2g} mean {3:.2g}'.format(
+        n_points, n_components, reconstruction['max_relative_error'],
+        reconstruction['mean_relative_error']))
+
+    return reconstruction
+
+
+def _centered_product(flux_dataset, mean, matrix, block_size):
+    """
+    Product of the centered fluxes (n_points, n_wavelength) with matrix
+    (n_wavelength, m), read block by block
+    """
+    result = np.empty((flux_dataset.shape[0], matrix.shape[1]))
+    for start in range(0, flux_dataset.shape[0], block_size):
+        result[start:start + block_size] = np.dot(
+            flux_dataset[start:start + block_size] - mean, matrix)
+    return result
+
+
+def _centered_transposed_product(flux_dataset, mean, matrix, block_size):
+    """
+    Product of the transposed centered fluxes (n_wavelength, n_points) with
+    matrix (n_points, m), accumulated block by block
+    """
+    result = np.zeros((flux_dataset.shape[1], matrix.shape[1]))
+    for start in range(0, flux_dataset.shape[0], block_size):
+        result += np.dot((flux_dataset[start:start + block_size] - mean).T,
+                         matrix[start:start + block_size])
+    return result
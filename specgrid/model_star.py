@@ -1,7 +1,11 @@
 from collections import OrderedDict
+
+import numpy as np
 from astropy.units import Quantity
 
 from specgrid import plugins
+from specgrid.plugins import LogGridPipeline
+from specgrid.spectrum_record import SpectrumRecord
 
 class SpecGridCompositeModel(object):
     param2model = OrderedDict()
@@ -49,7 +53,19 @@ class SpecGridCompositeModel(object):
         ``specgrid._set_parameters(logg=4.4)``
         """
 
+        for key, value in self._parse_parameters(*args, **kwargs).items():
+            setattr(self, key, value)
+
+    def _parse_parameters(self, *args, **kwargs):
+        """
+        Check parameters given either as arguments (one for each parameter)
+        or as keyword arguments
 
+        Returns
+        -------
+            : ~collections.OrderedDict
+            parameter values by name
+        """
 
         if len(args) > 0:
             if len(kwargs) > 0:
@@ -62,15 +78,24 @@ class SpecGridCompositeModel(object):
                         len(self.param_names),
                         ', '.join(self.param_names),
                         len(args)))
-            for param_name, value in zip(self.param_names, args):
-                setattr(self, param_name, value)
+            return OrderedDict(zip(self.param_names, args))
 
         for key in kwargs:
             if key not in self.param_names:
                 raise ValueError('{0} not a parameter of the current '
                                  'observation (param_names are {1})'.format(
                     key, ','.join(self.param_names)))
-            setattr(self, key, kwargs[key])
+        return OrderedDict(kwargs)
+
+    def _grid_contains(self, spectral_grid, *args, **kwargs):
+        """
+        Check if the grid parameters among the given parameters are inside
+        spectral_grid, without evaluating the model
+        """
+        parameters = self._parse_parameters(*args, **kwargs)
+        return spectral_grid.contains(
+            **OrderedDict((key, value) for key, value in parameters.items()
+                          if key in spectral_grid.param_names))
 
     def __call__(self, spectrum):
 
@@ -79,6 +104,75 @@ class SpecGridCompositeModel(object):
 
         return spectrum
 
+    def _provides_jacobian(self, spectral_grid, plugins):
+        return (hasattr(spectral_grid, 'evaluate_with_jacobian') and
+                all(getattr(plugin, 'flux_linear', False)
+                    for plugin in plugins))
+
+    def _pipeline_jacobian(self, spectral_grid, plugins, jacobian_names):
+        """
+        Evaluate spectral_grid and plugins through ``self.pipeline`` with the
+        current parameters, together with the derivatives of the flux with
+        respect to jacobian_names. The plugins have to be linear in the flux
+        (``flux_linear``), so the derivatives with respect to the grid
+        parameters are the derivatives of the grid passed through the same
+        plugins. Derivatives with respect to plugin parameters are forward
+        differences, taken in double precision also for single precision grids.
+
+        Returns
+        -------
+        spectrum: ~specgrid.spectrum_record.SpectrumRecord
+
+        jacobian: ~astropy.units.Quantity
+            derivatives with shape (len(jacobian_names), n_wavelength)
+        """
+        grid_spectrum, grid_jacobian = spectral_grid.evaluate_with_jacobian()
+        grid_record = SpectrumRecord.from_spectrum1d(grid_spectrum)
+        log_wavelength_step = spectral_grid.log_wavelength_step
+        evaluate = lambda record: self.pipeline(record, plugins,
+                                                log_wavelength_step)
+        spectrum = evaluate(grid_record)
+
+        jacobian = np.empty((len(jacobian_names), len(spectrum.flux)),
+                            dtype=spectrum.flux.dtype)
+        double_record = grid_record.replace(
+            flux=grid_record.flux.astype(np.float64))
+        double_flux = None
+        for i, name in enumerate(jacobian_names):
+            if name in spectral_grid.param_names:
+                grid_row = grid_jacobian[spectral_grid.param_names.index(
+                    name)].to(grid_record.flux_unit).value
+                jacobian[i] = evaluate(grid_record.replace(
+                    flux=grid_row.astype(grid_record.flux.dtype,
+                                         copy=False))).flux
+                continue
+
+            if double_flux is None:
+                double_flux = evaluate(double_record).flux
+            value = getattr(self, name)
+            plain_value = getattr(value, 'value', value)
+            # the plugins resample the flux piecewise linearly, so the step
+            # is kept well above the double precision one of
+            # scipy.optimize.leastsq to smooth over the pixel boundaries
+            step = 1e-4 * max(abs(plain_value), 1.)
+            setattr(self, name, plain_value + step)
+            try:
+                jacobian[i] = (evaluate(double_record).flux -
+                               double_flux) / step
+            finally:
+                setattr(self, name, value)
+        return spectrum, jacobian * spectrum.flux_unit
+
+    def _jacobian_not_provided(self, spectral_grid, plugins):
+        non_linear = [plugin.__class__.__name__ for plugin in plugins
+                      if not getattr(plugin, 'flux_linear', False)]
+        if non_linear:
+            return ValueError('Derivatives are only propagated through '
+                              'plugins linear in the flux - not through '
+                              '{0}'.format(', '.join(non_linear)))
+        return ValueError('{0} provides no derivatives'.format(
+            spectral_grid.__class__.__name__))
+
 class ModelStar(SpecGridCompositeModel):
     """
     A model star combines a normal spectral grid (~specgrid.SpectralGrid) with a
@@ -96,17 +190,23 @@ class ModelStar(SpecGridCompositeModel):
         self.spectral_grid = spectral_grid
         super(ModelStar, self).__init__([spectral_grid] + plugins)
         self.models = self.models[1:]
+        self.pipeline = LogGridPipeline()
 
     def __call__(self):
         """
         Evaluate the spectrum with the current param_names
         """
-        spectrum = self.spectral_grid()
-
-        for model in self.models:
-            spectrum = model(spectrum)
+        return self._evaluate_record().to_spectrum1d()
 
-        return spectrum
+    def _evaluate_record(self, *args, **kwargs):
+        """
+        Set the given parameters (like `evaluate`) and evaluate the spectrum
+        as `~specgrid.spectrum_record.SpectrumRecord`
+        """
+        self._set_parameters(*args, **kwargs)
+        return self.pipeline(self.spectral_grid._evaluate_record(),
+                             self.models,
+                             self.spectral_grid.log_wavelength_step)
 
     def evaluate(self, *args, **kwargs):
         """
@@ -124,6 +224,50 @@ class ModelStar(SpecGridCompositeModel):
 
         return self.__call__()
 
+    @property
+    def provides_jacobian(self):
+        """
+        True if `evaluate_with_jacobian` is available: the grid has
+        derivatives and all plugins are linear in the flux
+        """
+        return self._provides_jacobian(self.spectral_grid, self.models)
+
+    def evaluate_with_jacobian(self, *args, **kwargs):
+        """
+        Evaluate the spectrum like `evaluate` together with the derivative of
+        the flux with respect to each parameter (see
+        `~specgrid.SpectralGrid.evaluate_with_jacobian`). Derivatives of the
+        grid are passed through the plugins, derivatives with respect to
+        plugin parameters are forward differences. Only available if
+        `provides_jacobian`.
+
+        Returns
+        -------
+        spectrum: ~Spectrum1D
+
+        jacobian: ~astropy.units.Quantity
+            shape (n_params, n_wavelength), the rows ordered as in
+            ``param_names``
+        """
+        spectrum, jacobian = self._evaluate_record_with_jacobian(
+            self.param_names, *args, **kwargs)
+        return spectrum.to_spectrum1d(), jacobian
+
+    def _evaluate_record_with_jacobian(self, jacobian_names, *args,
+                                       **kwargs):
+        if not self.provides_jacobian:
+            raise self._jacobian_not_provided(self.spectral_grid, self.models)
+        self._set_parameters(*args, **kwargs)
+        return self._pipeline_jacobian(self.spectral_grid, self.models,
+                                       jacobian_names)
+
+    def contains(self, *args, **kwargs):
+        """
+        Check if the parameters are inside the spectral grid without
+        evaluating the model (see `~specgrid.SpectralGrid.contains`)
+        """
+        return self._grid_contains(self.spectral_grid, *args, **kwargs)
+
     def __repr__(self):
 
         param_str = '\n'.join(['{0} {1}'.format(key, value)
@@ -156,16 +300,63 @@ class ModelInstrument(SpecGridCompositeModel):
 
 
 class Observation(SpecGridCompositeModel):
-    def __init__(self, model_star, model_instrument):
+    """
+    An observation combines a model star (~specgrid.ModelStar) with a model
+    instrument (~specgrid.ModelInstrument)
+
+    Parameters
+    ----------
+
+    model_star: ~specgrid.ModelStar
+
+    model_instrument: ~specgrid.ModelInstrument
+
+    dtype: ~numpy.dtype or None
+        dtype all plugins compute the flux in, e.g. ``np.float32``. None lets
+        each plugin follow the dtype of its input (set the dtype of the
+        ~specgrid.SpectralGrid to keep a whole evaluation in single
+        precision) [default None]
+    """
+
+    def __init__(self, model_star, model_instrument, dtype=None):
         self.model_star = model_star
         self.model_instrument = model_instrument
 
         self.param2model = self.model_star.param2model.copy()
         self.param2model.update(self.model_instrument.param2model.copy())
+        self.pipeline = LogGridPipeline()
+        if dtype is not None:
+            self.dtype = dtype
+
+    @property
+    def dtype(self):
+        return getattr(self, '_dtype', None)
+
+    @dtype.setter
+    def dtype(self, value):
+        self._dtype = value
+        for plugin in self.all_plugins:
+            if hasattr(plugin, 'dtype'):
+                plugin.dtype = value
 
     def __call__(self):
-        spectrum = self.model_star()
-        return self.model_instrument(spectrum)
+        return self._evaluate_record().to_spectrum1d()
+
+    def _evaluate_record(self, *args, **kwargs):
+        """
+        Set the given parameters (like `evaluate`) and evaluate the
+        observation as `~specgrid.spectrum_record.SpectrumRecord`, which
+        avoids building `Spectrum1D` objects inside fitting loops. The star
+        and instrument plugins run as one
+        `~specgrid.plugins.LogGridPipeline`, so the spectrum is only
+        resampled onto a log(wavelength) grid and to the observed wavelengths
+        once.
+        """
+        self._set_parameters(*args, **kwargs)
+        spectral_grid = self.model_star.spectral_grid
+        return self.pipeline(spectral_grid._evaluate_record(),
+                             self.all_plugins,
+                             spectral_grid.log_wavelength_step)
 
     @property
     def all_plugins(self):
@@ -175,8 +366,45 @@ class Observation(SpecGridCompositeModel):
         return "Model Observation:\n\n{0}\n\n{1}".format(self.model_star, self.model_instrument)
 
     def evaluate(self, *args, **kwargs):
+        return self._evaluate_record(*args, **kwargs).to_spectrum1d()
+
+    @property
+    def provides_jacobian(self):
+        """
+        True if `evaluate_with_jacobian` is available: the grid has
+        derivatives and all plugins are linear in the flux (e.g. no
+        `~specgrid.plugins.Normalize`)
+        """
+        return self._provides_jacobian(self.model_star.spectral_grid,
+                                       self.all_plugins)
+
+    def evaluate_with_jacobian(self, *args, **kwargs):
+        """
+        Evaluate the observation like `evaluate` together with the
+        derivative of the flux with respect to each parameter (see
+        `~specgrid.ModelStar.evaluate_with_jacobian`). Only available if
+        `provides_jacobian`.
+        """
+        spectrum, jacobian = self._evaluate_record_with_jacobian(
+            self.param_names, *args, **kwargs)
+        return spectrum.to_spectrum1d(), jacobian
+
+    def _evaluate_record_with_jacobian(self, jacobian_names, *args,
+                                       **kwargs):
+        spectral_grid = self.model_star.spectral_grid
+        if not self.provides_jacobian:
+            raise self._jacobian_not_provided(spectral_grid, self.all_plugins)
         self._set_parameters(*args, **kwargs)
-        return self.model_instrument(self.model_star())
+        return self._pipeline_jacobian(spectral_grid, self.all_plugins,
+                                       jacobian_names)
+
+    def contains(self, *args, **kwargs):
+        """
+        Check if the parameters are inside the spectral grid without
+        evaluating the model (see `~specgrid.SpectralGrid.contains`)
+        """
+        return self._grid_contains(self.model_star.spectral_grid, *args,
+                                   **kwargs)
 
 def assemble_observation(spectral_grid, plugin_names=[], spectrum=None, normalize_npol=None, ):
     """
@@ -2,16 +2,566 @@ import warnings
 from collections import OrderedDict
 
 
-import scipy.ndimage as nd
-
 import numpy as np
 from numpy.polynomial import Polynomial
+from scipy import sparse
 
 import astropy.units as u
 import astropy.constants as const
 from fix_spectrum1d import Spectrum1D
+from spectrum_record import SpectrumRecord, spectrum_record_call
+from cache import LRUCache
+from convolution import Convolver, gaussian_kernel, variable_gaussian_matrix
+
+# speed of light for unit-free velocity arithmetic in the plugins
+c_kms = const.c.to(u.km / u.s).value
+
+
+def compute_dtype(plugin, flux):
+    """
+    dtype a plugin computes its output flux in: the ``dtype`` set on the
+    plugin or, if that is None, the dtype of the incoming flux
+    """
+    if plugin.dtype is None:
+        return flux.dtype
+    else:
+        return np.dtype(plugin.dtype)
+
+
+def interpolation_weights(xp, x):
+    """
+    Indices and weights for linear interpolation from the sorted points xp to
+    x. Points outside xp take the first or last value, as in `numpy.interp`.
+
+    Returns
+    -------
+    index: ~numpy.ndarray
+        index of the left neighbour in xp for each point of x
+    weight: ~numpy.ndarray
+        weight of the right neighbour for each point of x
+    """
+    # fractional position of x in xp - numpy.interp searches sorted x much
+    # faster than numpy.searchsorted
+    position = np.interp(x, xp, np.arange(len(xp), dtype=float))
+    index = np.minimum(position.astype(int), len(xp) - 2)
+    return index, position - index
+
+
+def fractional_shift(flux, shift):
+    """
+    Shift flux by a fractional number of pixels towards larger indices,
+    interpolating with a four point cubic (Lagrange) stencil. Beyond its ends
+    the spectrum is continued with the first or last value.
+
+    Parameters
+    ----------
+
+    flux: ~numpy.ndarray
+        1D spectrum
+
+    shift: float
+        shift in pixels
+
+    Returns
+    -------
+        : ~numpy.ndarray
+        shifted spectrum in the dtype of flux
+    """
+    # pixel i takes the value at i - shift = i + offset + t, interpolated
+    # from pixels i + offset - 1 ... i + offset + 2
+    offset = int(np.floor(-shift))
+    t = -shift - offset
+    weights = np.array([-t * (t - 1) * (t - 2) / 6.,
+                        (t + 1) * (t - 1) * (t - 2) / 2.,
+                        -(t + 1) * t * (t - 2) / 2.,
+                        (t + 1) * t * (t - 1) / 6.])
+
+    n = len(flux)
+    shifted = np.empty_like(flux)
+    # pixels whose stencil lies inside the spectrum, without temporaries
+    start = min(max(1 - offset, 0), n)
+    stop = max(min(n - 2 - offset, n), start)
+    interior = shifted[start:stop]
+    product = np.empty_like(interior)
+    first = start + offset - 1
+    np.multiply(flux[first:first + len(interior)], weights[0], out=interior)
+    for i in range(1, 4):
+        np.multiply(flux[first + i:first + i + len(interior)], weights[i],
+                    out=product)
+        interior += product
+
+    edges = np.concatenate((np.arange(start), np.arange(stop, n)))
+    stencil = np.clip(edges[:, np.newaxis] + offset - 1 + np.arange(4),
+                      0, n - 1)
+    shifted[edges] = np.dot(flux[stencil], weights)
+    return shifted
+
+
+class LogWavelengthResampler(object):
+    """
+    Linear interpolation of fluxes from a wavelength array onto a grid
+    equally spaced in log(wavelength) and back, with the interpolation
+    indices and weights of both directions precomputed
+
+    Parameters
+    ----------
+
+    wavelength: ~numpy.ndarray
+        sorted wavelengths of the input fluxes
+
+    log_step: float
+        step of the grid in log(wavelength)
+    """
+
+    def __init__(self, wavelength, log_step):
+        self.wavelength = np.array(wavelength)
+        self.log_step = log_step
+        self.log_grid_wavelength = np.exp(np.arange(
+            np.log(self.wavelength.min()), np.log(self.wavelength.max()),
+            log_step))
+        self._to_log_grid = interpolation_weights(self.wavelength,
+                                                  self.log_grid_wavelength)
+        self._from_log_grid = interpolation_weights(self.log_grid_wavelength,
+                                                    self.wavelength)
+
+    def matches(self, wavelength, log_step):
+        """
+        Check if the resampler was built for these wavelengths and step
+        """
+        return (log_step == self.log_step and
+                wavelength.shape == self.wavelength.shape and
+                np.array_equal(wavelength, self.wavelength))
+
+    @staticmethod
+    def _interpolate(flux, index, weight):
+        return flux[index] * (1. - weight) + flux[index + 1] * weight
+
+    def to_log_grid(self, flux):
+        return self._interpolate(flux, *self._to_log_grid)
+
+    def from_log_grid(self, log_grid_flux):
+        return self._interpolate(log_grid_flux, *self._from_log_grid)
+
+
+def same_wavelength(wavelength, other_wavelength):
+    """
+    Check if two wavelength arrays are equal, comparing the ends first as
+    Doppler shifted arrays differ everywhere
+    """
+    return (wavelength.shape == other_wavelength.shape and
+            wavelength[0] == other_wavelength[0] and
+            wavelength[-1] == other_wavelength[-1] and
+            np.array_equal(wavelength, other_wavelength))
+
+
+class RepeatedWavelengthCache(object):
+    """
+    One object (e.g. interpolation weights) built for an array of
+    wavelengths and a key. It is only built once the same wavelengths and
+    key are asked for twice in a row, so wavelengths that change with every
+    call (like Doppler shifted ones) never pay for building it.
+    """
+
+    def __init__(self):
+        self.clear()
+
+    def clear(self):
+        self._wavelength = None
+        self._key = None
+        self._value = None
+        self._previous = None
+
+    def get(self, wavelength, key, build, build_now=False):
+        """
+        Object for wavelength and key, or None if it is not built (yet)
+
+        Parameters
+        ----------
+
+        wavelength: ~numpy.ndarray
+
+        key:
+            anything else the object depends on, compared with ==
+
+        build: callable
+            called without arguments to build the object
+
+        build_now: bool
+            build the object on the first request [default False]
+        """
+        if self._value is not None and key == self._key and \
+                same_wavelength(wavelength, self._wavelength):
+            return self._value
+
+        previous = self._previous
+        self._previous = (wavelength, key)
+        if not build_now and (previous is None or key != previous[1] or
+                              not same_wavelength(wavelength, previous[0])):
+            return None
+
+        self._wavelength = np.array(wavelength)
+        self._key = key
+        self._value = build()
+        self._previous = None
+        return self._value
+
+
+def convolve_rebin_matrix(wavelength, output_wavelength, kernel):
+    """
+    Sparse matrix that convolves a spectrum with kernel (odd length, centred
+    on the middle pixel, reflecting the spectrum at the edges like
+    `~specgrid.convolution.Convolver`) and interpolates the result linearly
+    to output_wavelength in one product
+
+    Parameters
+    ----------
+
+    wavelength: ~numpy.ndarray
+        sorted wavelengths of the spectrum, uniform in the coordinate the
+        kernel is sampled in (e.g. log(wavelength))
+
+    output_wavelength: ~numpy.ndarray
+        sorted wavelengths to interpolate to
+
+    kernel: ~numpy.ndarray
+
+    Returns
+    -------
+        : ~scipy.sparse.csr_matrix
+        matrix with shape (len(output_wavelength), len(wavelength))
+    """
+    n = len(wavelength)
+    index, weight = interpolation_weights(wavelength, output_wavelength)
+    half = len(kernel) // 2
+
+    # row j combines the convolved pixels index[j] and index[j] + 1, each a
+    # sum over the kernel
+    offsets = half - np.arange(len(kernel))
+    columns = np.concatenate((index[:, np.newaxis] + offsets,
+                              index[:, np.newaxis] + 1 + offsets), axis=1)
+    data = np.concatenate(((1. - weight)[:, np.newaxis] * kernel,
+                           weight[:, np.newaxis] * kernel), axis=1)
+    columns = np.where(columns < 0, -columns - 1, columns)
+    columns = np.where(columns >= n, 2 * n - columns - 1, columns)
+    columns = np.clip(columns, 0, n - 1)
+
+    rows = np.repeat(np.arange(len(index)), columns.shape[1])
+    return sparse.csr_matrix((data.ravel(), (rows, columns.ravel())),
+                             shape=(len(index), n))
+
+
+class WavelengthRebinner(object):
+    """
+    Resampling of fluxes from one wavelength array to another with the
+    interpolation indices and weights precomputed, so each call is a gather
+    and a multiply-add
+
+    By default the fluxes are interpolated linearly (like `numpy.interp`).
+    Flux conserving rebinning instead averages the linearly interpolated
+    input over each output pixel, bounded by the midpoints to its neighbours,
+    so no input pixel is skipped when the output is coarser than the input.
+    Output pixels beyond the input take the first or last value.
+
+    Parameters
+    ----------
+
+    wavelength: ~numpy.ndarray
+        sorted wavelengths of the input fluxes
+
+    output_wavelength: ~numpy.ndarray
+        sorted wavelengths to resample to (in the unit of wavelength)
+
+    flux_conserving: bool
+        average over the output pixels instead of interpolating at their
+        centres [default False]
+    """
+
+    def __init__(self, wavelength, output_wavelength, flux_conserving=False):
+        self.wavelength = np.array(wavelength)
+        self.flux_conserving = flux_conserving
+
+        if not flux_conserving:
+            self._weights = interpolation_weights(self.wavelength,
+                                                  output_wavelength)
+            return
+
+        # pixel edges, clipped to the input
+        edges = np.concatenate((
+            [1.5 * output_wavelength[0] - 0.5 * output_wavelength[1]],
+            0.5 * (output_wavelength[1:] + output_wavelength[:-1]),
+            [1.5 * output_wavelength[-1] - 0.5 * output_wavelength[-2]]))
+        edges = np.clip(edges, self.wavelength[0], self.wavelength[-1])
+        self._widths = np.diff(edges)
+        outside = self._widths == 0
+        self._outside = np.flatnonzero(outside)
+        self._outside_source = np.where(
+            edges[:-1][outside] <= self.wavelength[0], 0,
+            len(self.wavelength) - 1)
+        self._widths[outside] = 1.
+
+        # the integral of the interpolated flux up to an edge in segment i is
+        # cumulative[i] + flux[i] * left + flux[i + 1] * right
+        self._steps = np.diff(self.wavelength)
+        index, fraction = interpolation_weights(self.wavelength, edges)
+        self._edge_index = index
+        self._edge_left = self._steps[index] * (fraction - 0.5 * fraction**2)
+        self._edge_right = self._steps[index] * 0.5 * fraction**2
+
+    def __call__(self, flux):
+        if not self.flux_conserving:
+            return LogWavelengthResampler._interpolate(flux, *self._weights)
+
+        flux = flux.astype(np.float64, copy=False)
+        cumulative = np.empty(len(flux))
+        cumulative[0] = 0.
+        np.cumsum(0.5 * self._steps * (flux[:-1] + flux[1:]),
+                  out=cumulative[1:])
+
+        index = self._edge_index
+        integral = (cumulative[index] + flux[index] * self._edge_left +
+                    flux[index + 1] * self._edge_right)
+        rebinned = np.diff(integral) / self._widths
+        rebinned[self._outside] = flux[self._outside_source]
+        return rebinned
+
+
+class LogGridSpectrum(object):
+    """
+    Spectrum sampled uniformly in log(wavelength) that is passed between
+    consecutive plugins by `LogGridPipeline`
+
+    Parameters
+    ----------
+
+    spectrum: ~specgrid.spectrum_record.SpectrumRecord
+        spectrum on the log(wavelength) grid
+
+    log_step: float
+        step of the grid in log(wavelength)
+
+    wavelength: ~numpy.ndarray or None
+        wavelengths (in the unit of spectrum) the spectrum is resampled back
+        to after the last plugin - Doppler shifts scale both. None if the
+        spectrum stays on its grid (grids stored uniform in log(wavelength)),
+        in which case Doppler shifts move the flux along the grid instead
+    """
+
+    __slots__ = ('spectrum', 'log_step', 'wavelength')
+
+    def __init__(self, spectrum, log_step, wavelength):
+        self.spectrum = spectrum
+        self.log_step = log_step
+        self.wavelength = wavelength
+
+
+class LogGridPipeline(object):
+    """
+    Apply a sequence of plugins to a `~specgrid.spectrum_record.SpectrumRecord`
+
+    Consecutive plugins that can work on a spectrum sampled uniformly in
+    log(wavelength) (those with a ``log_grid_call`` method) share a single
+    such grid: the spectrum is resampled onto it once, with the finest step
+    any of them asks for (``log_grid_step``), and resampled back only if the
+    next plugin does not resample the spectrum anyway (like `Interpolate`).
+    The resamplers for the last few grids are cached.
+
+    Spectra from grids that are already uniform in log(wavelength) (see
+    `~specgrid.io.base.convert_to_log_wavelength`) are not resampled at all
+    if the grid step is at least as fine as the plugins ask for. Doppler
+    shifts then move the flux along the fixed grid, so the wavelengths
+    reaching the next plugin do not change between evaluations.
+
+    Parameters
+    ----------
+
+    max_resamplers: int
+        number of cached `LogWavelengthResampler` [default 8]
+    """
+
+    # grid steps are rounded down to 2 ** (n / steps_per_octave), so that
+    # steps changing with a fitted parameter (e.g. R) reuse cached grids
+    steps_per_octave = 8
+
+    def __init__(self, max_resamplers=8):
+        self.max_resamplers = max_resamplers
+        self._resamplers = OrderedDict()
+
+    def __call__(self, spectrum, plugins, log_wavelength_step=None):
+        """
+        Apply plugins to spectrum
+
+        Parameters
+        ----------
+
+        spectrum: ~specgrid.spectrum_record.SpectrumRecord
+
+        plugins: list
+            plugins in the order they are applied
+
+        log_wavelength_step: float or None
+            step in ln(wavelength) if spectrum is uniform in log(wavelength),
+            None otherwise [default None]
+        """
+        start = 0
+        while start < len(plugins):
+            stop = start
+            while stop < len(plugins) and hasattr(plugins[stop],
+                                                  'log_grid_call'):
+                stop += 1
+            log_steps = [plugin.log_grid_step
+                         for plugin in plugins[start:stop]
+                         if plugin.log_grid_step is not None]
+            next_plugin = plugins[stop] if stop < len(plugins) else None
+
+            if log_wavelength_step is not None and stop > start and \
+                    log_wavelength_step <= min(log_steps + [np.inf]):
+                log_grid_spectrum = LogGridSpectrum(
+                    spectrum, log_wavelength_step, None)
+                observed_spectrum = self._apply_log_grid_plugins(
+                    log_grid_spectrum, plugins[start:stop], next_plugin)
+                spectrum = log_grid_spectrum.spectrum
+            elif log_steps:
+                spectrum, observed_spectrum = self._log_grid_call(
+                    spectrum, plugins[start:stop], min(log_steps),
+                    next_plugin)
+                log_wavelength_step = None
+            else:
+                spectrum = plugins[start](spectrum)
+                start += 1
+                log_wavelength_step = None
+                continue
+
+            start = stop
+            if observed_spectrum is not None:
+                # the next plugin was applied together with the last one
+                spectrum = observed_spectrum
+                start += 1
+                log_wavelength_step = None
+
+        return spectrum
+
+    def quantize_log_step(self, log_step):
+        return 2 ** (np.floor(np.log2(log_step) * self.steps_per_octave) /
+                     self.steps_per_octave)
+
+    def resampler(self, wavelength, log_step):
+        """
+        `LogWavelengthResampler` from wavelength to a grid with log_step
+        """
+        resampler = self._resamplers.pop(log_step, None)
+        if resampler is None or not resampler.matches(wavelength, log_step):
+            resampler = LogWavelengthResampler(wavelength, log_step)
+            if len(self._resamplers) >= self.max_resamplers:
+                self._resamplers.popitem(last=False)
+        self._resamplers[log_step] = resampler
+        return resampler
+
+    @staticmethod
+    def _apply_log_grid_plugins(log_grid_spectrum, plugins, next_plugin):
+        """
+        Apply plugins to log_grid_spectrum in place. A convolution at the end
+        (a plugin with ``log_grid_kernel`` and a
+        `~specgrid.convolution.Convolver`) followed by an interpolation to
+        the observed wavelengths (a plugin with ``convolve_rebinner``, i.e.
+        `Interpolate`) is done as one sparse matrix product where the matrix
+        is cached and cheaper than the convolution, which skips convolving
+        pixels that are not observed.
+
+        Returns
+        -------
+            : ~specgrid.spectrum_record.SpectrumRecord or None
+            the spectrum on the observed wavelengths if next_plugin was
+            applied as well, None otherwise
+        """
+        last_plugin = plugins[-1]
+        fuse = (hasattr(last_plugin, 'log_grid_kernel') and
+                hasattr(next_plugin, 'convolve_rebinner'))
+        for plugin in plugins[:-1] if fuse else plugins:
+            plugin.log_grid_call(log_grid_spectrum)
+        if not fuse:
+            return None
+
+        spectrum = log_grid_spectrum.spectrum
+        kernel = last_plugin.log_grid_kernel(log_grid_spectrum.log_step)
+        convolve_rebinner = None
+        if kernel is not None:
+            # the matrix has about len(kernel) + 1 entries per observed pixel
+            n_observed = len(next_plugin.observed_wavelength_in(
+                spectrum.wavelength_unit))
+            if n_observed * (len(kernel) + 1) < last_plugin.convolver.cost(
+                    len(spectrum.flux), len(kernel)):
+                convolve_rebinner = next_plugin.convolve_rebinner(
+                    spectrum.wavelength, spectrum.wavelength_unit, kernel)
+        if convolve_rebinner is None:
+            last_plugin.log_grid_call(log_grid_spectrum)
+            return None
+
+        flux = spectrum.flux.astype(compute_dtype(last_plugin, spectrum.flux),
+                                    copy=False)
+        return next_plugin.observed_record(convolve_rebinner.dot(flux), flux)
+
+    def _log_grid_call(self, spectrum, plugins, log_step, next_plugin):
+        """
+        Resample spectrum to a log(wavelength) grid with (at most) log_step,
+        apply plugins on it and resample it back unless next_plugin resamples
+        anyway
+
+        Returns
+        -------
+        spectrum: ~specgrid.spectrum_record.SpectrumRecord
+
+        observed_spectrum: ~specgrid.spectrum_record.SpectrumRecord or None
+            see `_apply_log_grid_plugins`
+        """
+        log_step = self.quantize_log_step(log_step)
+        resampler = self.resampler(spectrum.wavelength, log_step)
+        dtype = spectrum.flux.dtype
+
+        log_grid_spectrum = LogGridSpectrum(
+            spectrum.replace(wavelength=resampler.log_grid_wavelength,
+                             flux=resampler.to_log_grid(
+                                 spectrum.flux).astype(dtype, copy=False)),
+            log_step, spectrum.wavelength)
+        observed_spectrum = self._apply_log_grid_plugins(
+            log_grid_spectrum, plugins, next_plugin)
+
+        spectrum = log_grid_spectrum.spectrum
+        if observed_spectrum is None and \
+                not getattr(next_plugin, 'resamples', False):
+            # Doppler shifts scale the log grid and the wavelengths to return
+            # to alike, so the interpolation weights stay valid
+            spectrum = spectrum.replace(
+                wavelength=log_grid_spectrum.wavelength,
+                flux=resampler.from_log_grid(spectrum.flux).astype(
+                    spectrum.flux.dtype, copy=False))
+        return spectrum, observed_spectrum
+
 
 class RotationalBroadening(object):
+    """
+    Broaden the spectrum with a rotational profile with limb darkening
+
+    The log(wavelength) grid the profile is applied on and the interpolation
+    onto it are cached for the last input wavelengths, and the profiles in an
+    LRU cache keyed on (vrot, limb_darkening, resolution), so repeated calls on
+    the same grid wavelengths only cost the convolution.
+
+    Parameters
+    ----------
+
+    profile_cache_bytes: int
+        byte budget of the profile cache [default 1 MB]
+
+    convolution: str
+        convolution method of `~specgrid.convolution.Convolver`: 'auto',
+        'direct' or 'fft'. 'auto' switches to FFT convolution for the wide
+        profiles of fast rotators [default 'auto']
+    """
+
+    def __init__(self, profile_cache_bytes=2**20, convolution='auto'):
+        self.profile_cache = LRUCache(profile_cache_bytes)
+        self.convolver = Convolver(convolution)
+        self._resampler = None
 
     @property
     def vrot(self):
@@ -25,13 +575,20 @@ class RotationalBroadening(object):
     resolution = (20 * u.km / u.s / const.c).to(1)
     limb_darkening = 0.6
     param_names = ['vrot']
-
-    def rotational_profile(self):
-        vrot_by_c = (np.maximum(0.1 * u.m / u.s, np.abs(self.vrot)) /
-                     const.c).to(1)
-        half_width = np.round(vrot_by_c / self.resolution).astype(int)
+    flux_linear = True
+    dtype = None
+
+    def rotational_profile(self, resolution=None):
+        """
+        Rotational profile sampled with a velocity step of resolution (in
+        units of c), by default ``resolution``
+        """
+        if resolution is None:
+            resolution = self.resolution.value
+        vrot_by_c = max(1e-4, np.abs(self.vrot.value)) / c_kms
+        half_width = int(np.round(vrot_by_c / resolution))
         profile_velocity = np.linspace(-half_width, half_width,
-                                       2 * half_width + 1) * self.resolution
+                                       2 * half_width + 1) * resolution
         profile = np.maximum(0.,
                              1. - (profile_velocity / vrot_by_c) ** 2)
         profile = ((2 * (1-self.limb_darkening) * np.sqrt(profile) +
@@ -39,24 +596,67 @@ class RotationalBroadening(object):
                    (np.pi * vrot_by_c * (1.-self.limb_darkening/3.)))
         return profile/profile.sum()
 
+    def cached_rotational_profile(self, resolution=None):
+        """
+        `rotational_profile` from the profile cache
+        """
+        if resolution is None:
+            resolution = self.resolution.value
+        key = (self.vrot.value, self.limb_darkening, resolution)
+        profile = self.profile_cache.get(key)
+        if profile is None:
+            profile = self.rotational_profile(resolution)
+            self.profile_cache.put(key, profile)
+        return profile
+
+    @property
+    def log_grid_step(self):
+        if self.vrot.value == 0.0:
+            return None
+        return self.resolution.value
+
+    def log_grid_call(self, log_grid_spectrum):
+        """
+        Broaden a `LogGridSpectrum` in place, with the profile sampled on its
+        grid
+        """
+        if self.vrot.value == 0.0:
+            return
+
+        spectrum = log_grid_spectrum.spectrum
+        dtype = compute_dtype(self, spectrum.flux)
+        profile = self.cached_rotational_profile(
+            log_grid_spectrum.log_step).astype(dtype, copy=False)
+        log_grid_spectrum.spectrum = spectrum.replace(flux=self.convolver(
+            spectrum.flux.astype(dtype, copy=False), profile))
+
+    def log_wavelength_resampler(self, wavelength):
+        """
+        `LogWavelengthResampler` for wavelength with a step of
+        ``resolution``, reused while the wavelengths do not change
+        """
+        resampler = self._resampler
+        if resampler is None or not resampler.matches(wavelength,
+                                                      self.resolution.value):
+            resampler = LogWavelengthResampler(wavelength,
+                                               self.resolution.value)
+            self._resampler = resampler
+        return resampler
+
+    @spectrum_record_call
     def __call__(self, spectrum):
-        if np.isclose(self.vrot, 0.0 * u.km / u.s, atol=0.0 * u.km / u.s):
+        if self.vrot.value == 0.0:
             return spectrum
 
-        wavelength, flux = spectrum.wavelength.value, spectrum.flux
-        log_grid_log_wavelength = np.arange(np.log(wavelength.min()),
-                                            np.log(wavelength.max()),
-                                            self.resolution.to(1).value)
-        log_grid_wavelength = np.exp(log_grid_log_wavelength)
-        log_grid_flux = np.interp(log_grid_wavelength, wavelength, flux)
-        profile = self.rotational_profile()
-        log_grid_convolved = nd.convolve1d(log_grid_flux, profile)
-        convolved_flux = np.interp(wavelength, log_grid_wavelength,
-                                   log_grid_convolved)
-        return Spectrum1D.from_array(spectrum.wavelength,
-                                     convolved_flux,
-                                     dispersion_unit=spectrum.wavelength.unit,
-                                     unit=spectrum.unit)
+        flux = spectrum.flux
+        dtype = compute_dtype(self, flux)
+        resampler = self.log_wavelength_resampler(spectrum.wavelength)
+        log_grid_flux = resampler.to_log_grid(flux).astype(dtype, copy=False)
+        profile = self.cached_rotational_profile().astype(dtype, copy=False)
+        log_grid_convolved = self.convolver(log_grid_flux, profile)
+        convolved_flux = resampler.from_log_grid(log_grid_convolved).astype(
+            dtype, copy=False)
+        return spectrum.replace(flux=convolved_flux)
 
 
 class DopplerShift(object):
@@ -70,11 +670,39 @@ class DopplerShift(object):
         self._vrad = u.Quantity(value, u.km / u.s)
 
     param_names = ['vrad']
+    flux_linear = True
+    dtype = None
+
+    log_grid_step = None
 
+    @spectrum_record_call
     def __call__(self, spectrum):
-        doppler_factor = 1. + (self.vrad / const.c)
-        return Spectrum1D.from_array(spectrum.wavelength * doppler_factor,
-                                     spectrum.flux)
+        doppler_factor = 1. + self.vrad.value / c_kms
+        return spectrum.replace(
+            wavelength=spectrum.wavelength * doppler_factor,
+            flux=spectrum.flux.astype(compute_dtype(self, spectrum.flux),
+                                      copy=False))
+
+    def log_grid_call(self, log_grid_spectrum):
+        """
+        Shift a `LogGridSpectrum` in place - a shift keeps the grid uniform
+        in log(wavelength). If the spectrum stays on its grid, the flux is
+        moved by ln(1 + vrad / c) / log_step pixels with `fractional_shift`.
+        """
+        doppler_factor = 1. + self.vrad.value / c_kms
+        if log_grid_spectrum.wavelength is not None:
+            log_grid_spectrum.spectrum = self(log_grid_spectrum.spectrum)
+            log_grid_spectrum.wavelength = (log_grid_spectrum.wavelength *
+                                            doppler_factor)
+            return
+
+        spectrum = log_grid_spectrum.spectrum
+        flux = spectrum.flux.astype(compute_dtype(self, spectrum.flux),
+                                    copy=False)
+        if doppler_factor != 1.:
+            flux = fractional_shift(
+                flux, np.log(doppler_factor) / log_grid_spectrum.log_step)
+        log_grid_spectrum.spectrum = spectrum.replace(flux=flux)
 
 
 class InstrumentConvolve(object):
@@ -90,6 +718,9 @@ class InstrumentConvolve(object):
     sampling: float
         number of pixels per resolution element (default=2.)
 
+    convolution: str
+        convolution method of `~specgrid.convolution.Convolver`: 'auto',
+        'direct' or 'fft' (default='auto')
     """
 
     @property
@@ -102,35 +733,237 @@ class InstrumentConvolve(object):
 
 
     param_names = ['R']
+    flux_linear = True
+    dtype = None
 
-    def __init__(self, R=np.inf, sampling=2.):
+    def __init__(self, R=np.inf, sampling=2., convolution='auto'):
         self.R = u.Quantity(R, u.Unit(1))
 
         self.sampling = float(sampling)
+        self.convolver = Convolver(convolution)
 
+    @property
+    def log_grid_step(self):
+        if np.isinf(self.R.value):
+            return None
+        return 1 / (self.sampling * self.R.value)
+
+    def log_grid_kernel(self, log_step):
+        """
+        Gaussian sampled on a log(wavelength) grid with log_step, None for
+        infinite R
+        """
+        if np.isinf(self.R.value):
+            return None
+        # FWHM of the gaussian in pixels of the grid
+        fwhm = 1 / (self.R.value * log_step)
+        return gaussian_kernel(fwhm / (2 * np.sqrt(2 * np.log(2))))
+
+    def log_grid_call(self, log_grid_spectrum):
+        """
+        Convolve a `LogGridSpectrum` in place, with the gaussian sampled on
+        its grid
+        """
+        kernel = self.log_grid_kernel(log_grid_spectrum.log_step)
+        if kernel is None:
+            return
+
+        spectrum = log_grid_spectrum.spectrum
+        dtype = compute_dtype(self, spectrum.flux)
+        log_grid_spectrum.spectrum = spectrum.replace(flux=self.convolver(
+            spectrum.flux.astype(dtype, copy=False), kernel))
+
+    @spectrum_record_call
     def __call__(self, spectrum):
         if np.isinf(self.R.value):
             return spectrum
 
-        wavelength, flux = spectrum.wavelength.value, spectrum.flux
+        wavelength, flux = spectrum.wavelength, spectrum.flux
+        dtype = compute_dtype(self, flux)
         log_grid_log_wavelength = np.arange(np.log(wavelength.min()),
                                             np.log(wavelength.max()),
                                             1 / (self.sampling *
-                                                 self.R.to(1).value))
+                                                 self.R.value))
         log_grid_wavelength = np.exp(log_grid_log_wavelength)
-        log_grid_flux = np.interp(log_grid_wavelength, wavelength, flux)
+        log_grid_flux = np.interp(log_grid_wavelength, wavelength,
+                                  flux).astype(dtype, copy=False)
         sigma = self.sampling / (2 * np.sqrt(2 * np.log(2)))
-        log_grid_convolved = nd.gaussian_filter1d(log_grid_flux, sigma)
+        log_grid_convolved = self.convolver(log_grid_flux,
+                                            gaussian_kernel(sigma))
         convolved_flux = np.interp(wavelength, log_grid_wavelength,
-                                   log_grid_convolved)
+                                   log_grid_convolved).astype(dtype,
+                                                              copy=False)
 
-        return Spectrum1D.from_array(spectrum.wavelength,
-                                     convolved_flux,
-                                     dispersion_unit=spectrum.wavelength.unit,
-                                     unit=spectrum.unit)
+        return spectrum.replace(flux=convolved_flux)
 
 
 
+class VariableInstrumentConvolve(object):
+    """
+    Convolve with a gaussian whose resolution R = lambda/delta_lambda
+    changes along the spectrum, for spectrographs whose resolution varies
+    along the detector
+
+    On a grid uniform in log(wavelength) the convolution is a banded sparse
+    matrix with one gaussian per pixel, applied at O(N K) cost for N pixels
+    and kernels of up to K pixels. The matrix is built once for a grid and
+    reused for grids of the same length and step that are shifted (e.g. by
+    a `DopplerShift` ahead of the plugin) as long as R at the pixels
+    changes by less than ``tolerance``, so one instance can be shared by
+    all fits with the same instrument configuration.
+
+    Parameters
+    ----------
+
+    wavelength: ~astropy.units.Quantity
+        sorted wavelengths at which R is given
+
+    R: ~numpy.ndarray or callable
+        resolution at wavelength, or a function returning the resolution for
+        an array of wavelengths (as ~astropy.units.Quantity) that is
+        evaluated at wavelength. R is interpolated linearly in between and
+        constant beyond the ends.
+
+    sampling: float
+        number of pixels per resolution element at the highest resolution
+        (default=2.)
+
+    tolerance: float
+        largest relative change of R at the pixels of a shifted grid for
+        which the matrix is reused (default=1e-3)
+    """
+
+    param_names = []
+    flux_linear = True
+    dtype = None
+
+    def __init__(self, wavelength, R, sampling=2., tolerance=1e-3):
+        self.wavelength = u.Quantity(wavelength)
+        if callable(R):
+            R = R(self.wavelength)
+        self.R = np.asarray(u.Quantity(R, u.Unit(1)).value, dtype=np.float64)
+        if self.R.shape != self.wavelength.shape:
+            raise ValueError('R needs to be given for each wavelength - '
+                             '{0} wavelengths and {1} R given'.format(
+                                 len(self.wavelength), len(self.R)))
+
+        self.sampling = float(sampling)
+        self.tolerance = float(tolerance)
+        # bounds the relative change of R for a shift in ln(wavelength)
+        if len(self.R) > 1:
+            self._max_log_slope = np.abs(
+                np.diff(np.log(self.R)) /
+                np.diff(np.log(self.wavelength.value))).max()
+        else:
+            self._max_log_slope = 0.
+        self._operator = None
+        self._operator_grid = None
+        self._operator_log_start = None
+
+    @classmethod
+    def from_fwhm(cls, wavelength, fwhm, sampling=2., tolerance=1e-3):
+        """
+        Instrument with a line spread function of the given FWHM at each
+        wavelength (e.g. measured from arc lines for each pixel)
+
+        Parameters
+        ----------
+
+        wavelength: ~astropy.units.Quantity
+            sorted wavelengths
+
+        fwhm: ~astropy.units.Quantity
+            FWHM of the line spread function at wavelength
+
+        sampling: float
+            number of pixels per resolution element at the highest resolution
+            (default=2.)
+
+        tolerance: float
+            largest relative change of R at the pixels of a shifted grid for
+            which the matrix is reused (default=1e-3)
+        """
+        wavelength = u.Quantity(wavelength)
+        return cls(wavelength, (wavelength / u.Quantity(fwhm)).to(u.Unit(1)),
+                   sampling=sampling, tolerance=tolerance)
+
+    @property
+    def log_grid_step(self):
+        return 1 / (self.sampling * self.R.max())
+
+    def resolution(self, wavelength):
+        """
+        Resolution at wavelength (~astropy.units.Quantity)
+        """
+        return np.interp(u.Quantity(wavelength).to(self.wavelength.unit).value,
+                         self.wavelength.value, self.R)
+
+    def operator(self, wavelength, log_step):
+        """
+        Sparse matrix that convolves a spectrum on a log(wavelength) grid
+
+        Parameters
+        ----------
+
+        wavelength: ~astropy.units.Quantity
+            wavelengths of the grid
+
+        log_step: float
+            step of the grid in log(wavelength)
+
+        Returns
+        -------
+            : ~scipy.sparse.csr_matrix
+        """
+        # FWHM of the gaussians in pixels of the grid
+        fwhm = 1 / (self.resolution(wavelength) * log_step)
+        return variable_gaussian_matrix(fwhm / (2 * np.sqrt(2 * np.log(2))))
+
+    def log_grid_call(self, log_grid_spectrum):
+        """
+        Convolve a `LogGridSpectrum` in place with the cached operator of its
+        grid
+        """
+        spectrum = log_grid_spectrum.spectrum
+        log_step = log_grid_spectrum.log_step
+        grid = (spectrum.wavelength_unit, log_step, len(spectrum.wavelength))
+        log_start = np.log(spectrum.wavelength[0])
+        if self._operator is None or grid != self._operator_grid or \
+                self._max_log_slope * abs(log_start -
+                                          self._operator_log_start) > \
+                self.tolerance:
+            self._operator = self.operator(
+                spectrum.wavelength * spectrum.wavelength_unit, log_step)
+            self._operator_grid = grid
+            self._operator_log_start = log_start
+        operator = self._operator
+
+        dtype = compute_dtype(self, spectrum.flux)
+        log_grid_spectrum.spectrum = spectrum.replace(flux=operator.dot(
+            spectrum.flux.astype(dtype, copy=False)).astype(dtype,
+                                                            copy=False))
+
+    @spectrum_record_call
+    def __call__(self, spectrum):
+        wavelength, flux = spectrum.wavelength, spectrum.flux
+        dtype = compute_dtype(self, flux)
+        log_grid_log_wavelength = np.arange(np.log(wavelength.min()),
+                                            np.log(wavelength.max()),
+                                            self.log_grid_step)
+        log_grid_wavelength = np.exp(log_grid_log_wavelength)
+        log_grid_spectrum = LogGridSpectrum(
+            spectrum.replace(wavelength=log_grid_wavelength,
+                             flux=np.interp(log_grid_wavelength, wavelength,
+                                            flux).astype(dtype, copy=False)),
+            self.log_grid_step, wavelength)
+        self.log_grid_call(log_grid_spectrum)
+        convolved_flux = np.interp(wavelength, log_grid_wavelength,
+                                   log_grid_spectrum.spectrum.flux).astype(
+            dtype, copy=False)
+
+        return spectrum.replace(flux=convolved_flux)
+
+
 class Interpolate(object):
 
     """
@@ -138,48 +971,183 @@ class Interpolate(object):
     You must initialize it with the observed spectrum. The output will be a
     Spectrum1D object.
 
+    The interpolation weights are computed once the same input wavelengths
+    arrive twice in a row (a `WavelengthRebinner`) and reused while they do
+    not change, e.g. for grids stored uniform in log(wavelength) or without
+    Doppler shift. Wavelengths changing with every call are interpolated
+    with `numpy.interp`, which is faster than computing the weights.
+    `LogGridPipeline` also lets Interpolate apply a preceding convolution
+    (`InstrumentConvolve`) and the interpolation as one sparse matrix
+    (`convolve_rebinner`).
+
     Parameters
     ----------
     observed: Spectrum1D object
         This is the observed spectrum which you want to interpolate your
         (model) spectrum to.
+
+    flux_conserving: bool
+        average the model over each observed pixel instead of interpolating
+        it at the pixel centres [default False]
     """
 
     param_names = []
-
-    def __init__(self, observed):
+    flux_linear = True
+    dtype = None
+    # the output is on the observed wavelengths whatever the input grid
+    resamples = True
+
+    def __init__(self, observed, flux_conserving=False):
+        self.flux_conserving = flux_conserving
+        self._rebinners = RepeatedWavelengthCache()
+        self._convolve_rebinners = RepeatedWavelengthCache()
         self._update_observed_spectrum(observed)
 
     def _update_observed_spectrum(self, observed_spectrum):
         self.observed = observed_spectrum
-
+        self._observed_wavelength = observed_spectrum.wavelength.value
+        self._observed_wavelength_unit = observed_spectrum.wavelength.unit
+        self._observed_flux_unit = observed_spectrum.unit
+        self._rebinners.clear()
+        self._convolve_rebinners.clear()
+
+    def observed_wavelength_in(self, wavelength_unit):
+        """
+        Observed wavelengths as array in wavelength_unit
+        """
+        if wavelength_unit == self._observed_wavelength_unit:
+            return self._observed_wavelength
+        return self._observed_wavelength * self._observed_wavelength_unit.to(
+            wavelength_unit)
+
+    def rebinner(self, wavelength, wavelength_unit):
+        """
+        `WavelengthRebinner` from wavelength (in wavelength_unit) to the
+        observed wavelengths. None for linear interpolation of wavelengths
+        that differ from the previous call, which `numpy.interp` does faster.
+        """
+        return self._rebinners.get(
+            wavelength, wavelength_unit,
+            lambda: WavelengthRebinner(
+                wavelength, self.observed_wavelength_in(wavelength_unit),
+                self.flux_conserving),
+            build_now=self.flux_conserving)
+
+    def convolve_rebinner(self, wavelength, wavelength_unit, kernel):
+        """
+        `convolve_rebin_matrix` convolving a spectrum on wavelength (uniform
+        in log(wavelength), in wavelength_unit) with kernel and interpolating
+        it to the observed wavelengths. None while the wavelengths or the
+        kernel change between calls, and for flux conserving interpolation.
+        """
+        if self.flux_conserving:
+            return None
+        return self._convolve_rebinners.get(
+            wavelength, (wavelength_unit, kernel.tobytes()),
+            lambda: convolve_rebin_matrix(
+                wavelength, self.observed_wavelength_in(wavelength_unit),
+                kernel))
+
+    def observed_record(self, interpolated_flux, flux):
+        """
+        `~specgrid.spectrum_record.SpectrumRecord` of interpolated_flux on the
+        observed wavelengths, in the dtype computed for the input flux
+        """
+        return SpectrumRecord(self._observed_wavelength,
+                              interpolated_flux.astype(
+                                  compute_dtype(self, flux), copy=False),
+                              self._observed_wavelength_unit,
+                              self._observed_flux_unit)
+
+    @spectrum_record_call
     def __call__(self, spectrum):
-        wavelength, flux = spectrum.wavelength.to(
-            self.observed.wavelength.unit).value, spectrum.flux
-        interpolated_flux = np.interp(self.observed.wavelength.value,
-                                      wavelength, flux)
-        return Spectrum1D.from_array(
-            self.observed.wavelength,
-            interpolated_flux,
-            dispersion_unit=self.observed.wavelength.unit,
-            unit=self.observed.unit)
+        wavelength, flux = spectrum.wavelength, spectrum.flux
+        rebinner = self.rebinner(wavelength, spectrum.wavelength_unit)
+        if rebinner is None:
+            interpolated_flux = np.interp(
+                self.observed_wavelength_in(spectrum.wavelength_unit),
+                wavelength, flux)
+        else:
+            interpolated_flux = rebinner(flux)
+        return self.observed_record(interpolated_flux, flux)
+
+
+def solve_normal_equations(normal_matrix, right_hand_side, max_condition):
+    """
+    Solve a stack of symmetric positive definite (normal equation) systems
+    after scaling their columns to unit diagonal
+
+    Parameters
+    ----------
+
+    normal_matrix: ~numpy.ndarray
+        matrices with shape (N, M, M) and a positive diagonal
+
+    right_hand_side: ~numpy.ndarray
+        right hand sides with shape (N, M)
+
+    max_condition: float
+        largest condition number of the scaled matrices that is solved
+
+    Returns
+    -------
+    solution: ~numpy.ndarray
+        solutions with shape (N, M), NaN for systems that are too poorly
+        conditioned
+    """
+    # normalizes different powers
+    scale = 1. / np.sqrt(np.diagonal(normal_matrix, axis1=1, axis2=2))
+    scaled_matrix = (normal_matrix * scale[:, :, np.newaxis] *
+                     scale[:, np.newaxis, :])
+    eigenvalues, eigenvectors = np.linalg.eigh(scaled_matrix)
+    well_conditioned = eigenvalues[:, 0] > eigenvalues[:, -1] / max_condition
+    projected = np.einsum('nji,nj->ni', eigenvectors,
+                          right_hand_side * scale)
+    solution = np.einsum('nij,nj->ni', eigenvectors,
+                         projected / eigenvalues) * scale
+    solution[~well_conditioned] = np.nan
+    return solution
 
 
 class Normalize(object):
     """Normalize a model spectrum to an observed one using a polynomial
 
+    By default the weighted least-squares fit is solved through its normal
+    equations: the (npol + 1) x (npol + 1) system is assembled from the
+    weighted power sums of the wavelengths with one product against
+    quantities of the observed spectrum that are computed once. Systems that
+    are too poorly conditioned for this fall back to the SVD solve of the
+    full design matrix. ``normalize_many`` fits many model spectra at once.
+
+    The normalized model matches the observed spectrum and is returned in the
+    flux unit of the observed spectrum (as by `NormalizeParts`), whatever the
+    unit of the model.
+
     Parameters
     ----------
     observed : Spectrum1D object
         The observed spectrum to which the model should be matched
     npol : int
         The degree of the polynomial
+    solver : str
+        'normal' for the normal equations, 'lstsq' for the SVD solve of the
+        full design matrix on every call [default 'normal']
     """
 
     param_names = []
+    dtype = None
+
+    solvers = ('normal', 'lstsq')
+    # largest condition number of the column-scaled normal equations that
+    # is solved directly (relative accuracy about max_condition * eps)
+    max_condition = 1e8
 
-    def __init__(self, observed, npol):
+    def __init__(self, observed, npol, solver='normal'):
+        if solver not in self.solvers:
+            raise ValueError('solver needs to be one of {0} - {1} '
+                             'given'.format(', '.join(self.solvers), solver))
         self.npol = npol
+        self.solver = solver
         self._update_observed_spectrum(observed)
 
     def _update_observed_spectrum(self, observed):
@@ -189,6 +1157,10 @@ class Normalize(object):
             self.uncertainty = getattr(observed.uncertainty, 'array',
                                        observed.uncertainty)
         self.signal_to_noise = observed.flux / self.uncertainty
+        self._uncertainty_value = np.asarray(
+            getattr(self.uncertainty, 'value', self.uncertainty))
+        self._signal_to_noise_value = np.asarray(
+            getattr(self.signal_to_noise, 'value', self.signal_to_noise))
         self.flux_unit = observed.unit
         self._rcond = (len(observed.flux) *
                        np.finfo(observed.flux.dtype).eps)
@@ -198,37 +1170,147 @@ class Normalize(object):
                                   observed.wavelength.max()])
         self.window = self.domain/observed.wavelength.mean() - 1.
 
+        # observation-side quantities of the normal equations: the powers up
+        # to 2 npol, 1 / uncertainty**2 and flux / uncertainty**2
+        self._powers = np.polynomial.polynomial.polyvander(
+            np.asarray(observed.wavelength/observed.wavelength.mean() - 1.,
+                       dtype=np.float64), 2 * self.npol)
+        uncertainty = np.broadcast_to(self._uncertainty_value,
+                                      self._signal_to_noise_value.shape)
+        self._inverse_variance = 1. / uncertainty.astype(np.float64) ** 2
+        self._weighted_flux = (self._signal_to_noise_value.astype(np.float64) /
+                               uncertainty)
+        # the normal matrix is a Hankel matrix of the weighted power sums
+        self._hankel_index = np.add.outer(np.arange(self.npol + 1),
+                                          np.arange(self.npol + 1))
+        self.coefficients = None
+        self._polynomial = None
 
-    def __call__(self, spectrum):
-        # V[:,0]=mfi/e, Vp[:,1]=mfi/e*w, .., Vp[:,npol]=mfi/e*w**npol
-        
-        V = self._Vp * (spectrum.flux / self.uncertainty)[:, np.newaxis]
-        # normalizes different powers
-        scl = np.sqrt((V*V).sum(0))
-        if np.isfinite(scl[0].value):  # check for validity before evaluating
-            sol, resids, rank, s = np.linalg.lstsq(V/scl, self.signal_to_noise,
-                                                   self._rcond)
-            sol = (sol.T / scl).T
-            if rank != self._Vp.shape[-1] - 1:
-                msg = "The fit may be poorly conditioned"
-                warnings.warn(msg)
-
-            fit = np.dot(V, sol) * self.uncertainty
-            # keep coefficients in case the outside wants to look at it
-            self.polynomial = Polynomial(sol, domain=self.domain.value,
-                                         window=self.window.value)
-            return Spectrum1D.from_array(
-                spectrum.wavelength,
-                u.Quantity(fit, spectrum.unit))
+    @property
+    def polynomial(self):
+        """
+        `~numpy.polynomial.Polynomial` of the last fit, only built when it is
+        read
+        """
+        if self.coefficients is None:
+            raise AttributeError('No spectrum normalized yet')
+        if self._polynomial is None:
+            self._polynomial = Polynomial(self.coefficients,
+                                          domain=self.domain.value,
+                                          window=self.window.value)
+        return self._polynomial
+
+    def normalize_many(self, fluxes):
+        """
+        Fit the polynomial normalization of many model spectra on the
+        observed wavelengths at once
+
+        Parameters
+        ----------
+
+        fluxes: ~numpy.ndarray
+            model fluxes with shape (N, n_wavelength)
+
+        Returns
+        -------
+        fits: ~numpy.ndarray
+            normalized model fluxes (in the unit of the observed spectrum)
+            with shape (N, n_wavelength); models with non-finite fluxes are
+            returned as they are
+        coefficients: ~numpy.ndarray
+            polynomial coefficients with shape (N, npol + 1), NaN for models
+            with non-finite fluxes
+        """
+        fluxes = np.atleast_2d(fluxes)
+        dtype = compute_dtype(self, fluxes)
+
+        if self.solver == 'normal':
+            coefficients, finite = self._normal_coefficients(fluxes)
+            use_lstsq = finite & np.isnan(coefficients[:, 0])
         else:
+            coefficients = np.full((len(fluxes), self.npol + 1), np.nan)
+            finite = np.ones(len(fluxes), dtype=bool)
+            use_lstsq = finite
+        for i in np.flatnonzero(use_lstsq):
+            coefficients[i], finite[i] = self._lstsq_coefficients(fluxes[i],
+                                                                  dtype)
+
+        fits = fluxes.astype(dtype)
+        fits[finite] = (fluxes[finite] *
+                        np.dot(coefficients[finite], self._Vp.T)).astype(
+            dtype, copy=False)
+        return fits, coefficients
+
+    def _normal_coefficients(self, fluxes):
+        """
+        Coefficients from the column-scaled normal equations (NaN where these
+        are too poorly conditioned) and which fluxes are finite
+        """
+        fluxes = fluxes.astype(np.float64, copy=False)
+        # sum of w**k * (model / uncertainty)**2 for k <= 2 npol and of
+        # w**k * model * flux / uncertainty**2 for k <= npol
+        sums = np.dot(np.concatenate((fluxes ** 2 * self._inverse_variance,
+                                      fluxes * self._weighted_flux)),
+                      self._powers)
+        normal_matrix = sums[:len(fluxes)][:, self._hankel_index]
+        right_hand_side = sums[len(fluxes):, :self.npol + 1]
+
+        finite = np.isfinite(sums).all(1)
+        finite = finite[:len(fluxes)] & finite[len(fluxes):]
+        # all-zero models can not be scaled to the observation either
+        valid = finite & (sums[:len(fluxes), 0] > 0)
+        coefficients = np.full((len(fluxes), self.npol + 1), np.nan)
+        if not valid.any():
+            return coefficients, finite
+
+        coefficients[valid] = solve_normal_equations(
+            normal_matrix[valid], right_hand_side[valid], self.max_condition)
+        return coefficients, finite
+
+    def _lstsq_coefficients(self, flux, dtype):
+        """
+        Coefficients from the SVD solve of the full design matrix and whether
+        the flux is finite
+        """
+        # V[:,0]=mfi/e, Vp[:,1]=mfi/e*w, .., Vp[:,npol]=mfi/e*w**npol
+        V = self._Vp.astype(dtype, copy=False) * (
+            flux / self._uncertainty_value).astype(
+            dtype, copy=False)[:, np.newaxis]
+        # normalizes different powers, accumulating in double precision
+        scl = np.sqrt((V*V).sum(0, dtype=np.float64))
+        if not np.isfinite(scl[0]):  # check for validity before evaluating
+            return np.nan, False
+
+        sol, resids, rank, s = np.linalg.lstsq(
+            (V/scl).astype(np.float64, copy=False),
+            self._signal_to_noise_value, self._rcond)
+        if rank < self._Vp.shape[-1]:
+            msg = "The fit may be poorly conditioned"
+            warnings.warn(msg)
+        return (sol.T / scl).T, True
+
+    @spectrum_record_call
+    def __call__(self, spectrum):
+        fits, coefficients = self.normalize_many(spectrum.flux[np.newaxis])
+        if np.isnan(coefficients[0, 0]):
             return spectrum
 
+        # keep coefficients in case the outside wants to look at it
+        self.coefficients = coefficients[0]
+        self._polynomial = None
+        # the fit matches the observed spectrum and is in its unit
+        return SpectrumRecord(spectrum.wavelength, fits[0],
+                              spectrum.wavelength_unit, self.flux_unit)
+
 
 class NormalizeParts(object):
     """Normalize a model spectrum to an observed one in multiple parts
 
     Here, different parts could, e.g., be different echelle orders or
-    different chips for GMOS spectra.
+    different chips for GMOS spectra. The normal equations of all parts are
+    assembled and solved together on the pixel indices of the parts, padding
+    lower degree parts to the highest degree; parts that are too poorly
+    conditioned for this fall back to the SVD solve of their normalizer.
 
     Parameters
     ----------
@@ -247,6 +1329,16 @@ class NormalizeParts(object):
 
         self._update_observed_spectrum(observed, parts)
 
+    @property
+    def dtype(self):
+        return getattr(self, '_dtype', None)
+
+    @dtype.setter
+    def dtype(self, value):
+        self._dtype = value
+        for normalizer in self.normalizers:
+            normalizer.dtype = value
+
     def _update_observed_spectrum(self, observed_spectrum, parts):
         self.parts = parts
         self.normalizers = []
@@ -262,7 +1354,42 @@ class NormalizeParts(object):
         for part, _npol in zip(parts, npol):
             self.normalizers.append(
                 Normalize(self.spectrum_1d_getitem(observed_spectrum, part), _npol))
-
+            self.normalizers[-1].dtype = self.dtype
+
+        # the pixels of the parts as rows padded to the longest part, with
+        # the observation-side quantities of their normalizers (zero weight
+        # in the padding)
+        pixels = np.arange(len(observed_spectrum.flux))
+        indices = [pixels[part].ravel() for part in parts]
+        part_lengths = np.array([len(index) for index in indices])
+        self._index = np.concatenate(indices)
+        self._in_part = (np.arange(part_lengths.max()) <
+                         part_lengths[:, np.newaxis])
+
+        npol = np.array([normalizer.npol for normalizer in self.normalizers])
+        max_npol = npol.max()
+        self._powers = np.zeros(self._in_part.shape + (2 * max_npol + 1,))
+        # inverse variance and flux / uncertainty**2
+        self._weights = np.zeros((len(parts), 2, part_lengths.max()))
+        for i, normalizer in enumerate(self.normalizers):
+            length = part_lengths[i]
+            self._powers[i, :length, :2 * normalizer.npol + 1] = (
+                normalizer._powers)
+            self._weights[i, 0, :length] = normalizer._inverse_variance
+            self._weights[i, 1, :length] = normalizer._weighted_flux
+        self._fit_powers = np.ascontiguousarray(
+            self._powers[:, :, :max_npol + 1])
+        # work buffers of the model fluxes and the weighted model fluxes
+        self._flux_buffer = np.zeros(self._in_part.shape)
+        self._weighted_flux_buffer = np.empty_like(self._weights)
+        self._hankel_index = np.add.outer(np.arange(max_npol + 1),
+                                          np.arange(max_npol + 1))
+
+        # lower degree parts are padded with decoupled unit rows
+        self._unused = np.arange(max_npol + 1) > npol[:, np.newaxis]
+        self._padding = (self._unused[:, :, np.newaxis] |
+                         self._unused[:, np.newaxis, :])
+        self._identity = np.eye(max_npol + 1)
 
     @staticmethod
     def spectrum_1d_getitem(observed, part):
@@ -274,19 +1401,93 @@ class NormalizeParts(object):
                                                 observed.uncertainty)[part]
         return observed_part
 
+    def _coefficients(self, flux, dtype):
+        """
+        Polynomial coefficients of all parts (padded with zeros to the
+        highest degree, NaN for parts with non-finite fluxes) for the model
+        fluxes of the parts as padded rows
+        """
+        max_npol = self._hankel_index.shape[0] - 1
+        weighted_flux = np.multiply(self._weights, flux[:, np.newaxis],
+                                    out=self._weighted_flux_buffer)
+        weighted_flux[:, 0] *= flux
+        # sums of w**k * (model / uncertainty)**2 and of
+        # w**k * model * flux / uncertainty**2 for each part
+        sums = np.matmul(weighted_flux, self._powers)
+        model_sums = sums[:, 0]
+        cross_sums = sums[:, 1, :max_npol + 1]
+
+        normal_matrix = np.where(self._padding, self._identity,
+                                 model_sums[:, self._hankel_index])
+        right_hand_side = np.where(self._unused, 0., cross_sums)
+
+        finite = np.isfinite(sums).all(2).all(1)
+        # all-zero models can not be scaled to the observation either
+        valid = finite & (model_sums[:, 0] > 0)
+        coefficients = np.full((len(self.normalizers), max_npol + 1), np.nan)
+        coefficients[valid] = solve_normal_equations(
+            normal_matrix[valid], right_hand_side[valid],
+            Normalize.max_condition)
+
+        for i in np.flatnonzero(finite & np.isnan(coefficients[:, 0])):
+            normalizer = self.normalizers[i]
+            part_flux = flux[i, :len(normalizer._powers)]
+            coefficients[i, :normalizer.npol + 1], finite[i] = (
+                normalizer._lstsq_coefficients(part_flux, dtype))
+        coefficients[self._unused] = 0.
+        coefficients[~finite] = np.nan
+        return coefficients
+
+    @spectrum_record_call
     def __call__(self, model):
-        fit = np.zeros_like(model.wavelength.value)
-        for part, normalizer in zip(self.parts, self.normalizers):
-            fit[part] = normalizer(self.spectrum_1d_getitem(model, part)).flux
+        dtype = compute_dtype(self, model.flux)
+        flux = self._flux_buffer
+        flux[self._in_part] = model.flux[self._index]
+        coefficients = self._coefficients(flux, dtype)
+
+        for normalizer, part_coefficients in zip(self.normalizers,
+                                                 coefficients):
+            if not np.isnan(part_coefficients[0]):
+                # keep coefficients in case the outside wants to look at it
+                normalizer.coefficients = part_coefficients[:normalizer.npol + 1]
+                normalizer._polynomial = None
 
-        return Spectrum1D.from_array(
-            model.wavelength.value,
-            fit, unit=self.normalizers[0].flux_unit,
-            dispersion_unit=model.wavelength.unit)
+        # parts with non-finite model fluxes are returned as they are
+        coefficients[np.isnan(coefficients[:, 0])] = self._identity[0]
+        polynomial = np.matmul(self._fit_powers,
+                               coefficients[:, :, np.newaxis])[:, :, 0]
+        fit = np.zeros_like(model.wavelength, dtype=dtype)
+        fit[self._index] = (flux * polynomial)[self._in_part]
+
+        return SpectrumRecord(model.wavelength, fit, model.wavelength_unit,
+                              self.normalizers[0].flux_unit)
 
 
 class CCM89Extinction(object):
+    """
+    Redden a spectrum with the extinction curve of Cardelli, Clayton & Mathis
+    (1989) between 910 and 33333 Angstrom
+
+    A_lambda / A_V is a + b / r_v with coefficients a and b that only depend
+    on the wavelength. Once the same wavelengths come twice in a row, a and b
+    are kept for them, so that changing a_v and r_v only costs one
+    exponential of the spectrum. New wavelengths (e.g. Doppler shifted ones)
+    evaluate the curve once for the current r_v.
+
+    Parameters
+    ----------
+
+    a_v: float
+        extinction in V [default 0.0]
+
+    r_v: float
+        ratio of total to selective extinction A_V / E(B - V) [default 3.1]
+    """
+
     param_names = ['a_v', 'r_v']
+    flux_linear = True
+    dtype = None
+    log_grid_step = None
 
 
     @property
@@ -309,20 +1510,72 @@ class CCM89Extinction(object):
     def __init__(self, a_v=0.0, r_v=3.1):
         self.a_v = a_v
         self.r_v = r_v
+        self._coefficients = RepeatedWavelengthCache()
 
-    def __call__(self, spectrum):
-
+    @staticmethod
+    def extinction_curve(wavelength, r_v):
+        """
+        A_lambda / A_V for wavelengths in Angstrom (zero outside
+        910 - 33333 Angstrom)
+        """
         from specutils import extinction
-        extinction_factor = np.ones_like(spectrum.wavelength.value)
-        valid_wavelength = ((spectrum.wavelength > 910 * u.angstrom) &
-                            (spectrum.wavelength < 33333 * u.angstrom))
-        extinction_factor[valid_wavelength] = 10 ** (-0.4 * extinction.extinction_ccm89(
-            spectrum.wavelength[valid_wavelength], a_v=self.a_v,
-            r_v=self.r_v).to(u.angstrom).value)
-
-
-        return Spectrum1D.from_array(spectrum.wavelength,
-                                     extinction_factor * spectrum.flux)
+        curve = np.zeros(len(wavelength))
+        valid_wavelength = (wavelength > 910) & (wavelength < 33333)
+        curve[valid_wavelength] = extinction.extinction_ccm89(
+            wavelength[valid_wavelength] * u.angstrom, a_v=1.,
+            r_v=r_v).to(u.angstrom).value
+        return curve
+
+    @classmethod
+    def extinction_coefficients(cls, wavelength):
+        """
+        Coefficients a and b of A_lambda / A_V = a + b / r_v
+
+        Parameters
+        ----------
+
+        wavelength: ~numpy.ndarray
+            wavelengths in Angstrom
+
+        Returns
+        -------
+            : ~numpy.ndarray
+            a and b with shape (2, len(wavelength)), zero outside
+            910 - 33333 Angstrom
+        """
+        # a + b for r_v = 1 and a + 2 b for r_v = 1 / 2
+        curve_1 = cls.extinction_curve(wavelength, 1.)
+        curve_2 = cls.extinction_curve(wavelength, 0.5)
+        return np.array([2. * curve_1 - curve_2, curve_2 - curve_1])
+
+    @spectrum_record_call
+    def __call__(self, spectrum):
+        dtype = compute_dtype(self, spectrum.flux)
+        flux = spectrum.flux.astype(dtype, copy=False)
+        if self.a_v == 0:
+            return spectrum.replace(flux=flux)
+
+        wavelength = lambda: (spectrum.wavelength *
+                              spectrum.wavelength_unit.to(u.angstrom))
+        coefficients = self._coefficients.get(
+            spectrum.wavelength, spectrum.wavelength_unit,
+            lambda: self.extinction_coefficients(wavelength()))
+        # 10 ** (-0.4 A_lambda)
+        scale = -0.4 * np.log(10.) * self.a_v
+        if coefficients is None:
+            extinction_factor = np.exp(
+                scale * self.extinction_curve(wavelength(), self.r_v))
+        else:
+            a, b = coefficients
+            extinction_factor = np.exp(scale * a + (scale / self.r_v) * b)
+        return spectrum.replace(flux=extinction_factor.astype(dtype) * flux)
+
+    def log_grid_call(self, log_grid_spectrum):
+        """
+        Redden a `LogGridSpectrum` in place - extinction is applied pixel by
+        pixel on any grid
+        """
+        log_grid_spectrum.spectrum = self(log_grid_spectrum.spectrum)
 
 
 
@@ -0,0 +1,81 @@
+import functools
+
+
+class SpectrumRecord(object):
+    """
+    Lightweight spectrum passed between the spectral grid, the plugins and
+    the fitness functions. It holds plain arrays and the units they are in,
+    so no `~astropy.units.Quantity` arithmetic runs on full-length arrays
+    while a model is evaluated. A `Spectrum1D` is only built at the public
+    API boundary with `to_spectrum1d`.
+
+    Parameters
+    ----------
+
+    wavelength: ~numpy.ndarray
+        wavelength values in ``wavelength_unit``
+
+    flux: ~numpy.ndarray
+        flux values in ``flux_unit``
+
+    wavelength_unit: ~astropy.units.Unit
+
+    flux_unit: ~astropy.units.Unit
+    """
+
+    __slots__ = ('wavelength', 'flux', 'wavelength_unit', 'flux_unit')
+
+    def __init__(self, wavelength, flux, wavelength_unit, flux_unit):
+        self.wavelength = wavelength
+        self.flux = flux
+        self.wavelength_unit = wavelength_unit
+        self.flux_unit = flux_unit
+
+    @classmethod
+    def from_spectrum1d(cls, spectrum):
+        """
+        Record of the wavelength and flux of a `Spectrum1D`
+        """
+        return cls(spectrum.wavelength.value, spectrum.flux.value,
+                   spectrum.wavelength.unit, spectrum.flux.unit)
+
+    def to_spectrum1d(self):
+        # specutils is only imported once a spectrum leaves the pipeline
+        from fix_spectrum1d import Spectrum1D
+        return Spectrum1D.from_array(self.wavelength, self.flux,
+                                     dispersion_unit=self.wavelength_unit,
+                                     unit=self.flux_unit)
+
+    def replace(self, wavelength=None, flux=None):
+        """
+        New record with the given wavelength and/or flux values, keeping the
+        rest (including the units)
+        """
+        return SpectrumRecord(
+            self.wavelength if wavelength is None else wavelength,
+            self.flux if flux is None else flux,
+            self.wavelength_unit, self.flux_unit)
+
+    def __len__(self):
+        return len(self.flux)
+
+    def __repr__(self):
+        return '<SpectrumRecord {0} pixels {1} - {2} {3} [{4}]>'.format(
+            len(self), self.wavelength[0], self.wavelength[-1],
+            self.wavelength_unit, self.flux_unit)
+
+
+def spectrum_record_call(method):
+    """
+    Decorator for plugin ``__call__`` methods that compute on a
+    `SpectrumRecord`. Records are passed through as they are; a `Spectrum1D`
+    is converted to a record and the result back to a `Spectrum1D`, so the
+    plugins can still be used on their own.
+    """
+    @functools.wraps(method)
+    def wrapper(self, spectrum):
+        if isinstance(spectrum, SpectrumRecord):
+            return method(self, spectrum)
+        return method(
+            self, SpectrumRecord.from_spectrum1d(spectrum)).to_spectrum1d()
+    return wrapper
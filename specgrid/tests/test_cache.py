@@ -0,0 +1,68 @@
+import os
+import pickle
+
+import numpy as np
+import numpy.testing as nptesting
+
+import specgrid
+from specgrid import SpectralGrid
+from specgrid.cache import LRUCache, LazyFluxes
+from specgrid.interpolators import SimplexInterpolator
+
+
+def data_path(filename):
+    return os.path.join(specgrid.__path__[0], 'data', filename)
+
+
+def test_lru_cache_eviction():
+    cache = LRUCache(3 * 80)
+    for i in range(3):
+        cache.put(i, np.zeros(10))
+    cache.get(0)
+    cache.put(3, np.zeros(10))
+    assert 0 in cache
+    assert 1 not in cache
+    assert cache.current_bytes == 3 * 80
+    cache.put('large', np.zeros(100))
+    assert 'large' not in cache
+    assert cache.get(1) is None
+    assert cache.stats['hits'] == 1
+    assert cache.stats['misses'] == 1
+
+
+def test_lazy_fluxes_indexing(test_specgrid):
+    row_bytes = test_specgrid.fluxes[0].nbytes
+    lazy_fluxes = LazyFluxes(data_path('munari_small.h5'),
+                             cache_bytes=4 * row_bytes)
+    nptesting.assert_allclose(lazy_fluxes[3], test_specgrid.fluxes[3])
+    nptesting.assert_allclose(lazy_fluxes[[5, 1, 5]],
+                              test_specgrid.fluxes[[5, 1, 5]])
+    nptesting.assert_allclose(lazy_fluxes[2:10, 100:200],
+                              test_specgrid.fluxes[2:10, 100:200])
+    assert lazy_fluxes.cache.current_bytes <= 4 * row_bytes
+
+    unpickled_fluxes = pickle.loads(pickle.dumps(lazy_fluxes))
+    nptesting.assert_allclose(unpickled_fluxes[-1], test_specgrid.fluxes[-1])
+    lazy_fluxes.close()
+    unpickled_fluxes.close()
+
+
+def test_lazy_regular_specgrid(test_regular_specgrid):
+    row_bytes = test_regular_specgrid.fluxes[0].nbytes
+    lazy_grid = SpectralGrid(data_path('munari_small.h5'), lazy=True,
+                             flux_cache_bytes=10 * row_bytes)
+    nptesting.assert_allclose(
+        lazy_grid.evaluate(5780., 4.4, 0.0).flux.value,
+        test_regular_specgrid.evaluate(5780., 4.4, 0.0).flux.value)
+    assert len(lazy_grid.fluxes.cache) == 8
+    lazy_grid.close()
+
+
+def test_lazy_simplex_specgrid(test_specgrid):
+    lazy_grid = SpectralGrid(data_path('munari_small.h5'), lazy=True,
+                             interpolator=SimplexInterpolator)
+    nptesting.assert_allclose(
+        lazy_grid.evaluate(5780., 4.4, 0.0).flux.value,
+        test_specgrid.evaluate(5780., 4.4, 0.0).flux.value)
+    assert len(lazy_grid.fluxes.cache) <= 4
+    lazy_grid.close()
@@ -0,0 +1,71 @@
+import numpy as np
+import numpy.testing as nptesting
+import pytest
+import scipy.ndimage as nd
+
+from specgrid.convolution import (Convolver, gaussian_kernel, next_fast_length,
+                                  variable_gaussian_matrix)
+from specgrid.plugins import InstrumentConvolve, RotationalBroadening
+
+
+def test_next_fast_length():
+    assert [next_fast_length(n) for n in [1, 7, 17, 1000, 1025]] == \
+        [1, 8, 18, 1000, 1080]
+
+
+@pytest.mark.parametrize("n,k", [(50, 7), (1000, 51), (5000, 301),
+                                 (12, 11), (300, 3)])
+def test_fft_convolution(n, k):
+    random_state = np.random.RandomState(0)
+    flux = random_state.uniform(size=n)
+    kernel = random_state.uniform(size=k)
+    convolver = Convolver('fft')
+    nptesting.assert_allclose(convolver(flux, kernel),
+                              nd.convolve1d(flux, kernel), rtol=1e-12)
+    nptesting.assert_allclose(convolver(flux, kernel),
+                              nd.convolve1d(flux, kernel), rtol=1e-12)
+    assert convolver.kernel_cache.hits == 1
+
+
+def test_convolution_method():
+    convolver = Convolver()
+    assert convolver.select_method(8000, 5) == 'direct'
+    assert convolver.select_method(8000, 641) == 'fft'
+    assert Convolver('direct').select_method(8000, 641) == 'direct'
+    # even kernels are always convolved directly
+    assert Convolver('fft').select_method(8000, 640) == 'direct'
+
+    with pytest.raises(ValueError):
+        Convolver('fast')
+
+    nptesting.assert_allclose(
+        nd.convolve1d(np.arange(100.) ** 2, gaussian_kernel(2.3)),
+        nd.gaussian_filter1d(np.arange(100.) ** 2, 2.3))
+
+
+def test_variable_gaussian_matrix():
+    flux = np.random.RandomState(0).uniform(size=500)
+    nptesting.assert_allclose(
+        variable_gaussian_matrix(np.full(500, 2.7)).dot(flux),
+        nd.convolve1d(flux, gaussian_kernel(2.7)), rtol=1e-12)
+
+    sigma = np.linspace(1., 6., 500)
+    matrix = variable_gaussian_matrix(sigma)
+    nptesting.assert_allclose(matrix.dot(np.ones(500)), 1.)
+    for i in [30, 250, 470]:
+        kernel = gaussian_kernel(sigma[i])
+        half = len(kernel) // 2
+        nptesting.assert_allclose(matrix.dot(flux)[i],
+                                  np.dot(kernel, flux[i - half:i + half + 1]),
+                                  rtol=1e-12)
+
+
+def test_plugin_convolution(test_spectrum):
+    for plugin_class, parameter in [(RotationalBroadening, 'vrot'),
+                                    (InstrumentConvolve, 'R')]:
+        fluxes = []
+        for convolution in ['direct', 'fft']:
+            plugin = plugin_class(convolution=convolution)
+            setattr(plugin, parameter, 300. if parameter == 'vrot' else 5000.)
+            fluxes.append(plugin(test_spectrum).flux.value)
+        nptesting.assert_allclose(fluxes[1], fluxes[0], rtol=1e-10)
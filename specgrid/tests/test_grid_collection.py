@@ -0,0 +1,145 @@
+import os
+import pickle
+
+import h5py
+import numpy as np
+import numpy.testing as nptesting
+import pandas as pd
+import pytest
+
+import specgrid
+from specgrid import GridCollection, ModelStar
+from specgrid.plugins import DopplerShift
+
+
+def data_path(filename):
+    return os.path.join(specgrid.__path__[0], 'data', filename)
+
+
+def write_subgrid(fname, index, fluxes, flux_attrs):
+    index.to_hdf(fname, 'index', mode='w')
+    with h5py.File(fname, 'a') as fh:
+        fh['fluxes'] = fluxes
+        for key, value in flux_attrs.items():
+            fh['fluxes'].attrs[key] = value
+
+
+@pytest.fixture(scope='module')
+def subgrid_fnames(tmpdir_factory):
+    """
+    munari_small.h5 split into a cool and a hot half sharing teff=5750
+    """
+    tmpdir = tmpdir_factory.mktemp('grid_collection')
+    index = pd.read_hdf(data_path('munari_small.h5'), 'index')
+    with h5py.File(data_path('munari_small.h5'), 'r') as fh:
+        fluxes = fh['fluxes'][()]
+        flux_attrs = dict(fh['fluxes'].attrs)
+
+    fnames = []
+    for name, selection in [('cool', index.teff <= 5750),
+                            ('hot', index.teff >= 5750)]:
+        fname = str(tmpdir.join('munari_{0}.h5'.format(name)))
+        write_subgrid(fname, index[selection.values],
+                      fluxes[selection.values], flux_attrs)
+        fnames.append(fname)
+    return fnames
+
+
+def test_grid_collection(test_regular_specgrid, subgrid_fnames):
+    collection = GridCollection(subgrid_fnames)
+    assert collection.param_names == test_regular_specgrid.param_names
+    nptesting.assert_allclose(collection.bounds, test_regular_specgrid.bounds)
+    assert len(collection._open_grids) == 0
+
+    parameter_matrix = np.random.RandomState(0).uniform(
+        [4900., 2.9, -0.1], [6600., 4.6, 0.6], size=(200, 3))
+    parameter_matrix = np.vstack((parameter_matrix, [[5750., 4.1, 0.2]]))
+    nptesting.assert_array_equal(
+        collection.contains_many(parameter_matrix),
+        test_regular_specgrid.contains_many(parameter_matrix))
+    nptesting.assert_allclose(
+        collection.evaluate_many(parameter_matrix),
+        test_regular_specgrid.evaluate_many(parameter_matrix))
+    assert collection.find_grids([[5750., 4.1, 0.2]])[0] == 0
+
+    spectrum = collection.evaluate(6100., 4.1, 0.2)
+    assert list(collection._open_grids) == [0, 1]
+    nptesting.assert_allclose(
+        spectrum.flux.value,
+        test_regular_specgrid.evaluate(6100., 4.1, 0.2).flux.value)
+    nptesting.assert_allclose(spectrum.wavelength.value,
+                              test_regular_specgrid.wavelength.value)
+
+    spectrum, jacobian = collection.evaluate_with_jacobian(5400., 4.1, 0.2)
+    regular_spectrum, regular_jacobian = \
+        test_regular_specgrid.evaluate_with_jacobian(5400., 4.1, 0.2)
+    nptesting.assert_allclose(jacobian.value, regular_jacobian.value)
+
+    assert not collection.contains(teff=7000.)
+    assert np.all(np.isnan(collection.evaluate(teff=7000.).flux.value))
+
+
+def test_grid_collection_members(test_regular_specgrid, subgrid_fnames):
+    collection = GridCollection(subgrid_fnames, max_open_grids=1)
+    index = collection.index
+    assert list(index.columns) == collection.param_names
+    # the shared teff=5750 points are in both subgrids
+    assert len(index.drop_duplicates()) == len(test_regular_specgrid.index)
+    assert len(collection._open_grids) == 0
+    # members of single grids are not half inherited
+    assert not hasattr(collection, 'regular_grid')
+    assert not hasattr(collection, 'fluxes')
+
+    collection.evaluate(6100., 4.1, 0.2)
+    assert list(collection._open_grids) == [1]
+    spectrum, jacobian = collection.evaluate_with_jacobian(7000., 4.1, 0.2)
+    assert np.all(np.isnan(spectrum.flux.value))
+    assert jacobian.shape == (3, len(collection.wavelength))
+    assert np.all(np.isnan(jacobian.value))
+    # off-grid parameters do not open (and evict) subgrids
+    assert list(collection._open_grids) == [1]
+
+    collection = pickle.loads(pickle.dumps(collection))
+    assert len(collection.index) == len(index)
+    nptesting.assert_allclose(
+        collection.evaluate(5300., 4.1, 0.2).flux.value,
+        test_regular_specgrid.evaluate(5300., 4.1, 0.2).flux.value)
+
+
+def test_grid_collection_model_star(test_regular_specgrid, subgrid_fnames):
+    collection = GridCollection(subgrid_fnames, max_open_grids=1)
+    model_star = ModelStar(collection, [DopplerShift()])
+    regular_model_star = ModelStar(test_regular_specgrid, [DopplerShift()])
+
+    for teff in [5300., 6200., 5500.]:
+        parameters = dict(teff=teff, logg=4.1, feh=0.2, vrad=20.)
+        nptesting.assert_allclose(
+            model_star.evaluate(**parameters).flux.value,
+            regular_model_star.evaluate(**parameters).flux.value)
+        assert len(collection._open_grids) == 1
+
+    collection = pickle.loads(pickle.dumps(collection))
+    assert len(collection._open_grids) == 0
+    nptesting.assert_allclose(
+        collection.evaluate(5780., 4.4, 0.0).flux.value,
+        test_regular_specgrid.evaluate(5780., 4.4, 0.0).flux.value)
+
+
+def test_grid_collection_mismatch(subgrid_fnames, tmpdir):
+    index = pd.read_hdf(subgrid_fnames[0], 'index')
+    with h5py.File(subgrid_fnames[0], 'r') as fh:
+        fluxes = fh['fluxes'][()]
+        flux_attrs = dict(fh['fluxes'].attrs)
+
+    fname = str(tmpdir.join('no_feh.h5'))
+    write_subgrid(fname, index[['teff', 'logg']], fluxes, flux_attrs)
+    with pytest.raises(ValueError):
+        GridCollection([subgrid_fnames[0], fname])
+
+    flux_attrs['wavelength'] = flux_attrs['wavelength'] * 2
+    fname = str(tmpdir.join('shifted.h5'))
+    write_subgrid(fname, index, fluxes, flux_attrs)
+    collection = GridCollection([subgrid_fnames[0], fname])
+    collection.evaluate(5500., 4.1, 0.2)
+    with pytest.raises(ValueError):
+        collection.get_grid(1)
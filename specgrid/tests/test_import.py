@@ -0,0 +1,75 @@
+import json
+import os
+import shutil
+import subprocess
+import sys
+
+import specgrid
+from specgrid.io.base import upgrade_hdf5
+
+# ``import specgrid`` took ~1.5 s when the whole package was imported eagerly
+# and takes well under 0.5 s now. The default budget leaves room for slow
+# machines (cold caches, .pyc compilation) and can be tightened or relaxed
+# with SPECGRID_IMPORT_TIME_BUDGET (in s); the imported modules catch
+# regressions to eager imports on any machine
+IMPORT_TIME_BUDGET = float(os.environ.get('SPECGRID_IMPORT_TIME_BUDGET', 2.))
+
+
+def data_path(filename):
+    return os.path.join(specgrid.__path__[0], 'data', filename)
+
+
+def run_isolated(code):
+    """
+    Run code in a fresh interpreter, returning the time it took and the
+    names of all imported modules
+    """
+    script = ('import json, sys, time\n'
+              'start = time.time()\n'
+              '{0}\n'
+              'print(json.dumps({{"time": time.time() - start, '
+              '"modules": sorted(sys.modules)}}))').format(code)
+    environment = os.environ.copy()
+    environment['PYTHONPATH'] = os.pathsep.join(
+        [os.path.dirname(specgrid.__path__[0])] +
+        environment.get('PYTHONPATH', '').split(os.pathsep))
+    output = subprocess.check_output([sys.executable, '-c', script],
+                                     env=environment)
+    result = json.loads(output.decode().strip().splitlines()[-1])
+    return result['time'], set(result['modules'])
+
+
+def test_import_time():
+    import_time, modules = run_isolated('import specgrid')
+    assert import_time < IMPORT_TIME_BUDGET
+    for module in ['scipy', 'pandas', 'h5py', 'specutils', 'astropy.modeling',
+                   'matplotlib', 'specgrid.base', 'specgrid.plugins']:
+        assert module not in modules
+
+
+def test_open_grid_imports():
+    _, modules = run_isolated(
+        'import specgrid\n'
+        'specgrid.SpectralGrid({0!r})'.format(data_path('munari_small.h5')))
+    assert 'specgrid.base' in modules
+    for module in ['scipy.interpolate', 'scipy.spatial', 'scipy.ndimage',
+                   'specutils', 'astropy.modeling', 'matplotlib',
+                   'specgrid.plugins']:
+        assert module not in modules
+
+
+def test_open_native_grid_imports(tmpdir):
+    fname = str(tmpdir.join('munari_small.h5'))
+    shutil.copy(data_path('munari_small.h5'), fname)
+    upgrade_hdf5(fname)
+    _, modules = run_isolated(
+        'import specgrid\n'
+        'specgrid.SpectralGrid({0!r})'.format(fname))
+    for module in ['pandas', 'tables']:
+        assert module not in modules
+
+
+def test_lazy_attributes():
+    assert 'SpectralGrid' in dir(specgrid)
+    assert specgrid.plugins.Interpolate.__module__ == 'specgrid.plugins'
+    assert specgrid.ModelStar is specgrid.model_star.ModelStar
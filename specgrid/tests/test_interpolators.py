@@ -0,0 +1,148 @@
+import os
+
+import numpy as np
+import numpy.testing as nptesting
+import pytest
+from scipy import interpolate
+
+import specgrid
+from specgrid import SpectralGrid
+from specgrid.interpolators import (MultilinearInterpolator,
+                                    SimplexInterpolator, Triangulation,
+                                    interpolate_with_jacobian,
+                                    weighted_row_sum)
+
+
+def data_path(filename):
+    return os.path.join(specgrid.__path__[0], 'data', filename)
+
+
+def test_regular_grid_detection(test_specgrid):
+    points = test_specgrid.index.values
+    assert MultilinearInterpolator.is_regular_grid(points)
+    assert not MultilinearInterpolator.is_regular_grid(points[:-1])
+    assert not MultilinearInterpolator.is_regular_grid(
+        np.vstack((points[:-1], points[:1])))
+
+
+def test_specgrid_selects_multilinear(test_regular_specgrid):
+    assert isinstance(test_regular_specgrid.interpolate_grid,
+                      MultilinearInterpolator)
+
+
+def test_multilinear_grid_nodes(test_regular_specgrid):
+    for point, flux in zip(test_regular_specgrid.index.values[::7],
+                           test_regular_specgrid.fluxes[::7]):
+        nptesting.assert_allclose(
+            test_regular_specgrid.interpolate_grid(point)[0], flux)
+
+
+def test_multilinear_against_scipy(test_regular_specgrid):
+    grid = test_regular_specgrid.interpolate_grid
+    sort_idx = grid.node_row.flatten()
+    scipy_interpolator = interpolate.RegularGridInterpolator(
+        grid.axes, test_regular_specgrid.fluxes[sort_idx].reshape(
+            grid.shape + (-1,)))
+    points = np.array([[5780., 4.4, 0.0], [5100., 3.2, 0.3],
+                       [6500., 4.5, 0.5]])
+    nptesting.assert_allclose(grid(points), scipy_interpolator(points))
+
+
+def test_multilinear_outside_grid(test_regular_specgrid):
+    flux = test_regular_specgrid.interpolate_grid([[4000., 4.4, 0.0],
+                                                   [5780., 4.4, 0.0]])
+    assert np.all(np.isnan(flux[0]))
+    assert np.all(np.isfinite(flux[1]))
+
+
+def test_multilinear_irregular_raises(test_specgrid):
+    with pytest.raises(ValueError):
+        MultilinearInterpolator(test_specgrid.index.values[:-1],
+                                test_specgrid.fluxes[:-1])
+
+
+def test_simplex_against_linearnd(test_specgrid):
+    simplex_interpolator = SimplexInterpolator(test_specgrid.index.values,
+                                               test_specgrid.fluxes)
+    points = np.array([[5780., 4.4, 0.0], [5100., 3.2, 0.3],
+                       [4000., 4.4, 0.0]])
+    nptesting.assert_allclose(simplex_interpolator(points),
+                              test_specgrid.interpolate_grid(points))
+
+
+def test_triangulation_cache(test_specgrid, tmpdir):
+    cache_fname = str(tmpdir.join('munari_small.triangulation.h5'))
+    points = test_specgrid.index.values
+    assert Triangulation.from_hdf5(cache_fname, points) is None
+
+    Triangulation.cached(cache_fname, points)
+    triangulation = Triangulation.from_hdf5(cache_fname, points)
+    assert isinstance(triangulation.transform, np.memmap)
+    assert Triangulation.from_hdf5(cache_fname, points[::-1]) is None
+
+    cached_grid = SpectralGrid(data_path('munari_small.h5'),
+                               interpolator=SimplexInterpolator,
+                               triangulation_cache=cache_fname)
+    assert isinstance(cached_grid.interpolate_grid, SimplexInterpolator)
+    points = np.array([[5780., 4.4, 0.0], [5100., 3.2, 0.3],
+                       [4000., 4.4, 0.0]] + points[::5].tolist())
+    nptesting.assert_allclose(cached_grid.interpolate_grid(points),
+                              test_specgrid.interpolate_grid(points))
+
+
+def test_weighted_row_sum(tmpdir):
+    random_state = np.random.RandomState(0)
+    values = random_state.uniform(size=(20, 50))
+    memmap_values = np.memmap(str(tmpdir.join('values.dat')), mode='w+',
+                              dtype=values.dtype, shape=values.shape)
+    memmap_values[:] = values
+    rows = random_state.randint(0, 20, size=(7, 4))
+    weights = random_state.uniform(size=(7, 4, 2))
+
+    expected = np.einsum('nvs,nvw->nsw', weights, values[rows])
+    for row_values in [values, memmap_values]:
+        nptesting.assert_allclose(
+            weighted_row_sum(row_values, rows, weights[..., 0],
+                             np.empty((7, 50))), expected[:, 0])
+        nptesting.assert_allclose(
+            weighted_row_sum(row_values, rows, weights,
+                             np.empty((7, 2, 50))), expected)
+
+
+def test_triangulation_duplicate_node(test_specgrid):
+    points = test_specgrid.index.values
+    # Qhull leaves one of the duplicated nodes out of all simplices
+    duplicated_points = np.vstack((points, points[[20]]))
+    triangulation = Triangulation.from_points(duplicated_points)
+    vertex_simplices = triangulation.simplices[
+        triangulation.vertex_to_simplex]
+    assert np.all(np.any(np.all(
+        duplicated_points[vertex_simplices] ==
+        duplicated_points[:, np.newaxis], axis=-1), axis=-1))
+
+    xi = points[20] + np.array([[0., 0., 0.], [10., 0.05, 0.01],
+                                [-10., -0.05, 0.01]])
+    simplex = triangulation.find_simplex(xi)
+    assert np.all(simplex >= 0)
+    assert np.all(triangulation.barycentric(simplex, xi) >= -1e-12)
+
+
+@pytest.mark.parametrize('interpolator', [MultilinearInterpolator,
+                                          SimplexInterpolator,
+                                          interpolate.LinearNDInterpolator])
+def test_jacobian_against_finite_differences(test_specgrid, interpolator):
+    grid = interpolator(test_specgrid.index.values, test_specgrid.fluxes)
+    point = np.array([5780., 4.1, 0.2])
+    step = np.array([1., 1e-3, 1e-3])
+
+    values, jacobian = interpolate_with_jacobian(grid, [point])
+    nptesting.assert_allclose(values, grid(point))
+    for i in range(3):
+        offset = np.eye(3)[i] * step[i]
+        finite_difference = (grid(point + offset) -
+                             grid(point - offset)) / (2 * step[i])
+        nptesting.assert_allclose(jacobian[0, i], finite_difference[0],
+                                  rtol=1e-6, atol=1e-6)
+
+    values, jacobian = interpolate_with_jacobian(grid, [7000., 4., 0.])
+    assert np.all(np.isnan(jacobian))
@@ -1,8 +1,18 @@
+import os
 import pytest
+import numpy as np
+import specgrid
+from specgrid import SpectralGrid
 from specgrid.model_star import assemble_observation, ModelStar
 from specgrid.plugins import DopplerShift
+from specgrid.io.base import convert_to_log_wavelength
 import numpy.testing as nptesting
 
+
+def data_path(filename):
+    return os.path.join(specgrid.__path__[0], 'data', filename)
+
+
 @pytest.mark.parametrize("plugin_names",
                          [['doppler', 'rotation', 'resolution'],
                          ['rotation', 'resolution', 'doppler']]
@@ -19,4 +29,160 @@ def test_simple_assemble_observation(test_specgrid, h5_test_data, plugin_names):
 def test_simple_modelstar(test_specgrid):
     doppler = DopplerShift()
     model_star = ModelStar(test_specgrid, [doppler])
-    assert model_star.param_names == ['teff', 'logg', 'feh', 'vrad']
\ No newline at end of file
+    assert model_star.param_names == ['teff', 'logg', 'feh', 'vrad']
+
+def test_observation_dtype(test_regular_specgrid):
+    float32_grid = SpectralGrid(data_path('munari_small.h5'),
+                                dtype=np.float32)
+    observation = assemble_observation(
+        float32_grid, plugin_names=['doppler', 'rotation', 'resolution'])
+    observation.dtype = np.float32
+    assert all(plugin.dtype == np.float32
+               for plugin in observation.all_plugins)
+    observation.vrot = 20.
+    spectrum = observation.evaluate(teff=5780., logg=4.4, feh=0.0)
+    assert spectrum.flux.dtype == np.float32
+
+    observation_64 = assemble_observation(
+        test_regular_specgrid,
+        plugin_names=['doppler', 'rotation', 'resolution'])
+    observation_64.vrot = 20.
+    nptesting.assert_allclose(
+        spectrum.flux.value,
+        observation_64.evaluate(teff=5780., logg=4.4, feh=0.0).flux.value,
+        rtol=1e-4)
+
+
+def test_observation_contains(test_specgrid):
+    observation = assemble_observation(test_specgrid,
+                                       plugin_names=['doppler', 'rotation'])
+    assert observation.contains(teff=5780., vrad=1000.)
+    assert not observation.contains(teff=4000.)
+    assert not observation.model_star.contains(logg=2.)
+    assert observation.teff != 4000.
+
+
+def test_observation_evaluate_record(test_specgrid):
+    observation = assemble_observation(
+        test_specgrid, plugin_names=['doppler', 'rotation', 'resolution'])
+    parameters = dict(teff=5780., logg=4.1, feh=0.2, vrot=10., vrad=20.,
+                      R=20000.)
+    record = observation._evaluate_record(**parameters)
+    spectrum = observation.evaluate(**parameters)
+    nptesting.assert_allclose(record.flux, spectrum.flux.value)
+    nptesting.assert_allclose(record.wavelength, spectrum.wavelength.value)
+    assert record.flux_unit == spectrum.flux.unit
+
+
+def test_observation_log_grid_pipeline(test_specgrid):
+    observation = assemble_observation(
+        test_specgrid, plugin_names=['doppler', 'rotation', 'resolution'])
+    parameters = dict(teff=5780., logg=4.1, feh=0.2, vrot=10., vrad=20.,
+                      R=20000.)
+    record = observation._evaluate_record(**parameters)
+
+    # the plugins one by one, each resampling to its own log grid and back
+    spectrum = test_specgrid._evaluate_record()
+    for plugin in observation.all_plugins:
+        spectrum = plugin(spectrum)
+    nptesting.assert_allclose(record.wavelength, spectrum.wavelength)
+    nptesting.assert_allclose(record.flux, spectrum.flux,
+                              atol=0.05 * np.abs(spectrum.flux).max())
+
+    # the rotation and the instrument share one log grid, which is kept for
+    # small changes of R
+    for R in [20500., 21000.]:
+        observation._evaluate_record(vrot=20., R=R)
+    assert len(observation.pipeline._resamplers) == 1
+
+
+def test_observation_log_wavelength_grid(test_regular_specgrid, tmpdir):
+    fname = str(tmpdir.join('munari_small_log.h5'))
+    convert_to_log_wavelength(data_path('munari_small.h5'), fname,
+                              log_wavelength_step=6.5e-5)
+    log_grid = SpectralGrid(fname)
+    plugin_names = ['doppler', 'rotation', 'resolution']
+    parameters = dict(teff=5780., logg=4.1, feh=0.2, vrot=10., vrad=30.,
+                      R=5000.)
+
+    observation = assemble_observation(log_grid, plugin_names=plugin_names)
+    record = observation._evaluate_record(**parameters)
+    # no resampling - the Doppler shift moves the flux along the grid
+    nptesting.assert_array_equal(record.wavelength, log_grid.wavelength.value)
+    assert len(observation.pipeline._resamplers) == 0
+
+    reference = assemble_observation(test_regular_specgrid,
+                                     plugin_names=plugin_names)
+    reference_record = reference._evaluate_record(**parameters)
+    reference_flux = np.interp(record.wavelength,
+                               reference_record.wavelength,
+                               reference_record.flux)
+    nptesting.assert_allclose(record.flux[100:-100],
+                              reference_flux[100:-100],
+                              atol=0.05 * np.abs(reference_flux).max())
+
+    # a grid coarser than the instrument needs is resampled as before
+    observation._evaluate_record(R=20000.)
+    assert len(observation.pipeline._resamplers) == 1
+
+
+def test_observation_convolve_rebin(test_regular_specgrid, test_spectrum,
+                                    tmpdir):
+    fname = str(tmpdir.join('munari_small_log.h5'))
+    convert_to_log_wavelength(data_path('munari_small.h5'), fname,
+                              log_wavelength_step=6.5e-5)
+    observation = assemble_observation(
+        SpectralGrid(fname), plugin_names=['doppler', 'rotation',
+                                           'resolution'],
+        spectrum=test_spectrum)
+    interpolate = observation.all_plugins[-1]
+    parameters = dict(teff=5780., logg=4.1, feh=0.2, vrot=10., vrad=30.,
+                      R=5000.)
+
+    # convolved and interpolated separately until the same wavelengths and
+    # kernel come again, then with one sparse matrix
+    separate_flux = observation._evaluate_record(**parameters).flux
+    assert interpolate._convolve_rebinners._value is None
+    for i in range(2):
+        record = observation._evaluate_record(**parameters)
+        nptesting.assert_allclose(record.flux, separate_flux, rtol=1e-10)
+        nptesting.assert_array_equal(record.wavelength,
+                                     test_spectrum.wavelength.value)
+    assert interpolate._convolve_rebinners._value is not None
+
+
+def test_observation_jacobian(test_regular_specgrid, test_spectrum):
+    observation = assemble_observation(
+        test_regular_specgrid, plugin_names=['doppler', 'rotation',
+                                             'resolution', 'ccm89'],
+        spectrum=test_spectrum)
+    assert observation.provides_jacobian
+    parameters = dict(teff=5650., logg=4.2, feh=0.15, vrot=20., vrad=10.,
+                      R=20000., a_v=0.5, r_v=3.1)
+    spectrum, jacobian = observation.evaluate_with_jacobian(**parameters)
+    nptesting.assert_allclose(spectrum.flux.value,
+                              observation.evaluate(**parameters).flux.value)
+    assert jacobian.shape == (len(observation.param_names),
+                              len(test_spectrum.flux))
+
+    # central differences inside the grid cell; the plugin parameters are
+    # forward differences over piecewise linear resampling
+    steps = dict(teff=1., logg=1e-3, feh=1e-3, vrot=1e-3, vrad=1e-2, R=10.,
+                 a_v=1e-3, r_v=1e-3)
+    for row, name in zip(jacobian.value, observation.param_names):
+        fluxes = [observation.evaluate(**dict(
+            parameters, **{name: parameters[name] + sign * steps[name]})
+                                       ).flux.value for sign in [-1, 1]]
+        if name in test_regular_specgrid.param_names:
+            atol = 1e-3 * np.abs(row).max()
+        else:
+            atol = 1e-2 * np.abs(row).max()
+        nptesting.assert_allclose(row, (fluxes[1] - fluxes[0]) /
+                                  (2 * steps[name]), atol=atol)
+
+    normalized = assemble_observation(
+        test_regular_specgrid, plugin_names=['doppler'],
+        spectrum=test_spectrum, normalize_npol=2)
+    assert not normalized.provides_jacobian
+    with pytest.raises(ValueError):
+        normalized.evaluate_with_jacobian(**dict(teff=5650., vrad=10.))
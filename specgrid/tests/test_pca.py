@@ -0,0 +1,81 @@
+import os
+import shutil
+
+import h5py
+import numpy as np
+import numpy.testing as nptesting
+import pytest
+
+import specgrid
+from specgrid import SpectralGrid
+from specgrid.cache import PCAFluxes
+from specgrid.interpolators import PCAInterpolator
+from specgrid.io.pca import make_pca_hdf5
+
+
+def data_path(filename):
+    return os.path.join(specgrid.__path__[0], 'data', filename)
+
+
+@pytest.fixture(scope='module')
+def pca_fname(tmpdir_factory):
+    fname = str(tmpdir_factory.mktemp('pca').join('munari_small_pca.h5'))
+    make_pca_hdf5(data_path('munari_small.h5'), fname, n_components=55)
+    return fname
+
+
+def test_make_pca_hdf5_error(tmpdir):
+    fname = str(tmpdir.join('munari_small_pca.h5'))
+    reconstruction = make_pca_hdf5(data_path('munari_small.h5'), fname,
+                                   max_relative_error=1e-2)
+    assert reconstruction['n_components'] < 56
+    assert reconstruction['max_relative_error'] <= 1e-2
+
+    pca_grid = SpectralGrid(fname)
+    fluxes = SpectralGrid(data_path('munari_small.h5')).fluxes
+    residual = np.asarray(pca_grid.fluxes) - fluxes
+    relative_error = np.sqrt((residual ** 2).sum(1) / (fluxes ** 2).sum(1))
+    nptesting.assert_allclose(relative_error.max(),
+                              reconstruction['max_relative_error'])
+
+
+def test_make_pca_hdf5_zero_spectrum(tmpdir):
+    grid_fname = str(tmpdir.join('munari_small.h5'))
+    shutil.copy(data_path('munari_small.h5'), grid_fname)
+    with h5py.File(grid_fname, 'a') as fh:
+        fh['fluxes'][3] = 0.
+
+    fname = str(tmpdir.join('munari_small_pca.h5'))
+    reconstruction = make_pca_hdf5(grid_fname, fname, max_relative_error=1e-2,
+                                   block_size=10)
+    assert reconstruction['max_relative_error'] <= 1e-2
+    with h5py.File(fname, 'r') as fh:
+        assert np.all(np.isfinite(fh['pca/relative_error'][()]))
+
+
+def test_pca_specgrid(test_regular_specgrid, pca_fname):
+    pca_grid = SpectralGrid(pca_fname)
+    assert isinstance(pca_grid.fluxes, PCAFluxes)
+    assert isinstance(pca_grid.interpolate_grid, PCAInterpolator)
+    nptesting.assert_allclose(pca_grid.wavelength,
+                              test_regular_specgrid.wavelength)
+    nptesting.assert_allclose(pca_grid.fluxes[[3, 7]],
+                              test_regular_specgrid.fluxes[[3, 7]], rtol=1e-6)
+
+    parameter_matrix = [[5780., 4.4, 0.0], [6100., 3.3, 0.45],
+                        [7000., 4.0, 0.0]]
+    pca_fluxes = pca_grid.evaluate_many(parameter_matrix)
+    nptesting.assert_allclose(
+        pca_fluxes[:2],
+        test_regular_specgrid.evaluate_many(parameter_matrix)[:2], rtol=1e-6)
+    assert np.all(np.isnan(pca_fluxes[2]))
+
+
+def test_pca_specgrid_options(pca_fname):
+    pca_grid = SpectralGrid(pca_fname, dtype=np.float32,
+                            wavelength_range=(5000, 6000))
+    assert pca_grid.fluxes.components.shape == (55, len(pca_grid.wavelength))
+    assert pca_grid.evaluate(5780., 4.4, 0.0).flux.value.dtype == np.float32
+
+    with pytest.raises(ValueError):
+        SpectralGrid(pca_fname, lazy=True)
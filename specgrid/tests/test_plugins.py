@@ -1,11 +1,18 @@
 import numpy as np
+import pytest
 import numpy.testing as nptesting
 from numpy.polynomial import Polynomial
 from specgrid.fix_spectrum1d import Spectrum1D
 #from specutils import Spectrum1D
 from astropy import units as u
 from specgrid.plugins import InstrumentConvolve, Interpolate, Normalize, NormalizeParts, CCM89Extinction
+from specgrid.plugins import RotationalBroadening, fractional_shift
+from specgrid.plugins import DopplerShift, LogGridPipeline
+from specgrid.plugins import convolve_rebin_matrix, VariableInstrumentConvolve
+from specgrid.convolution import Convolver, gaussian_kernel
+from specgrid.spectrum_record import SpectrumRecord
 from scipy.integrate import simps
+import scipy.ndimage as nd
 
 
 
@@ -30,6 +37,60 @@ def test_convolution():
                         rtol=1.0, atol=0.0002)
 
 
+def test_variable_instrument_convolve(test_spectrum):
+    wavelength = test_spectrum.wavelength
+    constant = VariableInstrumentConvolve(wavelength[[0, -1]], [5000., 5000.])
+    nptesting.assert_allclose(constant(test_spectrum).flux.value,
+                              InstrumentConvolve(R=5000)(test_spectrum).flux.value,
+                              rtol=1e-10)
+
+    R = np.linspace(3000., 8000., len(wavelength))
+    variable = VariableInstrumentConvolve(wavelength, R)
+    convolved = variable(test_spectrum).flux.value
+    operator = variable._operator
+    nptesting.assert_array_equal(variable(test_spectrum).flux.value, convolved)
+    assert variable._operator is operator
+
+    # close to the constant resolution of either end
+    low, high = [InstrumentConvolve(R=R_end)(test_spectrum).flux.value
+                 for R_end in [3000, 8000]]
+    blue, red = slice(None, len(R) // 10), slice(-len(R) // 10, None)
+    for part, closer, further in [(blue, low, high), (red, high, low)]:
+        assert (np.abs(convolved[part] - closer[part]).sum() <
+                0.5 * np.abs(convolved[part] - further[part]).sum())
+
+    from_fwhm = VariableInstrumentConvolve.from_fwhm(wavelength,
+                                                     wavelength / R)
+    nptesting.assert_allclose(from_fwhm(test_spectrum).flux.value, convolved)
+
+
+def test_variable_instrument_convolve_doppler(test_spectrum):
+    record = SpectrumRecord.from_spectrum1d(test_spectrum)
+    wavelength = test_spectrum.wavelength
+    R = np.linspace(3000., 8000., len(wavelength))
+    doppler = DopplerShift()
+    variable = VariableInstrumentConvolve(wavelength, R)
+    pipeline = LogGridPipeline()
+
+    operator = None
+    for vrad in [0., 3., -2.]:
+        doppler.vrad = vrad
+        flux = pipeline(record, [doppler, variable]).flux
+        if operator is None:
+            operator = variable._operator
+        # small shifts change R by less than the tolerance
+        assert variable._operator is operator
+
+        fresh = VariableInstrumentConvolve(wavelength, R)
+        nptesting.assert_allclose(
+            flux, LogGridPipeline()(record, [doppler, fresh]).flux,
+            rtol=1e-3)
+
+    doppler.vrad = 3000.
+    pipeline(record, [doppler, variable])
+    assert variable._operator is not operator
+
+
 def test_interpolate():
     obs_spectrum = Spectrum1D.from_array(np.arange(1,26), np.zeros(25),
                                          dispersion_unit='micron',
@@ -49,6 +110,62 @@ def test_interpolate():
                                   expected_interpolated_flux, decimal=6)
 
 
+def test_interpolate_rebinner(test_spectrum):
+    model = SpectrumRecord(np.linspace(4000., 7000., 10000),
+                           np.sin(np.linspace(0., 300., 10000)),
+                           u.angstrom, test_spectrum.flux.unit)
+    observed_wavelength = test_spectrum.wavelength.to(u.angstrom).value
+    expected_flux = np.interp(observed_wavelength, model.wavelength,
+                              model.flux)
+
+    interpolate_plugin = Interpolate(test_spectrum)
+    for i in range(3):
+        nptesting.assert_allclose(interpolate_plugin(model).flux,
+                                  expected_flux, atol=1e-10)
+        if i == 0:
+            # the weights are only computed for wavelengths seen twice
+            assert interpolate_plugin._rebinners._value is None
+        rebinner = interpolate_plugin._rebinners._value
+    assert interpolate_plugin._rebinners._value is rebinner
+
+    shifted_model = model.replace(wavelength=model.wavelength * 1.0001)
+    nptesting.assert_allclose(
+        interpolate_plugin(shifted_model).flux,
+        np.interp(observed_wavelength, shifted_model.wavelength, model.flux))
+    assert interpolate_plugin._rebinners._value is rebinner
+
+
+def test_interpolate_flux_conserving(test_spectrum):
+    wavelength = np.linspace(2990., 6010., 302001)
+    flux = np.sin(20. * wavelength) ** 2
+    model = SpectrumRecord(wavelength, flux, u.angstrom,
+                           test_spectrum.flux.unit)
+    interpolate_plugin = Interpolate(test_spectrum, flux_conserving=True)
+    rebinned_flux = interpolate_plugin(model).flux
+
+    # the mean of sin^2 over pixels several periods wide
+    nptesting.assert_allclose(rebinned_flux, 0.5, atol=0.05)
+    assert np.ptp(Interpolate(test_spectrum)(model).flux) > 0.9
+
+    constant_model = model.replace(flux=np.full_like(flux, 3.))
+    nptesting.assert_allclose(interpolate_plugin(constant_model).flux, 3.)
+
+
+def test_convolve_rebin_matrix():
+    wavelength = np.exp(np.arange(np.log(4000.), np.log(7000.), 5e-5))
+    flux = np.sin(wavelength / 3.) + 2.
+    observed_wavelength = np.arange(3990., 7010., 0.7)
+    for sigma in [0.4, 2., 30.]:
+        kernel = gaussian_kernel(sigma)
+        matrix = convolve_rebin_matrix(wavelength, observed_wavelength,
+                                       kernel)
+        assert matrix.shape == (len(observed_wavelength), len(wavelength))
+        nptesting.assert_allclose(
+            matrix.dot(flux),
+            np.interp(observed_wavelength, wavelength,
+                      Convolver('direct')(flux, kernel)), rtol=1e-12)
+
+
 def test_normalize():
     w = np.arange(4000., 5000., 10.)
     coeff = [1., 0.1, 0.1]
@@ -64,6 +181,48 @@ def test_normalize():
                         np.array(coeff + [0.]), rtol=1e-5, atol=1.e-10)
 
 
+def test_normalize_unit():
+    w = np.arange(4000., 5000., 10.)
+    obs_spectrum = Spectrum1D.from_array(w, Polynomial([1., 0.1])(w),
+                                         dispersion_unit=u.AA, unit='Jy')
+    norm = Normalize(obs_spectrum, npol=1)
+    model = Spectrum1D.from_array(w, np.ones_like(w), dispersion_unit=u.AA,
+                                  unit='erg/(cm^2 s Angstrom)')
+    # the fit reproduces the observed fluxes and is labelled in their unit
+    fit = norm(model)
+    assert fit.flux.unit == u.Jy
+    nptesting.assert_allclose(fit.flux.value, obs_spectrum.flux.value)
+    record = norm(SpectrumRecord.from_spectrum1d(model))
+    assert record.flux_unit == u.Jy
+
+
+def test_normalize_solvers(test_spectrum):
+    wavelength = test_spectrum.wavelength.value
+    model = SpectrumRecord(wavelength,
+                           1. + 0.3 * np.sin(wavelength / 50.),
+                           test_spectrum.wavelength.unit,
+                           test_spectrum.flux.unit)
+    for npol in [0, 3, 8]:
+        normal = Normalize(test_spectrum, npol=npol)
+        lstsq = Normalize(test_spectrum, npol=npol, solver='lstsq')
+        nptesting.assert_allclose(normal(model).flux, lstsq(model).flux,
+                                  rtol=1e-9)
+        nptesting.assert_allclose(normal.coefficients, lstsq.coefficients,
+                                  rtol=1e-7, atol=1e-12)
+
+    fluxes = np.array([model.flux, 2. * model.flux, model.flux])
+    fluxes[2, 10] = np.nan
+    fits, coefficients = normal.normalize_many(fluxes)
+    nptesting.assert_allclose(fits[0], normal(model).flux)
+    nptesting.assert_allclose(fits[1], fits[0])
+    nptesting.assert_allclose(coefficients[1], coefficients[0] / 2.)
+    assert np.isnan(coefficients[2]).all()
+    nptesting.assert_array_equal(fits[2], fluxes[2])
+
+    with pytest.raises(ValueError):
+        Normalize(test_spectrum, npol=3, solver='qr')
+
+
 def test_normalize_parts():
     w = np.arange(4000., 5000., 10.)
     coeff = [1., 0.1, 0.1]
@@ -88,6 +247,37 @@ def test_normalize_parts():
                             np.array(coeff + [0.]), rtol=1e-3, atol=1.e-5)
 
 
+def test_normalize_parts_block(test_spectrum):
+    wavelength = test_spectrum.wavelength.value
+    model_flux = 1. + 0.3 * np.sin(wavelength / 50.)
+    model = SpectrumRecord(wavelength, model_flux,
+                           test_spectrum.wavelength.unit,
+                           test_spectrum.flux.unit)
+    n = len(wavelength)
+    # parts of different degrees, the last one needing the SVD solve
+    parts = [slice(0, n // 4), slice(n // 4, n // 2),
+             np.arange(n)[n // 2:3 * n // 4], np.arange(n) >= 3 * n // 4]
+    npol = [2, 0, 5, 14]
+    norm_parts = NormalizeParts(test_spectrum, parts, npol=npol)
+    fit = norm_parts(model).flux
+
+    for part, _npol, normalizer in zip(parts, npol, norm_parts.normalizers):
+        part_normalize = Normalize(
+            NormalizeParts.spectrum_1d_getitem(test_spectrum, part), _npol)
+        part_fit = part_normalize(model.replace(
+            wavelength=wavelength[part], flux=model_flux[part])).flux
+        nptesting.assert_allclose(fit[part], part_fit, rtol=1e-8)
+        nptesting.assert_allclose(normalizer.coefficients,
+                                  part_normalize.coefficients,
+                                  rtol=1e-6, atol=1e-12)
+
+    nan_flux = model_flux.copy()
+    nan_flux[n // 4 + 3] = np.nan
+    fit = norm_parts(model.replace(flux=nan_flux)).flux
+    nptesting.assert_array_equal(fit[parts[1]], nan_flux[parts[1]])
+    assert np.isfinite(fit[parts[0]]).all()
+
+
 def test_ccm89(test_spectrum):
     ccm89_plugin = CCM89Extinction()
     ccm89_plugin.a_v = 0
@@ -96,4 +286,92 @@ def test_ccm89(test_spectrum):
     ccm89_plugin.a_v = 1
     extincted_spectrum = ccm89_plugin(test_spectrum)
     assert not np.all(np.isclose(extincted_spectrum.flux.value,
-                                 test_spectrum.flux.value))
\ No newline at end of file
+                                 test_spectrum.flux.value))
+
+
+def test_ccm89_coefficient_cache(test_spectrum):
+    from specutils import extinction
+    wavelength = test_spectrum.wavelength.to(u.angstrom).value
+    ccm89_plugin = CCM89Extinction()
+    for a_v, r_v in [(1., 3.1), (0.3, 2.), (2.5, 5.)]:
+        ccm89_plugin.a_v = a_v
+        ccm89_plugin.r_v = r_v
+        a_lambda = extinction.extinction_ccm89(
+            wavelength * u.angstrom, a_v=a_v, r_v=r_v).to(u.angstrom).value
+        nptesting.assert_allclose(ccm89_plugin(test_spectrum).flux.value,
+                                  test_spectrum.flux.value *
+                                  10 ** (-0.4 * a_lambda), rtol=1e-12)
+        if a_v == 1.:
+            # the coefficients are only computed for wavelengths seen twice
+            assert ccm89_plugin._coefficients._value is None
+        else:
+            coefficients = ccm89_plugin._coefficients._value
+    assert ccm89_plugin._coefficients._value is coefficients
+
+    # new (e.g. Doppler shifted) wavelengths evaluate the curve directly
+    shifted = SpectrumRecord.from_spectrum1d(test_spectrum)
+    shifted = shifted.replace(wavelength=shifted.wavelength * 1.001)
+    a_lambda = extinction.extinction_ccm89(
+        shifted.wavelength * shifted.wavelength_unit, a_v=2.5,
+        r_v=5.).to(u.angstrom).value
+    nptesting.assert_allclose(ccm89_plugin(shifted).flux,
+                              shifted.flux * 10 ** (-0.4 * a_lambda),
+                              rtol=1e-12)
+    assert ccm89_plugin._coefficients._value is coefficients
+
+
+def test_rotational_broadening_cache(test_spectrum):
+    rotation = RotationalBroadening()
+    rotation.vrot = 30.
+    rotated = rotation(test_spectrum)
+
+    wavelength = test_spectrum.wavelength.value
+    log_grid_wavelength = np.exp(np.arange(np.log(wavelength.min()),
+                                           np.log(wavelength.max()),
+                                           rotation.resolution.value))
+    log_grid_flux = np.interp(log_grid_wavelength, wavelength,
+                              test_spectrum.flux.value)
+    log_grid_convolved = nd.convolve1d(log_grid_flux,
+                                       rotation.rotational_profile())
+    nptesting.assert_allclose(
+        rotated.flux.value,
+        np.interp(wavelength, log_grid_wavelength, log_grid_convolved),
+        rtol=1e-12)
+
+    resampler = rotation._resampler
+    nptesting.assert_array_equal(rotation(test_spectrum).flux.value,
+                                 rotated.flux.value)
+    assert rotation._resampler is resampler
+    assert rotation.profile_cache.hits == 1
+
+    rotation.limb_darkening = 0.3
+    rotation(test_spectrum)
+    assert rotation.profile_cache.misses == 2
+    assert len(rotation.profile_cache) == 2
+
+
+def test_fractional_shift():
+    x = np.arange(200.)
+    flux = np.sin(x / 7.)
+    nptesting.assert_array_equal(fractional_shift(flux, 3.)[3:], flux[:-3])
+    nptesting.assert_array_equal(fractional_shift(flux, -3.)[:-3], flux[3:])
+    for shift in [0.3, -2.6, 40.5]:
+        shifted = fractional_shift(flux, shift)
+        inside = (x - shift >= 1) & (x - shift <= 197)
+        nptesting.assert_allclose(shifted[inside],
+                                  np.sin((x[inside] - shift) / 7.), atol=1e-4)
+    assert fractional_shift(flux.astype(np.float32), 0.5).dtype == np.float32
+
+
+def test_plugins_on_spectrum_record(test_spectrum):
+    record = SpectrumRecord.from_spectrum1d(test_spectrum)
+    for plugin in [InstrumentConvolve(R=5000), Interpolate(test_spectrum),
+                   Normalize(test_spectrum, npol=3),
+                   CCM89Extinction(a_v=1.)]:
+        record_result = plugin(record)
+        assert isinstance(record_result, SpectrumRecord)
+        spectrum_result = plugin(test_spectrum)
+        assert isinstance(spectrum_result, Spectrum1D)
+        nptesting.assert_allclose(record_result.flux,
+                                  spectrum_result.flux.value)
+        assert record_result.flux_unit == spectrum_result.flux.unit
@@ -33,6 +33,27 @@ def test_simple_fit1(test_spectrum, test_model_star):
     nptesting.assert_allclose(fit_result.best_fit_values[1], 4.40831046502)
     nptesting.assert_allclose(fit_result.best_fit_values[2], 0.328212333713)
 
+def test_fit_specgrid_with_jacobian(test_regular_specgrid):
+    spectrum = test_regular_specgrid.evaluate(5700., 4.2, 0.3)
+    fit_result = fit_spectrum(spectrum, test_regular_specgrid, teff=5500.,
+                              logg=4.0, feh=0.1)
+
+    nptesting.assert_allclose(fit_result.best_fit_values, [5700., 4.2, 0.3])
+    assert fit_result.full_output['njev'] > 0
+
+def test_fit_observation_with_jacobian(test_regular_specgrid, test_spectrum):
+    observation = assemble_observation(
+        test_regular_specgrid, plugin_names=['doppler', 'resolution'],
+        spectrum=test_spectrum)
+    observation.R = 20000.
+    spectrum = observation.evaluate(teff=5700., logg=4.2, feh=0.3, vrad=12.)
+    fit_result = fit_spectrum(spectrum, observation, teff=5600., logg=4.1,
+                              feh=0.2, vrad=10.)
+
+    nptesting.assert_allclose(fit_result.best_fit_values,
+                              [5700., 4.2, 0.3, 12.], rtol=1e-4)
+    assert fit_result.full_output['njev'] > 0
+
 @pytest.mark.xfail
 def test_simple_fit1(test_spectrum, test_model_star):
     fit_result = fit_spectrum(test_spectrum, test_model_star, teff=5600, logg=4.3,
@@ -1,10 +1,16 @@
 import os
+import pickle
+import shutil
 import specgrid
-from specgrid import SpectralGrid
+from specgrid import SpectralGrid, cache
+from specgrid.base import GRID_FORMAT_VERSION
+from specgrid.interpolators import SimplexInterpolator
+from specgrid.io.base import upgrade_hdf5, convert_to_log_wavelength
 import numpy.testing as nptesting
 import numpy as np
 import h5py
 import pytest
+from astropy import units as u
 
 
 def data_path(filename):
@@ -35,3 +41,218 @@ def test_simple_interpolation(test_specgrid, h5_test_data):
     comp_flux = h5_test_data['test_data']['simple_interpolation_sun'].__array__()
     nptesting.assert_allclose(spec.flux.value, comp_flux)
 
+
+def test_evaluate_many(test_specgrid):
+    parameter_matrix = np.array([[5780., 4.4, 0.0], [5100., 3.2, 0.3],
+                                 [4000., 4.4, 0.0]])
+    fluxes = test_specgrid.evaluate_many(parameter_matrix)
+    assert fluxes.shape == (3, len(test_specgrid.wavelength))
+    for parameters, flux in zip(parameter_matrix[:2], fluxes[:2]):
+        nptesting.assert_allclose(
+            flux, test_specgrid.evaluate(*parameters).flux.value)
+    assert np.all(np.isnan(fluxes[2]))
+
+    with pytest.raises(ValueError):
+        test_specgrid.evaluate_many([[5780., 4.4]])
+
+
+def test_evaluate_with_jacobian(test_regular_specgrid):
+    spectrum, jacobian = test_regular_specgrid.evaluate_with_jacobian(
+        5780., 4.1, 0.2)
+    assert jacobian.shape == (3, len(test_regular_specgrid.wavelength))
+    assert jacobian.unit == test_regular_specgrid.flux_unit
+    nptesting.assert_allclose(
+        spectrum.flux.value,
+        test_regular_specgrid.evaluate(5780., 4.1, 0.2).flux.value)
+
+    # multilinear interpolation is linear along each axis within a cell
+    shifted_flux = test_regular_specgrid.evaluate(teff=5790.).flux.value
+    nptesting.assert_allclose(shifted_flux, spectrum.flux.value +
+                              10. * jacobian[0].value)
+
+@pytest.mark.parametrize("regular_grid", [True, False])
+def test_contains(test_regular_specgrid, test_irregular_specgrid,
+                  regular_grid):
+    # regular grids are checked against their bounds, irregular grids
+    # against the convex hull of their points
+    if regular_grid:
+        grid = test_regular_specgrid
+    else:
+        grid = test_irregular_specgrid
+    assert grid.regular_grid == regular_grid
+    assert grid.contains(5780., 4.4, 0.0)
+    assert not grid.contains(teff=4000.)
+    assert grid.teff != 4000.
+
+    parameter_matrix = np.random.RandomState(0).uniform(
+        [4900., 2.9, -0.1], [6600., 4.6, 0.6], size=(500, 3))
+    parameter_matrix = np.vstack((parameter_matrix, grid.index.values))
+    outside = np.isnan(grid.interpolate_grid(parameter_matrix)[:, 0])
+    nptesting.assert_array_equal(grid.contains_many(parameter_matrix),
+                                 ~outside)
+    nptesting.assert_array_equal(
+        np.isnan(grid.evaluate_many(parameter_matrix)[:, 0]), outside)
+    # the point removed from the irregular grid is inside the bounds only
+    assert grid.contains(6450., 4.45, 0.45) == regular_grid
+
+
+@pytest.mark.parametrize("lazy", [False, True])
+def test_wavelength_range(test_regular_specgrid, lazy):
+    range_grid = SpectralGrid(data_path('munari_small.h5'), lazy=lazy,
+                              wavelength_range=(5000, 5100),
+                              margin=100 * u.km / u.s)
+    nptesting.assert_allclose(range_grid.wavelength[[0, -1]].value,
+                              [4997.5, 5102.5])
+    assert range_grid.fluxes.shape == (len(test_regular_specgrid.fluxes),
+                                       len(range_grid.wavelength))
+    nptesting.assert_allclose(
+        range_grid.evaluate(5780., 4.4, 0.0).flux.value,
+        test_regular_specgrid.evaluate(5780., 4.4, 0.0).flux.value[
+            range_grid.wavelength_slice])
+
+
+def test_wavelength_range_outside_grid():
+    with pytest.raises(ValueError):
+        SpectralGrid(data_path('munari_small.h5'),
+                     wavelength_range=(2 * u.micron, 3 * u.micron))
+
+
+@pytest.mark.parametrize("lazy", [False, True])
+def test_single_precision(test_regular_specgrid, lazy):
+    float32_grid = SpectralGrid(data_path('munari_small.h5'), lazy=lazy,
+                                dtype=np.float32)
+    assert float32_grid.dtype == np.float32
+    spec = float32_grid.evaluate(5780., 4.4, 0.0)
+    assert spec.flux.dtype == np.float32
+    nptesting.assert_allclose(
+        spec.flux.value,
+        test_regular_specgrid.evaluate(5780., 4.4, 0.0).flux.value,
+        rtol=1e-6)
+    assert float32_grid.evaluate_many([[5780., 4.4, 0.0]]).dtype == \
+        np.float32
+
+
+def test_single_precision_irregular(test_irregular_specgrid,
+                                    irregular_grid_fname):
+    float32_grid = SpectralGrid(irregular_grid_fname, dtype=np.float32)
+    assert not float32_grid.regular_grid
+    # no double precision copy of the fluxes in the interpolator
+    assert isinstance(float32_grid.interpolate_grid, SimplexInterpolator)
+    assert float32_grid.interpolate_grid.values.dtype == np.float32
+    spec = float32_grid.evaluate(5780., 4.4, 0.0)
+    assert spec.flux.dtype == np.float32
+    nptesting.assert_allclose(
+        spec.flux.value,
+        test_irregular_specgrid.evaluate(5780., 4.4, 0.0).flux.value,
+        rtol=1e-6)
+    assert float32_grid.evaluate_many([[5780., 4.4, 0.0]]).dtype == \
+        np.float32
+
+
+def test_spectrum_cache(test_regular_specgrid):
+    row_bytes = test_regular_specgrid.fluxes[0].nbytes
+    cached_grid = SpectralGrid(data_path('munari_small.h5'),
+                               spectrum_cache_bytes=3 * row_bytes,
+                               spectrum_cache_tolerance=[1., 0.01, 0.01])
+    spec = cached_grid.evaluate(5780., 4.4, 0.0)
+    nptesting.assert_allclose(
+        spec.flux.value,
+        test_regular_specgrid.evaluate(5780., 4.4, 0.0).flux.value)
+    cached_spec = cached_grid.evaluate(5780.2, 4.4, 0.0)
+    assert cached_grid.spectrum_cache.stats['hits'] == 1
+    nptesting.assert_array_equal(cached_spec.flux.value, spec.flux.value)
+
+    for teff in [5000., 5100., 5200., 5300.]:
+        cached_grid.evaluate(teff, 4.4, 0.0)
+    assert cached_grid.spectrum_cache.stats['misses'] == 5
+    assert cached_grid.spectrum_cache.current_bytes <= 3 * row_bytes
+
+
+def test_memmap_specgrid(test_regular_specgrid, tmpdir):
+    grid_fname = str(tmpdir.join('munari_small.h5'))
+    shutil.copy(data_path('munari_small.h5'), grid_fname)
+
+    memmap_grid = SpectralGrid(grid_fname, memmap=True)
+    assert isinstance(memmap_grid.fluxes, np.memmap)
+    pickled_grid = pickle.dumps(memmap_grid)
+    assert len(pickled_grid) < memmap_grid.fluxes.nbytes / 10
+    unpickled_grid = pickle.loads(pickled_grid)
+    assert isinstance(unpickled_grid.fluxes, np.memmap)
+    nptesting.assert_allclose(
+        unpickled_grid.evaluate(5780., 4.4, 0.0).flux.value,
+        test_regular_specgrid.evaluate(5780., 4.4, 0.0).flux.value)
+
+    float32_grid = SpectralGrid(grid_fname, memmap=True, dtype=np.float32)
+    assert float32_grid.fluxes.dtype == np.float32
+    assert os.path.exists(grid_fname + '.fluxes.float32.npy')
+
+
+def test_memmap_read_only(test_regular_specgrid, tmpdir, monkeypatch):
+    grid_dir = tmpdir.mkdir('read_only')
+    grid_fname = str(grid_dir.join('munari_small.h5'))
+    shutil.copy(data_path('munari_small.h5'), grid_fname)
+    cache_dir = tmpdir.join('cache')
+    monkeypatch.setattr(cache, 'user_cache_dir', lambda: str(cache_dir))
+
+    os.chmod(str(grid_dir), 0o555)
+    try:
+        if os.access(str(grid_dir), os.W_OK):
+            pytest.skip('directory permissions are not enforced')
+        float32_grid = SpectralGrid(grid_fname, memmap=True,
+                                    dtype=np.float32)
+        assert isinstance(float32_grid.fluxes, np.memmap)
+        assert len(cache_dir.listdir()) == 1
+        nptesting.assert_allclose(
+            float32_grid.evaluate(5780., 4.4, 0.0).flux.value,
+            test_regular_specgrid.evaluate(5780., 4.4, 0.0).flux.value,
+            rtol=1e-6)
+
+        # no writable directory at all - the fluxes are loaded into memory
+        monkeypatch.setattr(cache, 'user_cache_dir', lambda: str(grid_dir))
+        memory_grid = SpectralGrid(grid_fname, memmap=True,
+                                   dtype=np.float32)
+        assert not isinstance(memory_grid.fluxes, np.memmap)
+        assert memory_grid.fluxes.dtype == np.float32
+    finally:
+        os.chmod(str(grid_dir), 0o755)
+
+
+def test_native_index(test_regular_specgrid, tmpdir):
+    fname = str(tmpdir.join('munari_small.h5'))
+    shutil.copy(data_path('munari_small.h5'), fname)
+    upgrade_hdf5(fname)
+    with h5py.File(fname, 'r') as fh:
+        assert isinstance(fh['index'], h5py.Dataset)
+        assert fh.attrs['grid_format_version'] == GRID_FORMAT_VERSION
+
+    native_grid = SpectralGrid(fname)
+    assert native_grid.param_names == test_regular_specgrid.param_names
+    nptesting.assert_array_equal(native_grid.index.values,
+                                 test_regular_specgrid.index.values)
+    nptesting.assert_array_equal(
+        native_grid.evaluate(5780., 4.4, 0.0).flux.value,
+        test_regular_specgrid.evaluate(5780., 4.4, 0.0).flux.value)
+
+    with h5py.File(fname, 'a') as fh:
+        fh.attrs['grid_format_version'] = GRID_FORMAT_VERSION + 1
+    with pytest.raises(ValueError):
+        SpectralGrid(fname)
+
+
+def test_convert_to_log_wavelength(test_regular_specgrid, tmpdir):
+    fname = str(tmpdir.join('munari_small_log.h5'))
+    convert_to_log_wavelength(data_path('munari_small.h5'), fname,
+                              log_wavelength_step=1e-4)
+    log_grid = SpectralGrid(fname)
+    assert test_regular_specgrid.log_wavelength_step is None
+    assert log_grid.log_wavelength_step == 1e-4
+    nptesting.assert_allclose(np.diff(np.log(log_grid.wavelength.value)),
+                              1e-4)
+    assert log_grid.wavelength.unit == test_regular_specgrid.wavelength.unit
+    assert log_grid.flux_unit == test_regular_specgrid.flux_unit
+
+    flux = test_regular_specgrid.evaluate(5780., 4.4, 0.0).flux.value
+    nptesting.assert_allclose(
+        log_grid.evaluate(5780., 4.4, 0.0).flux.value,
+        np.interp(log_grid.wavelength.value,
+                  test_regular_specgrid.wavelength.value, flux))